@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# Benchmarks run against a scratch database and file storage unless they are given explicitly
+_SCRATCH = tempfile.mkdtemp(prefix="sonata-bench-")
+os.environ.setdefault("DATABASE_PATH", os.path.join(_SCRATCH, "sonata.db"))
+os.environ.setdefault("STORAGE_PATH", os.path.join(_SCRATCH, "storage"))
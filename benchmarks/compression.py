@@ -0,0 +1,56 @@
+import functools
+import gzip
+import statistics
+import time
+
+from flask_jwt_extended import create_access_token
+
+from benchmarks.data import reset_with_user
+from web.base import app
+from web.models import Piece, Tag
+
+_PIECES = 2000
+_TAGS = 20
+_TAGS_PER_PIECE = 5
+_LEVELS = [1, 3, 6, 9]
+_ROUNDS = 20
+
+
+def _median_ms(func) -> float:
+    timings = []
+    for _ in range(_ROUNDS):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    with app.app_context():
+        tags = [Tag(tag=f"tag {i}", color="red") for i in range(_TAGS)]  # type: ignore
+        user = reset_with_user(tags=tags, pieces=[
+            Piece(name=f"piece {i}", description="A piece to practice",  # type: ignore
+                  instrument="Piano", state=i % 3, tags=tags[i % _TAGS:][:_TAGS_PER_PIECE])
+            for i in range(_PIECES)])
+        headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+
+        client = app.test_client()
+        payload = client.get("/api/auth/current_user", headers=headers).get_data()
+        print(f"current_user payload of {_PIECES} pieces: {len(payload)} bytes")
+        print(f"{'level':>6} {'bytes':>10} {'ratio':>7} {'cpu (ms)':>9}")
+        for level in _LEVELS:
+            compressed = gzip.compress(payload, compresslevel=level, mtime=0)
+            cpu = _median_ms(functools.partial(gzip.compress, payload, compresslevel=level,
+                                               mtime=0))
+            print(f"{level:>6} {len(compressed):>10} {len(payload) / len(compressed):>7.1f} "
+                  f"{cpu:>9.2f}")
+
+        plain = _median_ms(lambda: client.get("/api/auth/current_user", headers=headers))
+        gzipped = _median_ms(lambda: client.get(
+            "/api/auth/current_user", headers={**headers, "Accept-Encoding": "gzip"}))
+        print(f"request without gzip: {plain:.2f}ms, with gzip (level "
+              f"{app.config['COMPRESSION_LEVEL']}): {gzipped:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import io
+import math
+import random
+from typing import Any, Dict, List, NamedTuple
+
+from web.base import database, storage
+from web.models import File, Piece, Tag, User
+
+_INSTRUMENTS = ["Piano", "Violin", "Cello", "Guitar", "Flute", None]
+_COLORS = ["red", "blue", "green", "yellow", "purple"]
+_FILE_TYPES = ["application/pdf", "image/png", "audio/mpeg"]
+_MIN_FILE_SIZE = 1024
+
+
+class DataShape(NamedTuple):
+    users: int = 10
+    pieces_per_user: int = 200
+    tags_per_user: int = 20
+    tags_per_piece: int = 3
+    # Share of the pieces with an attached file
+    files: float = 0.2
+    # File sizes are log-normal around the median, capped at max_file_size
+    file_size_median: int = 256 * 1024
+    file_size_sigma: float = 1.0
+    max_file_size: int = 4 * 1024 * 1024
+
+
+class Dataset(NamedTuple):
+    emails: List[str]
+    # Ids by user id
+    pieces: Dict[int, List[int]]
+    tags: Dict[int, List[int]]
+    files: List[int]
+
+
+def file_size(rng: random.Random, shape: DataShape) -> int:
+    size = rng.lognormvariate(math.log(shape.file_size_median), shape.file_size_sigma)
+    return int(min(max(size, _MIN_FILE_SIZE), shape.max_file_size))
+
+
+def _add_file(rng: random.Random, shape: DataShape) -> File:
+    blob = storage.save(io.BytesIO(rng.randbytes(file_size(rng, shape))))
+    return File(file_type=rng.choice(_FILE_TYPES), size=blob.size, sha256=blob.sha256,
+                path=blob.path)  # type: ignore
+
+
+# The single user the micro benchmarks run as, in an emptied database
+def reset_with_user(**columns: Any) -> User:
+    database.drop_all()
+    database.create_all()
+    user = User(email="bench@example.com", name="bench", password_hash="hash", salt="salt",
+                **columns)  # type: ignore
+    database.session.add(user)
+    database.session.commit()
+    return user
+
+
+# The same seed and shape always produce the same rows, in the same order, so runs of the
+# benchmarks are comparable
+def generate(seed: int, shape: DataShape) -> Dataset:
+    rng = random.Random(seed)
+    dataset = Dataset([], {}, {}, [])
+    for user_index in range(shape.users):
+        user = User(email=f"user{user_index}@example.com", name=f"user {user_index}",
+                    password_hash="hash", salt="salt")  # type: ignore
+        tags = [Tag(tag=f"tag {i}", color=rng.choice(_COLORS))  # type: ignore
+                for i in range(shape.tags_per_user)]
+        pieces = [Piece(  # type: ignore
+            name=f"piece {i}",
+            description=rng.choice([None, f"Practice notes for piece {i}"]),
+            instrument=rng.choice(_INSTRUMENTS),
+            state=rng.randrange(3),
+            tags=rng.sample(tags, min(shape.tags_per_piece, len(tags))),
+            file=_add_file(rng, shape) if rng.random() < shape.files else None,
+        ) for i in range(shape.pieces_per_user)]
+        user.tags = tags
+        user.pieces = pieces  # type: ignore
+        database.session.add(user)
+        database.session.flush()
+
+        dataset.emails.append(user.email)
+        dataset.pieces[user.id] = [piece.id for piece in pieces]
+        dataset.tags[user.id] = [tag.id for tag in tags]
+        dataset.files.extend(piece.file_id for piece in pieces if piece.file_id is not None)
+        database.session.commit()
+    return dataset
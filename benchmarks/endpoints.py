@@ -0,0 +1,202 @@
+import argparse
+import io
+import itertools
+import platform
+import random
+import sqlite3
+import sys
+import time
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple
+
+from flask.testing import FlaskClient
+from flask_jwt_extended import create_access_token
+from werkzeug.test import TestResponse
+
+from benchmarks.data import DataShape, Dataset, file_size, generate
+from benchmarks.measure import (QueryCounter, compare_results, load_results, save_results,
+                                summarize)
+from web.api.identity import identity_claims
+from web.base import app, database, hasher
+from web.database_config import reader_engine
+from web.models import User
+
+
+class _Context(NamedTuple):
+    client: FlaskClient
+    rng: random.Random
+    shape: DataShape
+    dataset: Dataset
+    user_ids: List[int]
+    headers: Dict[int, Dict[str, str]]
+    # Numbers the requests, so every added or renamed row gets a unique name
+    sequence: Iterator[int]
+
+
+def _pick_user(context: _Context) -> int:
+    return context.rng.choice(context.user_ids)
+
+
+def _tag_ids(context: _Context, user_id: int) -> List[str]:
+    tags = context.dataset.tags[user_id]
+    return [hasher.encode(tag_id)
+            for tag_id in context.rng.sample(tags, min(context.shape.tags_per_piece, len(tags)))]
+
+
+def _current_user(context: _Context) -> TestResponse:
+    user_id = _pick_user(context)
+    return context.client.get("/api/auth/current_user", headers=context.headers[user_id])
+
+
+def _pieces_add(context: _Context) -> TestResponse:
+    user_id = _pick_user(context)
+    return context.client.post("/api/pieces/add", headers=context.headers[user_id], json={
+        "name": f"added piece {next(context.sequence)}", "description": None,
+        "instrument": "Piano", "state": 0, "tag_ids": _tag_ids(context, user_id)})
+
+
+def _pieces_edit(context: _Context) -> TestResponse:
+    user_id = _pick_user(context)
+    piece_id = context.rng.choice(context.dataset.pieces[user_id])
+    return context.client.post("/api/pieces/edit", headers=context.headers[user_id], json={
+        "id": hasher.encode(piece_id), "name": f"edited piece {next(context.sequence)}",
+        "description": "Edited", "instrument": None, "state": context.rng.randrange(3),
+        "tag_ids": _tag_ids(context, user_id)})
+
+
+def _tags_edit(context: _Context) -> TestResponse:
+    user_id = _pick_user(context)
+    tag_id = context.rng.choice(context.dataset.tags[user_id])
+    return context.client.post("/api/tags/edit", headers=context.headers[user_id], json={
+        "id": hasher.encode(tag_id), "tag": f"edited tag {next(context.sequence)}",
+        "color": "blue"})
+
+
+def _file_upload(context: _Context) -> TestResponse:
+    user_id = _pick_user(context)
+    piece_id = context.rng.choice(context.dataset.pieces[user_id])
+    content = context.rng.randbytes(file_size(context.rng, context.shape))
+    return context.client.post("/api/files/upload_file", headers=context.headers[user_id], data={
+        "id": hasher.encode(piece_id),
+        "file": (io.BytesIO(content), "sheet.pdf", "application/pdf"),
+    })
+
+
+def _file_download(context: _Context) -> TestResponse:
+    file_id = context.rng.choice(context.dataset.files)
+    return context.client.get(f"/api/files/file/{hasher.encode(file_id)}")
+
+
+# In the order they run. Uploads replace the files of the seeded pieces, so they run after the
+# downloads
+BENCHMARKS: Dict[str, Callable[[_Context], TestResponse]] = {
+    "current_user": _current_user,
+    "file_download": _file_download,
+    "pieces_add": _pieces_add,
+    "pieces_edit": _pieces_edit,
+    "tags_edit": _tags_edit,
+    "file_upload": _file_upload,
+}
+
+
+def _measure(context: _Context, name: str, iterations: int, warmup: int) -> Dict[str, float]:
+    benchmark = BENCHMARKS[name]
+    with app.app_context():
+        counter = QueryCounter([database.engine, reader_engine(app, database.engine)])
+    latencies: List[float] = []
+    queries: List[int] = []
+    with counter.listening():
+        for iteration in range(warmup + iterations):
+            with app.app_context():
+                before = counter.count
+                start = time.perf_counter()
+                response = benchmark(context)
+                elapsed = time.perf_counter() - start
+            assert response.status_code == 200, (name, response.status_code, response.data)
+            if iteration >= warmup:
+                latencies.append(elapsed)
+                queries.append(counter.count - before)
+    return summarize(latencies, queries)
+
+
+def _prepare(seed: int, shape: DataShape) -> _Context:
+    with app.app_context():
+        database.drop_all()
+        database.create_all()
+        dataset = generate(seed, shape)
+        users = User.query.filter(User.email.in_(dataset.emails)).all()
+        headers = {user.id: {"Authorization": "Bearer " + create_access_token(
+            identity=user.email, additional_claims=identity_claims(user))} for user in users}
+    return _Context(app.test_client(), random.Random(seed), shape, dataset,
+                    sorted(dataset.pieces), headers, itertools.count())
+
+
+def _print_results(results: Dict[str, Any]):
+    print(f"{'benchmark':>14} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} "
+          f"{'mean (ms)':>10} {'queries':>8}")
+    for name, summary in results["benchmarks"].items():
+        print(f"{name:>14} {summary['p50_ms']:>9.2f} {summary['p95_ms']:>9.2f} "
+              f"{summary['p99_ms']:>9.2f} {summary['mean_ms']:>10.2f} "
+              f"{summary['queries_mean']:>8.1f}")
+
+
+def main():
+    defaults = DataShape()
+    parser = argparse.ArgumentParser(
+        description="Measures the latency and SQL queries of the API endpoints on seeded data")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--users", type=int, default=defaults.users)
+    parser.add_argument("--pieces", type=int, default=defaults.pieces_per_user,
+                        help="pieces per user")
+    parser.add_argument("--tags", type=int, default=defaults.tags_per_user, help="tags per user")
+    parser.add_argument("--tags-per-piece", type=int, default=defaults.tags_per_piece)
+    parser.add_argument("--files", type=float, default=defaults.files,
+                        help="share of the pieces with a file")
+    parser.add_argument("--file-size-median", type=int, default=defaults.file_size_median)
+    parser.add_argument("--file-size-sigma", type=float, default=defaults.file_size_sigma)
+    parser.add_argument("--max-file-size", type=int, default=defaults.max_file_size)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--benchmark", action="append", choices=sorted(BENCHMARKS),
+                        help="benchmarks to run, all by default")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed latency increase over the baseline")
+    args = parser.parse_args()
+
+    shape = DataShape(args.users, args.pieces, args.tags, args.tags_per_piece, args.files,
+                      args.file_size_median, args.file_size_sigma, args.max_file_size)
+    context = _prepare(args.seed, shape)
+    names = [name for name in BENCHMARKS if name in (args.benchmark or BENCHMARKS)
+             and (name != "file_download" or context.dataset.files)]
+
+    results: Dict[str, Any] = {
+        "config": {
+            "seed": args.seed,
+            "shape": shape._asdict(),
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+        },
+        "benchmarks": {name: _measure(context, name, args.iterations, args.warmup)
+                       for name in names},
+    }
+    _print_results(results)
+    if args.output:
+        save_results(args.output, results)
+
+    if args.baseline:
+        baseline = load_results(args.baseline)
+        if baseline["config"] != results["config"]:
+            print("The baseline was recorded with a different configuration")
+        regressions = compare_results(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
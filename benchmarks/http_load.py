@@ -0,0 +1,66 @@
+import argparse
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import List
+
+from benchmarks.measure import percentile
+
+
+class _Results:
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.lock = threading.Lock()
+
+
+def _worker(url: str, headers: dict, deadline: float, results: _Results):
+    while time.perf_counter() < deadline:
+        request = urllib.request.Request(url, headers=headers)
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+        except (urllib.error.URLError, ConnectionError):
+            with results.lock:
+                results.errors += 1
+            continue
+        with results.lock:
+            results.latencies.append(time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures requests/sec of a running Sonata server")
+    parser.add_argument("url")
+    parser.add_argument("--token", help="access token sent as a Bearer token")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+
+    headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+    results = _Results()
+    deadline = time.perf_counter() + args.duration
+    threads = [threading.Thread(target=_worker, args=(args.url, headers, deadline, results))
+               for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies = results.latencies
+    if not latencies:
+        print(f"No successful requests ({results.errors} errors)")
+        return
+    print(f"requests:   {len(latencies)} ({results.errors} errors)")
+    print(f"throughput: {len(latencies) / args.duration:.1f} req/s")
+    print(f"latency:    mean {statistics.mean(latencies) * 1000:.1f}ms, "
+          f"p50 {percentile(latencies, 50) * 1000:.1f}ms, "
+          f"p95 {percentile(latencies, 95) * 1000:.1f}ms, "
+          f"p99 {percentile(latencies, 99) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import time
+from typing import Callable, List
+
+from web.base import hasher
+from web.ids import clear_id_cache, decode_ids, encode_ids
+
+_IDS = list(range(1, 20_001))
+
+
+def _measure(func: Callable[[], List], rounds: int = 5) -> float:
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def main():
+    hashed_ids = [hasher.encode(value) for value in _IDS]
+    print(f"{len(_IDS)} ids")
+    print(f"hashids encode:      {_measure(lambda: [hasher.encode(v) for v in _IDS]):8.2f}ms")
+    print(f"hashids decode:      {_measure(lambda: [hasher.decode(h) for h in hashed_ids]):8.2f}ms")
+
+    clear_id_cache()
+    print(f"codec encode (cold): {_measure(lambda: encode_ids(_IDS), rounds=1):8.2f}ms")
+    print(f"codec encode (warm): {_measure(lambda: encode_ids(_IDS)):8.2f}ms")
+    clear_id_cache()
+    print(f"codec decode (cold): {_measure(lambda: decode_ids(hashed_ids), rounds=1):8.2f}ms")
+    print(f"codec decode (warm): {_measure(lambda: decode_ids(hashed_ids)):8.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
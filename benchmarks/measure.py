@@ -0,0 +1,74 @@
+import contextlib
+import json
+import statistics
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import sqlalchemy
+from sqlalchemy import Engine
+
+
+def percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+# Counts the statements sent to the engines
+class QueryCounter:
+    def __init__(self, engines: Iterable[Optional[Engine]]) -> None:
+        self.engines = [engine for engine in engines if engine is not None]
+        self.count = 0
+
+    def _count(self, *_):
+        self.count += 1
+
+    @contextlib.contextmanager
+    def listening(self) -> Iterator["QueryCounter"]:
+        for engine in self.engines:
+            sqlalchemy.event.listen(engine, "before_cursor_execute", self._count)
+        try:
+            yield self
+        finally:
+            for engine in self.engines:
+                sqlalchemy.event.remove(engine, "before_cursor_execute", self._count)
+
+
+def summarize(latencies: List[float], queries: List[int]) -> Dict[str, float]:
+    return {
+        "requests": len(latencies),
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies) * 1000,
+        "queries_mean": statistics.mean(queries),
+        "queries_max": max(queries),
+    }
+
+
+def save_results(path: str, results: Dict[str, Any]):
+    with open(path, "w", encoding="utf-8") as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+
+
+def load_results(path: str) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as results:
+        return json.load(results)
+
+
+# Latencies are noisy, so they only regress past the threshold. Query counts of a seeded run are
+# deterministic, so any increase is reported
+def compare_results(results: Dict[str, Any], baseline: Dict[str, Any],
+                    threshold: float) -> List[str]:
+    regressions = []
+    for name, current in results["benchmarks"].items():
+        previous: Optional[Dict[str, float]] = baseline["benchmarks"].get(name)
+        if previous is None:
+            continue
+        for metric in ("p50_ms", "p95_ms"):
+            if current[metric] > previous[metric] * (1 + threshold):
+                regressions.append(f"{name}: {metric} {previous[metric]:.2f} -> "
+                                   f"{current[metric]:.2f} (+{threshold:.0%} allowed)")
+        if current["queries_mean"] > previous["queries_mean"]:
+            regressions.append(f"{name}: queries per request {previous['queries_mean']:.2f} -> "
+                               f"{current['queries_mean']:.2f}")
+    return regressions
@@ -0,0 +1,122 @@
+import argparse
+import logging
+import multiprocessing
+import statistics
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple
+
+from flask_jwt_extended import create_access_token
+
+from benchmarks.data import reset_with_user
+from benchmarks.measure import percentile
+from web.base import app
+from web.api.identity import identity_claims
+from web.models import Piece
+
+
+def _reader(headers: dict, deadline: float, latencies: List[float], lock: threading.Lock):
+    client = app.test_client()
+    while time.time() < deadline:
+        with app.app_context():
+            start = time.perf_counter()
+            response = client.get("/api/pieces?limit=50", headers=headers)
+            elapsed = time.perf_counter() - start
+        assert response.status_code == 200, response.data
+        with lock:
+            latencies.append(elapsed)
+
+
+# Shared with the writer processes
+class _WriteCounters(NamedTuple):
+    writes: Any
+    failures: Any
+
+
+# Writers run in their own processes, so they compete with the readers for the database and
+# not for the GIL, as they would with separate server workers
+def _writer(index: int, headers: dict, batch: int, deadline: float, counters: _WriteCounters):
+    writes, failures = counters
+    logging.disable(logging.ERROR)
+    client = app.test_client()
+    round_number = 0
+    while time.time() < deadline:
+        operations: List[Dict[str, Any]] = [
+            {"op": "add", "name": f"writer {index} round {round_number} piece {i}",
+             "description": None, "instrument": None, "state": 0, "tag_ids": []}
+            for i in range(batch)]
+        round_number += 1
+        with app.app_context():
+            response = client.post("/api/pieces/bulk", json={"operations": operations},
+                                   headers=headers)
+            if response.status_code != 200:
+                with failures.get_lock():
+                    failures.value += 1
+                continue
+            assert response.json is not None
+            added = [result["piece"]["id"] for result in response.json["results"]]
+            response = client.post("/api/pieces/bulk", headers=headers, json={
+                "operations": [{"op": "delete", "id": piece_id} for piece_id in added]})
+        with writes.get_lock():
+            writes.value += batch
+        if response.status_code == 200:
+            with writes.get_lock():
+                writes.value += batch
+        else:
+            with failures.get_lock():
+                failures.value += 1
+
+
+def _run(headers: dict, readers: int, writers: int, batch: int, duration: float):
+    context = multiprocessing.get_context("spawn")
+    latencies: List[float] = []
+    counters = _WriteCounters(context.Value("i", 0), context.Value("i", 0))
+    lock = threading.Lock()
+    deadline = time.time() + duration
+    processes = [context.Process(target=_writer,
+                                 args=(i, headers, batch, deadline, counters))
+                 for i in range(writers)]
+    threads = [threading.Thread(target=_reader, args=(headers, deadline, latencies, lock))
+               for _ in range(readers)]
+    for process in processes:
+        process.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for process in processes:
+        process.join()
+    return latencies, counters.writes.value, counters.failures.value
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures read latency with and without concurrent bulk writes")
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--batch", type=int, default=50, help="pieces per bulk request")
+    parser.add_argument("--pieces", type=int, default=500, help="pieces seeded for the user")
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+
+    with app.app_context():
+        user = reset_with_user(pieces=[Piece(name=f"piece {i}", description=None, instrument=None,
+                                             state=0) for i in range(args.pieces)])
+        token = create_access_token(identity=user.email,
+                                    additional_claims=identity_claims(user))
+    headers = {"Authorization": f"Bearer {token}"}
+
+    print(f"read split: {'on' if app.config['DATABASE_READ_SPLIT'] else 'off'}")
+    for name, writers in (("reads only", 0), ("reads + bulk writes", args.writers)):
+        latencies, written, failed = _run(
+            headers, args.readers, writers, args.batch, args.duration)
+        print(f"{name:>20}: {len(latencies) / args.duration:7.1f} reads/s, "
+              f"p50 {percentile(latencies, 50) * 1000:6.1f}ms, "
+              f"p95 {percentile(latencies, 95) * 1000:6.1f}ms, "
+              f"p99 {percentile(latencies, 99) * 1000:6.1f}ms, "
+              f"mean {statistics.mean(latencies) * 1000:6.1f}ms, "
+              f"{written / args.duration:.0f} rows written/s, {failed} failed writes")
+
+
+if __name__ == "__main__":
+    main()
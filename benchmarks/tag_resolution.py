@@ -0,0 +1,51 @@
+import statistics
+import time
+from typing import Callable, List
+
+from benchmarks.data import reset_with_user
+from web.api.tags import get_tag_by_id, resolve_tags
+from web.base import app, database, hasher
+from web.models import Tag, User
+
+_TAG_COUNTS = [1, 10, 100]
+_ROUNDS = 200
+
+
+def _resolve_tags_one_by_one(user: User, tag_id_hashes: List[str]) -> List[Tag]:
+    tags = []
+    for tag_id_hash in tag_id_hashes:
+        tag = get_tag_by_id(hasher.decode(tag_id_hash)[0])
+        if tag.user_id != user.id:
+            raise ValueError(tag_id_hash)
+        tags.append(tag)
+    return tags
+
+
+def _measure(func: Callable[[User, List[str]], List[Tag]], user: User,
+             tag_id_hashes: List[str]) -> float:
+    timings = []
+    for _ in range(_ROUNDS):
+        database.session.expire_all()
+        start = time.perf_counter()
+        func(user, tag_id_hashes)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    with app.app_context():
+        user = reset_with_user(tags=[Tag(tag=f"tag {i}", color="red")  # type: ignore
+                                     for i in range(max(_TAG_COUNTS))])
+        tag_id_hashes = [hasher.encode(tag.id)
+                         for tag in user.tags]  # type: ignore
+
+        print(f"{'tags':>6} {'one by one (ms)':>16} {'set based (ms)':>15}")
+        for count in _TAG_COUNTS:
+            one_by_one = _measure(_resolve_tags_one_by_one,
+                                  user, tag_id_hashes[:count])
+            set_based = _measure(resolve_tags, user, tag_id_hashes[:count])
+            print(f"{count:>6} {one_by_one:>16.3f} {set_based:>15.3f}")
+
+
+if __name__ == "__main__":
+    main()
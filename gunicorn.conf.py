@@ -0,0 +1,73 @@
+# Gunicorn reads its settings from these lowercase module variables
+# pylint: disable=invalid-name
+import multiprocessing
+import os
+import pathlib
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY",
+                             multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("WEB_THREADS", 4))
+worker_class = "gthread"
+
+# The app is imported once in the master and shared copy-on-write by the workers
+preload_app = True
+
+# On SIGTERM workers stop accepting connections and finish in-flight requests
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+timeout = int(os.environ.get("WORKER_TIMEOUT", 60))
+keepalive = 5
+
+accesslog = os.environ.get("ACCESS_LOG", "-") or None
+
+# The workers share their metrics through files there, so a scrape of any of them sees all of them
+os.environ.setdefault("METRICS_DIR",
+                      str(pathlib.Path(__file__).parent / "storage" / "tmp" / "metrics"))
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    # pylint: disable=import-outside-toplevel
+    from web.instrumentation import metrics_exporter
+
+    metrics_exporter.clear()
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    # pylint: disable=import-outside-toplevel
+    from web.base import app, database
+    from web.api.metrics import collect_metrics
+    from web.database_config import dispose_reader_engine
+    from web.instrumentation import metrics_exporter
+    from web.maintenance import maintenance_worker
+
+    # Connections must not be shared with the master or sibling workers
+    with app.app_context():
+        database.engine.dispose(close=False)
+    dispose_reader_engine(app, close=False)
+
+    # Every worker schedules the maintenance, the lock file lets one of them run it at a time
+    if app.config["MAINTENANCE_INTERVAL_S"] > 0:
+        maintenance_worker.start(app.config["MAINTENANCE_INTERVAL_S"])
+    metrics_exporter.start(app.config["METRICS_FLUSH_INTERVAL_S"], collect_metrics)
+
+
+def worker_exit(server, worker):  # pylint: disable=unused-argument
+    # pylint: disable=import-outside-toplevel
+    from web.instrumentation import metrics_exporter
+    from web.maintenance import maintenance_worker
+    from web.passwords import hashing_pool
+    from web.writes import write_coordinator
+
+    maintenance_worker.stop()
+    metrics_exporter.stop()
+    hashing_pool.shutdown()
+    if write_coordinator is not None:
+        write_coordinator.stop()
+
+
+# Runs in the master, also for workers killed before their worker_exit hook could run
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    # pylint: disable=import-outside-toplevel
+    from web.instrumentation import metrics_exporter
+
+    metrics_exporter.remove(worker.pid)
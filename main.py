@@ -1,11 +1,10 @@
-from web.base import app, database
+import os
 
+from web.base import app
 
-def main():
-    with app.app_context():
-        database.create_all()
 
-    app.run(host="0.0.0.0", debug=True)
+def main():
+    app.run(host="0.0.0.0", debug=os.environ.get("FLASK_DEBUG") == "1")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,49 @@
+from flask_jwt_extended import create_access_token
+import pytest
+
+from tests.conftest import add_user
+from web.base import database
+from web.models import Piece, Tag
+
+
+@pytest.fixture
+def user(test_client):  # pylint: disable=unused-argument
+    return add_user(password_hash='b305cadbb3bce54f3aa59c64fec00dea',
+                    tags=[Tag(tag="test", color="red")])
+
+
+@pytest.fixture
+def tags(user):
+    t1 = Tag(user_id=user.id, tag="sample tag", color="blue")  # type: ignore
+    t2 = Tag(user_id=user.id, tag="sample tag2", color="red")  # type: ignore
+    database.session.add(t1)
+    database.session.add(t2)
+    database.session.commit()
+    return t1, t2
+
+
+@pytest.fixture
+def piece(user, tags):
+    p = Piece(name="test", description="test", instrument="Piano",
+              state=1, tags=list(tags), user_id=user.id)  # type: ignore
+    database.session.add(p)
+    database.session.commit()
+    return p
+
+
+@pytest.fixture
+def other_user(test_client):  # pylint: disable=unused-argument
+    return add_user(email="other@example.com", name="otheruser", password_hash="hashed_password")
+
+
+@pytest.fixture
+def other_tag(other_user):
+    t = Tag(user_id=other_user.id, tag="other tag", color="green")  # type: ignore
+    database.session.add(t)
+    database.session.commit()
+    return t
+
+
+@pytest.fixture
+def other_headers(other_user):
+    return {'Authorization': f'Bearer {create_access_token(identity=other_user.email)}'}
@@ -1,45 +1,27 @@
 from flask_jwt_extended import create_access_token
 import pytest
+import sqlalchemy
 
+from tests.conftest import add_user, app_database
+from web.api.identity import _user_cache
 from web.base import app, database
-from web.models.tags import Tag
+from web.models.piece import Piece
+from web.models.tags import Tag, pieces_tags
 from web.models.user import User
 
 
 @pytest.fixture(scope='module')
 def test_client():
-    app.config['TESTING'] = True
-    client = app.test_client()
-
-    ctx = app.app_context()
-    ctx.push()
-
-    database.create_all()
-
-    yield client
-
-    database.session.remove()
-    database.drop_all()
-    ctx.pop()
+    with app_database():
+        app.config['TESTING'] = True
+        yield app.test_client()
 
 
 @pytest.fixture(scope='module')
-def init_database():
-    # Create a test user
-    user = User(
-        email='user@example.com',
-        name="name",
-        password_hash='b305cadbb3bce54f3aa59c64fec00dea',
-        salt='salt',
-        tags=[Tag(tag="test", color="red")]  # type: ignore
-    )  # type: ignore
-    database.session.add(user)
-    database.session.commit()
-
-    yield database
-
-    database.session.remove()
-    database.drop_all()
+def init_database(test_client):  # pylint: disable=unused-argument
+    add_user(password_hash='b305cadbb3bce54f3aa59c64fec00dea',
+             tags=[Tag(tag="test", color="red")])
+    return database
 
 
 def test_auth_login_success(test_client, init_database):
@@ -133,3 +115,126 @@ def test_auth_current_user_success(test_client, init_database):
     assert data['name'] == 'name'
     assert len(data["tags"]) == 1
     assert len(data["pieces"]) == 0
+
+
+def _seed_user_with_pieces(email: str, pieces_count: int) -> User:
+    user = User(email=email, name=email, password_hash="hash", salt="salt",
+                tags=[Tag(tag="first", color="red"),
+                      Tag(tag="second", color="blue")])  # type: ignore
+    database.session.add(user)
+    database.session.commit()
+
+    database.session.execute(sqlalchemy.insert(Piece), [
+        {"name": f"piece {i}", "state": 1, "user_id": user.id}
+        for i in range(pieces_count)
+    ])
+    piece_ids = [piece_id for piece_id, in database.session.execute(
+        sqlalchemy.select(Piece.id).filter_by(user_id=user.id))]
+    database.session.execute(sqlalchemy.insert(pieces_tags), [
+        {"piece_id": piece_id, "tag_id": tag.id}
+        for piece_id in piece_ids for tag in user.tags  # type: ignore
+    ])
+    database.session.commit()
+    database.session.expunge_all()
+    return user
+
+
+def _count_current_user_queries(test_client, email: str):
+    statements = []
+
+    def count(_conn, _cursor, statement, *_):
+        if statement.startswith("SELECT"):
+            statements.append(statement)
+
+    headers = {'Authorization': f'Bearer {create_access_token(identity=email)}'}
+    # Listening on the class also counts the queries sent to the reader engine
+    sqlalchemy.event.listen(sqlalchemy.Engine, "before_cursor_execute", count)
+    try:
+        response = test_client.get('/api/auth/current_user', headers=headers)
+    finally:
+        sqlalchemy.event.remove(
+            sqlalchemy.Engine, "before_cursor_execute", count)
+    database.session.expunge_all()
+    return response, len(statements)
+
+
+def test_auth_current_user_query_count_is_constant(test_client, init_database):
+    _seed_user_with_pieces("few@example.com", 1)
+    _seed_user_with_pieces("many@example.com", 2000)
+
+    few_response, few_queries = _count_current_user_queries(
+        test_client, "few@example.com")
+    many_response, many_queries = _count_current_user_queries(
+        test_client, "many@example.com")
+
+    assert len(few_response.get_json()["pieces"]) == 1
+    assert len(many_response.get_json()["pieces"]) == 2000
+    assert all(len(piece["tags"]) == 2
+               for piece in many_response.get_json()["pieces"])
+    assert many_queries == few_queries
+    assert many_queries <= 5
+
+
+def _count_user_queries(test_client, headers):
+    statements = []
+
+    def count(_conn, _cursor, statement, *_):
+        if statement.startswith("SELECT") and "FROM users" in statement:
+            statements.append(statement)
+
+    # Listening on the class also counts the queries sent to the reader engine
+    sqlalchemy.event.listen(sqlalchemy.Engine, "before_cursor_execute", count)
+    try:
+        response = test_client.get('/api/auth/current_user', headers=headers)
+    finally:
+        sqlalchemy.event.remove(
+            sqlalchemy.Engine, "before_cursor_execute", count)
+    return response, len(statements)
+
+
+def test_current_user_resolution_is_cached(test_client, init_database):
+    response = test_client.post('/api/auth/login', json={
+        'email': 'user@example.com',
+        'password': 'password'
+    })
+    headers = {'Authorization': f'Bearer {response.get_json()["access_token"]}'}
+    database.session.expunge_all()
+    _user_cache.clear()
+
+    # The first request resolves the user by its id claim, the second one from the cache
+    _, first_queries = _count_user_queries(test_client, headers)
+    database.session.expunge_all()
+    response, cached_queries = _count_user_queries(test_client, headers)
+    assert response.status_code == 200
+    assert cached_queries == first_queries - 1
+    cached_state = _user_cache.get('user@example.com')
+    assert cached_state is not None
+    assert "password_hash" not in cached_state and "salt" not in cached_state
+
+    user = User.query.filter_by(email='user@example.com').one()
+    user.name = "renamed"
+    database.session.commit()
+    database.session.expunge_all()
+
+    response = test_client.get('/api/auth/current_user', headers=headers)
+    assert response.get_json()["name"] == "renamed"
+    user = User.query.filter_by(email='user@example.com').one()
+    user.name = "name"
+    database.session.commit()
+
+
+def test_auth_login_rehashes_legacy_password(test_client, init_database):
+    user = User(email='legacy@example.com', name="legacy",
+                password_hash='b305cadbb3bce54f3aa59c64fec00dea', salt='salt')  # type: ignore
+    database.session.add(user)
+    database.session.commit()
+
+    for _ in range(2):
+        response = test_client.post('/api/auth/login', json={
+            'email': 'legacy@example.com',
+            'password': 'password'
+        })
+        assert response.status_code == 200
+        database.session.expire_all()
+        assert User.query.filter_by(
+            email='legacy@example.com').one().password_hash.startswith("scrypt$")
@@ -1,66 +1,18 @@
+import hashlib
 import io
 from flask_jwt_extended import create_access_token
 import pytest
-from web.base import app, database, hasher
-from web.models import Piece, User, Tag
+from web.api.files import _upload_digests
+from web.base import app, database, file_cache, hasher, storage
+from web.maintenance import MaintenanceWorker
+from web.models import File, Piece
 
 
 @pytest.fixture()
-def test_client():
-    app.config['TESTING'] = True
-    client = app.test_client()
-
-    ctx = app.app_context()
-    ctx.push()
-
-    database.create_all()
-
-    yield client
-
-    database.session.remove()
-    database.drop_all()
-    ctx.pop()
-
-
-@pytest.fixture
-def user():
-    u = User(
-        email='user@example.com',
-        name="name",
-        password_hash='b305cadbb3bce54f3aa59c64fec00dea',
-        salt='salt',
-        tags=[Tag(tag="test", color="red")]  # type: ignore
-    )  # type: ignore
-    database.session.add(u)
-    database.session.commit()
-    return u
-
-
-@pytest.fixture
-def headers(user):
-    access_token = create_access_token(identity=user.email)
-    return {
-        'Authorization': f'Bearer {access_token}'
-    }
-
-
-@pytest.fixture
-def tags(user):
-    t1 = Tag(user_id=user.id, tag="sample tag", color="blue")  # type: ignore
-    t2 = Tag(user_id=user.id, tag="sample tag2", color="red")  # type: ignore
-    database.session.add(t1)
-    database.session.add(t2)
-    database.session.commit()
-    return t1, t2
-
-
-@pytest.fixture
-def piece(user, tags):
-    p = Piece(name="test", description="test", instrument="Piano",
-              state=1, tags=list(tags), user_id=user.id)  # type: ignore
-    database.session.add(p)
-    database.session.commit()
-    return p
+def test_client(test_client, tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "root", tmp_path)
+    file_cache.clear()
+    return test_client
 
 
 def test_upload_link_file_success(test_client, piece, headers):
@@ -83,24 +35,26 @@ def test_upload_link_file_not_found(test_client, headers):
     assert response.get_data(as_text=True) == "Piece with ID 999 not found"
 
 
-def test_upload_link_file_unauthorized(test_client, piece):
-    other_user = User(email="other@example.com", name="otheruser",
-                      password_hash="hashed_password", salt="salt")  # type: ignore
-    database.session.add(other_user)
-    database.session.commit()
-
-    access_token = create_access_token(identity=other_user.email)
+def test_upload_link_file_unauthorized(test_client, piece, other_headers):
     response = test_client.post('/api/files/upload_link', json={
         "id": hasher.encode(piece.id),
         "link": "http://example.com",
-    }, headers={
-        'Authorization': f'Bearer {access_token}'
-    })
+    }, headers=other_headers)
     assert response.status_code == 404
     assert response.get_data(as_text=True) == f"Piece with ID {
         piece.id} not found for this user"
 
 
+def test_upload_link_unknown_user(test_client, piece):
+    headers = {'Authorization': f'Bearer {create_access_token(identity="gone@example.com")}'}
+    response = test_client.post('/api/files/upload_link', json={
+        "id": hasher.encode(piece.id),
+        "link": "http://example.com",
+    }, headers=headers)
+    assert response.status_code == 401
+    assert database.session.get(Piece, piece.id).file_type is None  # type: ignore
+
+
 def test_files_upload_file_success(test_client, headers, piece):
     data = {
         "id": hasher.encode(piece.id)
@@ -120,6 +74,62 @@ def test_files_upload_file_success(test_client, headers, piece):
         Piece, piece.id).file_id is not None  # type: ignore
 
 
+def test_files_upload_file_stored_on_disk(test_client, headers, piece):
+    content = b"some initial text data"
+    response = test_client.post(
+        '/api/files/upload_file',
+        headers=headers,
+        data={"id": hasher.encode(piece.id),
+              'file': (io.BytesIO(content), "test.txt")},
+    )
+    assert response.status_code == 200
+    file = database.session.get(File, database.session.get(
+        Piece, piece.id).file_id)  # type: ignore
+    assert file.size == len(content)
+    assert file.content == b""
+    assert storage.local_path(file.path).read_bytes() == content
+
+    response = test_client.get(f"/api/files/file/{hasher.encode(file.id)}")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert response.get_data() == content
+
+
+def test_get_file_served_from_cache(test_client):
+    file = File(content=b"cached content", file_type="text/plain")  # type: ignore
+    database.session.add(file)
+    database.session.commit()
+    hits = file_cache.stats()["hits"]
+
+    for _ in range(2):
+        response = test_client.get(f"/api/files/file/{hasher.encode(file.id)}")
+        assert response.status_code == 200
+        assert response.get_data() == b"cached content"
+    assert file_cache.stats()["hits"] == hits + 1
+
+
+def test_get_file_invalid_id(test_client):
+    response = test_client.get("/api/files/file/invalid")
+    assert response.status_code == 404
+    assert response.get_data(as_text=True) == "File with ID invalid not found"
+
+
+def test_migrate_files_moves_content_to_storage(test_client):
+    legacy = File(content=b"legacy content", file_type="text/plain")  # type: ignore
+    database.session.add(legacy)
+    database.session.flush()
+    legacy_id = legacy.id
+    database.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["migrate-files", "--batch-size", "1"])
+    assert result.exit_code == 0
+
+    file = database.session.get(File, legacy_id)
+    assert file.content == b""
+    assert file.size == len(b"legacy content")
+    assert storage.local_path(file.path).read_bytes() == b"legacy content"
+
+
 def test_files_upload_file_missing_file(test_client, headers, piece):
     data = {
         "id": hasher.encode(piece.id)
@@ -150,13 +160,7 @@ def test_files_upload_file_too_large(test_client, headers, piece):
         as_text=True) == f"File too large! ({file_size / 1024 / 1024}MB > 30MB)"
 
 
-def test_files_upload_file_file_unauthorized(test_client, piece):
-    other_user = User(email="other@example.com", name="otheruser",
-                      password_hash="hashed_password", salt="salt")  # type: ignore
-    database.session.add(other_user)
-    database.session.commit()
-
-    access_token = create_access_token(identity=other_user.email)
+def test_files_upload_file_file_unauthorized(test_client, piece, other_headers):
     data = {
         "id": hasher.encode(piece.id)
     }
@@ -165,9 +169,186 @@ def test_files_upload_file_file_unauthorized(test_client, piece):
     }
     response = test_client.post(
         '/api/files/upload_file',
-        headers={'Authorization': f'Bearer {access_token}'},
+        headers=other_headers,
         data={**data, **file_data},
     )
     assert response.status_code == 404
     assert response.get_data(as_text=True) == f"Piece with ID {
         piece.id} not found for this user"
+
+
+def _start_upload(test_client, headers, piece, **kwargs):
+    response = test_client.post('/api/files/uploads', json={
+        "id": hasher.encode(piece.id),
+        "file_type": "application/pdf",
+        **kwargs
+    }, headers=headers)
+    assert response.status_code == 200
+    return response.json["id"]
+
+
+def test_chunked_upload_success(test_client, headers, piece):
+    upload_id = _start_upload(test_client, headers, piece)
+    for index, chunk in enumerate([b"first chunk ", b"second chunk"]):
+        response = test_client.put(
+            f'/api/files/uploads/{upload_id}/{index}', data=chunk, headers=headers)
+        assert response.status_code == 200
+        assert response.json["next_chunk"] == index + 1
+
+    response = test_client.post(
+        f'/api/files/uploads/{upload_id}/finalize', headers=headers)
+    assert response.status_code == 200
+    assert response.json["file_type"] == "application/pdf"
+
+    file = database.session.get(File, database.session.get(
+        Piece, piece.id).file_id)  # type: ignore
+    assert storage.local_path(
+        file.path).read_bytes() == b"first chunk second chunk"
+    assert file.sha256 == hashlib.sha256(
+        b"first chunk second chunk").hexdigest()
+
+
+def test_chunked_upload_resume(test_client, headers, piece):
+    upload_id = _start_upload(test_client, headers, piece)
+    test_client.put(f'/api/files/uploads/{upload_id}/0',
+                    data=b"first ", headers=headers)
+    # A retried chunk that was already acknowledged is not written twice
+    test_client.put(f'/api/files/uploads/{upload_id}/0',
+                    data=b"first ", headers=headers)
+    # Resuming on a worker that did not see the previous chunks
+    _upload_digests.clear()
+
+    response = test_client.get(
+        f'/api/files/uploads/{upload_id}', headers=headers)
+    assert response.json["received_size"] == len(b"first ")
+    assert response.json["next_chunk"] == 1
+
+    response = test_client.put(
+        f'/api/files/uploads/{upload_id}/2', data=b"third", headers=headers)
+    assert response.status_code == 400
+    assert response.get_data(as_text=True) == "Expected chunk 1, got chunk 2"
+
+    test_client.put(f'/api/files/uploads/{upload_id}/1',
+                    data=b"second", headers=headers)
+    response = test_client.post(
+        f'/api/files/uploads/{upload_id}/finalize', headers=headers)
+    assert response.status_code == 200
+    file = database.session.get(File, database.session.get(
+        Piece, piece.id).file_id)  # type: ignore
+    assert file.sha256 == hashlib.sha256(b"first second").hexdigest()
+
+
+def test_chunked_upload_too_large(test_client, headers, piece):
+    upload_id = _start_upload(test_client, headers, piece)
+    chunk = b"A" * (16 * 1024 * 1024)
+    response = test_client.put(
+        f'/api/files/uploads/{upload_id}/0', data=chunk, headers=headers)
+    assert response.status_code == 200
+
+    response = test_client.put(
+        f'/api/files/uploads/{upload_id}/1', data=chunk, headers=headers)
+    assert response.status_code == 400
+    assert response.get_data(as_text=True).startswith("File too large!")
+
+    response = test_client.get(
+        f'/api/files/uploads/{upload_id}', headers=headers)
+    assert response.status_code == 404
+
+
+def test_chunked_upload_finalize_for_deleted_piece(test_client, headers, piece):
+    upload_id = _start_upload(test_client, headers, piece)
+    test_client.put(f'/api/files/uploads/{upload_id}/0', data=b"chunk", headers=headers)
+    database.session.delete(database.session.get(Piece, piece.id))
+    database.session.commit()
+
+    response = test_client.post(f'/api/files/uploads/{upload_id}/finalize', headers=headers)
+    assert response.status_code == 404
+    # The upload is gone with its bytes, so a retry fails the same way
+    response = test_client.post(f'/api/files/uploads/{upload_id}/finalize', headers=headers)
+    assert response.status_code == 404
+    response = test_client.put(
+        f'/api/files/uploads/{upload_id}/1', data=b"chunk", headers=headers)
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize("size", ["abc", -1, 1.5, True, [1]])
+def test_chunked_upload_invalid_declared_size(test_client, headers, piece, size):
+    response = test_client.post('/api/files/uploads', json={
+        "id": hasher.encode(piece.id),
+        "file_type": "application/pdf",
+        "size": size
+    }, headers=headers)
+    assert response.status_code == 400
+    assert response.get_data(as_text=True) == "Invalid size"
+
+
+def test_chunked_upload_declared_size_too_large(test_client, headers, piece):
+    response = test_client.post('/api/files/uploads', json={
+        "id": hasher.encode(piece.id),
+        "file_type": "application/pdf",
+        "size": 30 * 1024 * 1024 + 1
+    }, headers=headers)
+    assert response.status_code == 400
+
+
+def _upload(test_client, headers, piece_id, content):
+    response = test_client.post('/api/files/upload_file', headers=headers, data={
+        "id": hasher.encode(piece_id), 'file': (io.BytesIO(content), "sheet.pdf")})
+    assert response.status_code == 200
+    return database.session.get(Piece, piece_id).file_id  # type: ignore
+
+
+def test_uploads_share_files_with_the_same_content(test_client, headers, piece, user):
+    other = Piece(name="other", description=None, instrument=None, state=0,
+                  user_id=user.id)  # type: ignore
+    database.session.add(other)
+    database.session.flush()
+    piece_id, other_id = piece.id, other.id
+    database.session.commit()
+
+    file_id = _upload(test_client, headers, piece_id, b"sheet music")
+    assert _upload(test_client, headers, other_id, b"sheet music") == file_id
+    file = database.session.get(File, file_id)
+    path = file.path
+    assert file.ref_count == 2
+    assert database.session.query(File).count() == 1
+
+    response = test_client.post('/api/pieces/delete', json={"id": hasher.encode(piece_id)},
+                                headers=headers)
+    assert response.status_code == 200
+    assert database.session.get(File, file_id, populate_existing=True).ref_count == 1
+    assert storage.exists(path)
+
+    # Replacing the last reference removes the row, and the maintenance its content
+    new_file_id = _upload(test_client, headers, other_id, b"new sheet music")
+    assert new_file_id != file_id
+    assert database.session.get(File, file_id, populate_existing=True) is None
+    assert storage.exists(path)
+    database.session.commit()
+    MaintenanceWorker(app, batch_size=10, grace=0, vacuum_pages=0, dry_run=False).run()
+    assert not storage.exists(path)
+    assert storage.exists(database.session.get(File, new_file_id).path)
+
+
+def test_recount_file_refs_merges_duplicates(test_client, piece, user):
+    blob = storage.save(io.BytesIO(b"duplicated"))
+    files = [File(file_type="application/pdf", size=blob.size, sha256=blob.sha256,
+                  path=blob.path) for _ in range(2)]  # type: ignore
+    database.session.add_all(files)
+    database.session.flush()
+    piece.file_id = files[1].id
+    user.profile_picture_id = files[0].id
+    database.session.flush()
+    file_id = files[0].id
+    database.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["recount-file-refs"])
+    assert result.exit_code == 0
+    assert "Merged 1 duplicate files" in result.output
+    database.session.expire_all()
+    assert [(file.id, file.ref_count) for file in File.query] == [(file_id, 2)]
+    assert database.session.get(Piece, piece.id).file_id == file_id  # type: ignore
+
+    result = app.test_cli_runner().invoke(args=["storage-report"])
+    assert result.exit_code == 0
+    assert f"saved_bytes: {blob.size}" in result.output
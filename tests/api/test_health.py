@@ -0,0 +1,55 @@
+import pytest
+import sqlalchemy
+from sqlalchemy import text
+
+from web.base import app, database, hasher
+from web.database_config import begin_write, read_only, reader_engine
+
+
+def test_health_reports_database_settings(test_client):
+    response = test_client.get('/api/health')
+    assert response.status_code == 200
+    settings = response.json["database"]["settings"]
+    assert settings["journal_mode"] == "wal"
+    assert settings["synchronous"] == 1
+    assert settings["busy_timeout"] == 5000
+    assert settings["temp_store"] == 2
+    assert response.json["database"]["pool"]["size"] == 1
+    assert response.json["database"]["reader_pool"]["size"] == app.config["WORKER_THREADS"]
+
+    # Answered while another connection holds the write lock
+    with begin_write(database.engine):
+        assert test_client.get('/api/health').status_code == 200
+
+
+def test_reader_engine_is_read_only(test_client):
+    reader = reader_engine(app, database.engine)
+    with reader.connect() as connection:
+        assert connection.execute(text("PRAGMA query_only")).scalar() == 1
+        with pytest.raises(sqlalchemy.exc.OperationalError):
+            connection.execute(text("DELETE FROM users"))
+
+
+def test_read_only_views_use_reader_engine(test_client):
+    reader = reader_engine(app, database.engine)
+    statements = []
+
+    def count(_conn, _cursor, statement, *_):
+        if statement.startswith("SELECT"):
+            statements.append(statement)
+
+    sqlalchemy.event.listen(reader, "before_cursor_execute", count)
+    try:
+        response = test_client.get(f'/api/files/file/{hasher.encode(1000)}')
+        assert response.status_code == 404
+        assert any("FROM files" in statement for statement in statements)
+        database.session.remove()
+        statements.clear()
+
+        with app.test_request_context():
+            read_only(lambda: database.session.execute(text("SELECT 1")))()
+            assert statements == ["SELECT 1"]
+            database.session.execute(text("SELECT 2"))
+            assert statements == ["SELECT 1"]
+    finally:
+        sqlalchemy.event.remove(reader, "before_cursor_execute", count)
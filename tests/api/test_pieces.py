@@ -1,66 +1,10 @@
-from flask_jwt_extended import create_access_token
-import pytest
+from datetime import datetime
+import sqlalchemy
+from web.api.tags import resolve_tags
 from web.base import app, database, hasher
-from web.models import User, Tag
+from web.models import User, Tag, pieces_tags
 from web.models.piece import Piece
-
-
-@pytest.fixture()
-def test_client():
-    app.config['TESTING'] = True
-    client = app.test_client()
-
-    ctx = app.app_context()
-    ctx.push()
-
-    database.create_all()
-
-    yield client
-
-    database.session.remove()
-    database.drop_all()
-    ctx.pop()
-
-
-@pytest.fixture
-def user():
-    u = User(
-        email='user@example.com',
-        name="name",
-        password_hash='b305cadbb3bce54f3aa59c64fec00dea',
-        salt='salt',
-        tags=[Tag(tag="test", color="red")]  # type: ignore
-    )  # type: ignore
-    database.session.add(u)
-    database.session.commit()
-    return u
-
-
-@pytest.fixture
-def headers(user):
-    access_token = create_access_token(identity=user.email)
-    return {
-        'Authorization': f'Bearer {access_token}'
-    }
-
-
-@pytest.fixture
-def tags(user):
-    t1 = Tag(user_id=user.id, tag="sample tag", color="blue")  # type: ignore
-    t2 = Tag(user_id=user.id, tag="sample tag2", color="red")  # type: ignore
-    database.session.add(t1)
-    database.session.add(t2)
-    database.session.commit()
-    return t1, t2
-
-
-@pytest.fixture
-def piece(user, tags):
-    p = Piece(name="test", description="test", instrument="Piano",
-              state=1, tags=list(tags), user_id=user.id)  # type: ignore
-    database.session.add(p)
-    database.session.commit()
-    return p
+from web.stats import rebuild_facet_counts
 
 
 def test_edit_piece_success(test_client, user, headers, tags, piece):
@@ -96,17 +40,7 @@ def test_edit_piece_not_found(test_client, user, headers, tags):
     assert response.get_data(as_text=True) == "Piece with ID 999 not found"
 
 
-def test_edit_piece_unauthorized(test_client, user, headers, tags, piece):
-    other_user = User(email="other@example.com", name="otheruser",
-                      password_hash="hashed_password", salt="salt")  # type: ignore
-    database.session.add(other_user)
-    database.session.commit()
-    other_tag = Tag(user_id=other_user.id, tag="other tag",
-                    color="green")  # type: ignore
-    database.session.add(other_tag)
-    database.session.commit()
-    access_token = create_access_token(identity=other_user.email)
-
+def test_edit_piece_unauthorized(test_client, piece, other_headers, other_tag):
     response = test_client.post('/api/pieces/edit', json={
         "id": hasher.encode(piece.id),
         "name": "new_name",
@@ -114,9 +48,7 @@ def test_edit_piece_unauthorized(test_client, user, headers, tags, piece):
         "instrument": None,
         "state": 2,
         "tag_ids": [hasher.encode(other_tag.id)]
-    }, headers={
-        'Authorization': f'Bearer {access_token}'
-    })
+    }, headers=other_headers)
     assert response.status_code == 404
     assert response.get_data(as_text=True) == f"Piece with ID {
         piece.id} not found for this user"
@@ -187,19 +119,326 @@ def test_delete_piece_not_found(test_client, headers):
     assert response.get_data(as_text=True) == "Piece with ID 999 not found"
 
 
-def test_delete_piece_unauthorized(test_client, piece):
-    other_user = User(email="other@example.com", name="otheruser",
-                      password_hash="hashed_password", salt="salt")  # type: ignore
-    database.session.add(other_user)
-    database.session.commit()
+def test_delete_piece_invalid_id(test_client, headers):
+    response = test_client.post('/api/pieces/delete', json={
+        'id': 'not an id'
+    }, headers=headers)
+    assert response.status_code == 404
+    assert response.get_data(as_text=True) == "Piece with ID not an id not found"
+
 
-    access_token = create_access_token(identity=other_user.email)
+def test_delete_piece_unauthorized(test_client, piece, other_headers):
     response = test_client.post('/api/pieces/delete', json={
         'id': hasher.encode(piece.id)
-    }, headers={
-        'Authorization': f'Bearer {access_token}'
-    })
+    }, headers=other_headers)
 
     assert response.status_code == 404
     assert response.get_data(as_text=True) == f"Piece with ID {
         piece.id} not found for this user"
+
+
+def _seed_pieces(user, count, **values):
+    added_at = datetime(2024, 1, 1)
+    database.session.execute(sqlalchemy.insert(Piece), [
+        {"name": f"piece {i:03}", "state": i % 3, "user_id": user.id,
+         "added_at": added_at, **values}
+        for i in range(count)
+    ])
+    database.session.commit()
+
+
+def _list_all_pieces(test_client, headers, **params):
+    names = []
+    cursor = None
+    while True:
+        response = test_client.get('/api/pieces', query_string={
+            **params, **({"cursor": cursor} if cursor else {})
+        }, headers=headers)
+        assert response.status_code == 200
+        names.extend(piece["name"] for piece in response.json["pieces"])
+        cursor = response.json["next_cursor"]
+        if cursor is None:
+            return names
+
+
+def test_list_pieces_pagination(test_client, user, headers):
+    _seed_pieces(user, 25)
+    names = _list_all_pieces(test_client, headers, limit=10)
+    assert len(names) == 25
+    assert len(set(names)) == 25
+
+    names = _list_all_pieces(test_client, headers, limit=7, sort="name")
+    assert names == sorted(names)
+    assert len(names) == 25
+
+
+def test_list_pieces_filters(test_client, user, headers, tags, piece):
+    _seed_pieces(user, 9, instrument="Violin")
+    assert len(_list_all_pieces(test_client, headers,
+               instrument="Violin", state=1)) == 3
+
+    names = _list_all_pieces(test_client, headers, tag_ids=",".join(
+        hasher.encode(tag.id) for tag in tags))
+    assert names == [piece.name]
+
+    response = test_client.get('/api/pieces', query_string={"tag_ids": "invalid"},
+                               headers=headers)
+    assert response.status_code == 404
+
+
+def test_list_pieces_invalid_cursor(test_client, user, headers):
+    response = test_client.get(
+        '/api/pieces', query_string={"cursor": "invalid"}, headers=headers)
+    assert response.status_code == 400
+    assert response.get_data(as_text=True) == "Invalid cursor"
+
+
+def test_list_pieces_uses_index(test_client, user):
+    plan = database.session.execute(sqlalchemy.text(
+        "EXPLAIN QUERY PLAN SELECT id FROM pieces WHERE user_id = 1 "
+        "AND (added_at, id) < ('2024-01-01', 5) ORDER BY added_at DESC, id DESC LIMIT 10"
+    )).all()
+    assert "ix_pieces_user_added_at" in str(plan)
+    assert "TEMP B-TREE" not in str(plan)
+
+
+def test_bulk_pieces(test_client, user, headers, tags, piece):
+    other = Piece(name="other", description=None, instrument="Piano",
+                  state=1, tags=[tags[0]], user_id=user.id)  # type: ignore
+    database.session.add(other)
+    database.session.commit()
+    tag_ids = [hasher.encode(tag.id) for tag in tags]
+
+    response = test_client.post('/api/pieces/bulk', json={"operations": [
+        {"op": "add", "name": "added", "description": None, "instrument": None,
+         "state": 0, "tag_ids": tag_ids},
+        {"op": "edit", "id": hasher.encode(piece.id), "name": "edited",
+         "description": None, "instrument": "Piano", "state": 2, "tag_ids": tag_ids[1:]},
+        {"op": "add", "name": "other", "description": None, "instrument": "Piano",
+         "state": 0, "tag_ids": []},
+        {"op": "edit", "id": hasher.encode(999), "name": "missing",
+         "description": None, "instrument": None, "state": 2, "tag_ids": []},
+        {"op": "add", "name": "bad tag", "description": None, "instrument": None,
+         "state": 0, "tag_ids": [hasher.encode(999)]},
+        {"op": "delete", "id": hasher.encode(other.id)},
+    ]}, headers=headers)
+    assert response.status_code == 200
+    results = response.json["results"]
+    assert [result["ok"] for result in results] == [
+        True, True, False, False, False, True]
+    assert results[0]["piece"]["name"] == "added"
+    assert len(results[0]["piece"]["tags"]) == 2
+    assert results[1]["piece"]["name"] == "edited"
+    assert [tag["tag"] for tag in results[1]["piece"]["tags"]] == [tags[1].tag]
+    assert results[2]["error"] == "A piece with this name already exists for this instrument!"
+    assert results[3]["code"] == 404
+    assert results[4]["code"] == 404
+
+    database.session.expire_all()
+    names = sorted(p.name for p in Piece.query.filter_by(user_id=user.id))
+    assert names == ["added", "edited"]
+    remaining_rows = database.session.execute(
+        sqlalchemy.select(pieces_tags)).all()
+    assert len(remaining_rows) == 3
+
+
+def test_bulk_pieces_apply_in_order(test_client, user, headers, tags, piece):
+    other, third = [Piece(name=name, description=None, instrument="Piano", state=1,
+                          tags=[tags[0]], user_id=user.id)  # type: ignore
+                    for name in ["other", "third"]]
+    database.session.add_all([other, third])
+    database.session.commit()
+    tag_ids = [hasher.encode(tag.id) for tag in tags]
+
+    response = test_client.post('/api/pieces/bulk', json={"operations": [
+        {"op": "delete", "id": hasher.encode(piece.id)},
+        {"op": "add", "name": piece.name, "description": None, "instrument": piece.instrument,
+         "state": 0, "tag_ids": tag_ids},
+        {"op": "delete", "id": hasher.encode(other.id)},
+        {"op": "edit", "id": hasher.encode(third.id), "name": "other", "description": None,
+         "instrument": "Piano", "state": 0, "tag_ids": []},
+        {"op": "edit", "id": hasher.encode(other.id), "name": "gone", "description": None,
+         "instrument": None, "state": 0, "tag_ids": []},
+    ]}, headers=headers)
+    assert response.status_code == 200
+    results = response.json["results"]
+    assert [result["ok"] for result in results] == [True, True, True, True, False]
+    assert results[1]["piece"]["name"] == piece.name
+    assert len(results[1]["piece"]["tags"]) == 2
+    assert results[3]["piece"]["name"] == "other"
+    assert results[4]["code"] == 404
+
+    database.session.expire_all()
+    assert sorted(p.name for p in Piece.query.filter_by(user_id=user.id)) == ["other", "test"]
+    assert len(database.session.execute(sqlalchemy.select(pieces_tags)).all()) == 2
+
+
+def test_bulk_pieces_missing_fields(test_client, user, headers):
+    response = test_client.post('/api/pieces/bulk', json={"operations": [
+        {"op": "add", "name": "added"},
+    ]}, headers=headers)
+    assert response.status_code == 200
+    assert response.json["results"] == [
+        {"ok": False, "code": 400, "error": "Missing fields"}]
+
+
+def test_add_piece_reports_all_missing_tags(test_client, user, headers, tags, other_tag):
+    response = test_client.post('/api/pieces/add', json={
+        "name": "name",
+        "description": None,
+        "instrument": None,
+        "state": 1,
+        "tag_ids": [hasher.encode(tags[0].id), hasher.encode(other_tag.id), hasher.encode(999)]
+    }, headers=headers)
+    assert response.status_code == 404
+    assert response.get_data(as_text=True) == "Tags with IDs " \
+        f"{hasher.encode(other_tag.id)}, {hasher.encode(999)} not found for this user"
+
+
+def test_resolve_tags_single_query(test_client, user):
+    tags = [Tag(user_id=user.id, tag=f"tag {i}", color="red")  # type: ignore
+            for i in range(15)]
+    database.session.add_all(tags)
+    database.session.commit()
+    tag_id_hashes = [hasher.encode(tag.id) for tag in tags]
+    user_id = user.id
+    database.session.expunge_all()
+    owner = database.session.get(User, user_id)
+
+    statements = []
+
+    def count(_conn, _cursor, statement, *_):
+        if statement.startswith("SELECT"):
+            statements.append(statement)
+
+    sqlalchemy.event.listen(database.engine, "before_cursor_execute", count)
+    try:
+        resolved = resolve_tags(owner, tag_id_hashes)
+    finally:
+        sqlalchemy.event.remove(database.engine, "before_cursor_execute", count)
+    assert [hasher.encode(tag.id) for tag in resolved] == tag_id_hashes
+    assert len(statements) == 1
+
+
+def test_search_pieces(test_client, user, headers, piece):
+    other = User(email='other@example.com', name="other", password_hash='hash',
+                 salt='salt')  # type: ignore
+    database.session.add(other)
+    database.session.flush()
+    database.session.add_all([
+        Piece(name="Cello Suite No. 1", description="Prélude by Bach", instrument="Cello",
+              state=0, user_id=user.id),  # type: ignore
+        Piece(name="Partita", description="<b>bach</b> for \x02violin\x03", instrument="Violin",
+              state=0, user_id=user.id),  # type: ignore
+        Piece(name="Inventions by Bach", description=None, instrument="Piano",
+              state=0, user_id=user.id),  # type: ignore
+        Piece(name="Bach Chorale", description=None, instrument=None,
+              state=0, user_id=other.id),  # type: ignore
+    ])
+    database.session.commit()
+
+    response = test_client.get('/api/pieces/search?q=bach', headers=headers)
+    assert response.status_code == 200
+    results = {result["piece"]["name"]: result for result in response.json["results"]}
+    # Only the user's own pieces, with names ranked above descriptions
+    assert set(results) == {"Inventions by Bach", "Cello Suite No. 1", "Partita"}
+    assert response.json["results"][0]["piece"]["name"] == "Inventions by Bach"
+    assert results["Partita"]["piece"]["tags"] == []
+    assert results["Partita"]["snippet"] == \
+        "&lt;b&gt;<mark>bach</mark>&lt;/b&gt; for \x02violin\x03"
+
+    # Prefix matching, ignoring accents
+    response = test_client.get('/api/pieces/search?q=prelu cel', headers=headers)
+    assert [result["piece"]["name"] for result in response.json["results"]] == \
+        ["Cello Suite No. 1"]  # type: ignore
+
+
+def test_search_pieces_follows_changes(test_client, user, headers, piece):
+    piece.name = "Moonlight Sonata"
+    database.session.commit()
+    response = test_client.get('/api/pieces/search?q=moonlight', headers=headers)
+    assert len(response.json["results"]) == 1  # type: ignore
+
+    response = test_client.post('/api/pieces/delete', json={"id": hasher.encode(piece.id)},
+                                headers=headers)
+    assert response.status_code == 200
+    response = test_client.get('/api/pieces/search?q=moonlight', headers=headers)
+    assert response.json["results"] == []  # type: ignore
+
+
+def test_search_pieces_query_syntax(test_client, user, headers, piece):
+    response = test_client.get('/api/pieces/search?q=', headers=headers)
+    assert response.status_code == 400
+    response = test_client.get('/api/pieces/search?q="test OR NEAR(*', headers=headers)
+    assert response.status_code == 200
+
+
+def test_init_db_builds_search_index_for_existing_pieces(test_client, user, headers, piece):
+    with database.engine.begin() as connection:
+        connection.exec_driver_sql("DROP TABLE pieces_fts")
+
+    result = app.test_cli_runner().invoke(args=["init-db"])
+    assert result.exit_code == 0
+    response = test_client.get('/api/pieces/search?q=test', headers=headers)
+    assert len(response.json["results"]) == 1  # type: ignore
+
+    result = app.test_cli_runner().invoke(args=["rebuild-search-index"])
+    assert result.exit_code == 0
+    response = test_client.get('/api/pieces/search?q=test', headers=headers)
+    assert len(response.json["results"]) == 1  # type: ignore
+
+
+def test_piece_stats(test_client, user, headers, tags, piece):
+    tag_ids = [hasher.encode(tag.id) for tag in tags]
+    response = test_client.post('/api/pieces/bulk', json={"operations": [
+        {"op": "add", "name": "added", "description": None, "instrument": None,
+         "state": 0, "tag_ids": tag_ids},
+        {"op": "add", "name": "other", "description": None, "instrument": "Cello",
+         "state": 1, "tag_ids": tag_ids[:1]},
+        {"op": "edit", "id": hasher.encode(piece.id), "name": "edited",
+         "description": None, "instrument": "Cello", "state": 2, "tag_ids": tag_ids[1:]},
+    ]}, headers=headers)
+    assert response.status_code == 200
+    response = test_client.post('/api/tags/delete', json={"id": tag_ids[0]}, headers=headers)
+    assert response.status_code == 200
+
+    response = test_client.get('/api/pieces/stats', headers=headers)
+    assert response.status_code == 200
+    expected = {
+        "total": 3,
+        "states": [{"state": 0, "count": 1}, {"state": 1, "count": 1}, {"state": 2, "count": 1}],
+        "instruments": [{"instrument": "Cello", "count": 2}, {"instrument": None, "count": 1}],
+        "tags": [{"id": tag_ids[1], "count": 2}],
+    }
+    assert response.json == expected
+
+    with database.engine.begin() as connection:
+        rebuild_facet_counts(connection)
+    assert test_client.get('/api/pieces/stats', headers=headers).json == expected
+
+
+def test_piece_stats_reads_only_the_counters(test_client, user, headers, piece):
+    statements = []
+
+    def count(_conn, _cursor, statement, *_):
+        statements.append(statement)
+
+    sqlalchemy.event.listen(sqlalchemy.Engine, "before_cursor_execute", count)
+    try:
+        response = test_client.get('/api/pieces/stats', headers=headers)
+    finally:
+        sqlalchemy.event.remove(sqlalchemy.Engine, "before_cursor_execute", count)
+    assert response.json["total"] == 1  # type: ignore
+    assert not [statement for statement in statements if "FROM pieces" in statement]
+
+
+def test_init_db_fills_piece_stats_for_existing_pieces(test_client, user, headers, piece):
+    with database.engine.begin() as connection:
+        connection.exec_driver_sql("DROP TRIGGER piece_facets_piece_insert")
+        connection.exec_driver_sql("DELETE FROM piece_facets")
+
+    result = app.test_cli_runner().invoke(args=["init-db"])
+    assert result.exit_code == 0
+    response = test_client.get('/api/pieces/stats', headers=headers)
+    assert response.json["total"] == 1  # type: ignore
+    assert len(response.json["tags"]) == 2  # type: ignore
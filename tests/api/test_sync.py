@@ -0,0 +1,77 @@
+import pytest
+from tests.conftest import add_user
+from web.base import hasher
+from web.models import Tag
+from web.models.piece import Piece
+
+
+@pytest.fixture
+def user(test_client):  # pylint: disable=unused-argument
+    tags = [Tag(tag="first", color="red"), Tag(tag="second", color="blue")]  # type: ignore
+    return add_user(tags=tags, pieces=[
+        Piece(name=f"piece {i}", description=None, instrument=None, state=0,
+              tags=[tags[i % 2]]) for i in range(4)])  # type: ignore
+
+
+def test_full_sync(test_client, user, headers):
+    response = test_client.get('/api/sync', headers=headers)
+    assert response.status_code == 200
+    assert sorted(piece["name"] for piece in response.json["pieces"]) == \
+        [f"piece {i}" for i in range(4)]
+    assert sorted(tag["tag"] for tag in response.json["tags"]) == ["first", "second"]
+    assert response.json["pieces"][0]["updated_at"] is not None
+    assert response.json["deleted_pieces"] == []
+    assert response.json["has_more"] is False
+
+    # Nothing changed since the returned cursor
+    response = test_client.get(f'/api/sync?since={response.json["cursor"]}', headers=headers)
+    assert response.json["pieces"] == []
+    assert response.json["tags"] == []
+
+
+def test_sync_returns_changes_and_deletions(test_client, user, headers):
+    cursor = test_client.get('/api/sync', headers=headers).json["cursor"]
+    pieces = {piece.name: hasher.encode(piece.id) for piece in user.pieces}
+    first_tag, second_tag = (hasher.encode(tag.id) for tag in user.tags)
+
+    response = test_client.post('/api/pieces/edit', json={
+        "id": pieces["piece 0"], "name": "edited", "description": None, "instrument": None,
+        "state": 1, "tag_ids": [first_tag]
+    }, headers=headers)
+    assert response.status_code == 200
+    response = test_client.post('/api/pieces/delete', json={"id": pieces["piece 2"]},
+                                headers=headers)
+    assert response.status_code == 200
+    response = test_client.post('/api/tags/delete', json={"id": second_tag}, headers=headers)
+    assert response.status_code == 200
+
+    response = test_client.get(f'/api/sync?since={cursor}', headers=headers)
+    assert response.status_code == 200
+    # Pieces 1 and 3 lost the deleted tag
+    assert sorted(piece["name"] for piece in response.json["pieces"]) == \
+        ["edited", "piece 1", "piece 3"]
+    assert response.json["tags"] == []
+    assert response.json["deleted_pieces"] == [pieces["piece 2"]]
+    assert response.json["deleted_tags"] == [second_tag]
+    assert response.json["cursor"] > cursor
+
+
+def test_sync_pages(test_client, user, headers):
+    synced = []
+    cursor = None
+    while True:
+        url = '/api/sync?limit=2' + (f'&since={cursor}' if cursor is not None else '')
+        response = test_client.get(url, headers=headers)
+        assert len(response.json["pieces"]) + len(response.json["tags"]) <= 2
+        synced += [piece["name"] for piece in response.json["pieces"]]
+        synced += [tag["tag"] for tag in response.json["tags"]]
+        cursor = response.json["cursor"]
+        if not response.json["has_more"]:
+            break
+    assert sorted(synced) == ["first"] + [f"piece {i}" for i in range(4)] + ["second"]
+
+
+def test_sync_invalid_cursor(test_client, user, headers):
+    response = test_client.get('/api/sync?since=yesterday', headers=headers)
+    assert response.status_code == 400
+    assert response.get_data(as_text=True) == "Invalid since"
@@ -1,47 +1,7 @@
-from flask_jwt_extended import create_access_token
 import pytest
 
-from web.base import app, database, hasher
-from web.models import User, Tag
-
-
-@pytest.fixture()
-def test_client():
-    app.config['TESTING'] = True
-    client = app.test_client()
-
-    ctx = app.app_context()
-    ctx.push()
-
-    database.create_all()
-
-    yield client
-
-    database.session.remove()
-    database.drop_all()
-    ctx.pop()
-
-
-@pytest.fixture
-def user():
-    u = User(
-        email='user@example.com',
-        name="name",
-        password_hash='b305cadbb3bce54f3aa59c64fec00dea',
-        salt='salt',
-        tags=[Tag(tag="test", color="red")]  # type: ignore
-    )  # type: ignore
-    database.session.add(u)
-    database.session.commit()
-    return u
-
-
-@pytest.fixture
-def headers(user):
-    access_token = create_access_token(identity=user.email)
-    return {
-        'Authorization': f'Bearer {access_token}'
-    }
+from web.base import database, hasher
+from web.models import Tag
 
 
 @pytest.fixture
@@ -77,16 +37,7 @@ def test_edit_tag_not_found(test_client, user, headers):
     assert response.get_data(as_text=True) == "Tag with ID 999 not found"
 
 
-def test_edit_tag_user_not_authorized(test_client, user, headers):
-    other_user = User(email="other@example.com", name="otheruser",
-                      password_hash="hashed_password", salt="salt")  # type: ignore
-    database.session.add(other_user)
-    database.session.commit()
-    other_tag = Tag(user_id=other_user.id, tag="other tag",
-                    color="green")  # type: ignore
-    database.session.add(other_tag)
-    database.session.commit()
-
+def test_edit_tag_user_not_authorized(test_client, user, headers, other_tag):
     response = test_client.post('/api/tags/edit', json={
         'id': hasher.encode(other_tag.id),
         'tag': 'new tag name',
@@ -157,16 +108,7 @@ def test_delete_tag_not_found(test_client, user, headers):
     assert response.get_data(as_text=True) == "Tag with ID 999 not found"
 
 
-def test_delete_tag_user_not_authorized(test_client, user, headers):
-    other_user = User(email="other@example.com", name="otheruser",
-                      password_hash="hashed_password", salt="salt")  # type: ignore
-    database.session.add(other_user)
-    database.session.commit()
-    other_tag = Tag(user_id=other_user.id, tag="other tag",
-                    color="green")  # type: ignore
-    database.session.add(other_tag)
-    database.session.commit()
-
+def test_delete_tag_user_not_authorized(test_client, user, headers, other_tag):
     response = test_client.post('/api/tags/delete', json={
         'id': hasher.encode(other_tag.id)
     }, headers=headers)
@@ -1,3 +1,50 @@
+import contextlib
+
 from dotenv import load_dotenv
+from flask_jwt_extended import create_access_token
+import pytest
 
 load_dotenv()
+
+# The app reads its settings from the environment loaded above
+# pylint: disable=wrong-import-position
+from web.base import app, database
+from web.models import User
+
+
+@contextlib.contextmanager
+def app_database():
+    ctx = app.app_context()
+    ctx.push()
+    database.create_all()
+    try:
+        yield
+    finally:
+        database.session.remove()
+        database.drop_all()
+        ctx.pop()
+
+
+def add_user(**columns) -> User:
+    user = User(**{"email": 'user@example.com', "name": "name", "password_hash": 'hash',
+                   "salt": 'salt', **columns})
+    database.session.add(user)
+    database.session.commit()
+    return user
+
+
+@pytest.fixture()
+def app_context():
+    with app_database():
+        yield
+
+
+@pytest.fixture()
+def test_client(app_context):  # pylint: disable=unused-argument
+    app.config['TESTING'] = True
+    return app.test_client()
+
+
+@pytest.fixture()
+def headers(user):
+    return {'Authorization': f'Bearer {create_access_token(identity=user.email)}'}
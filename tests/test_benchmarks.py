@@ -0,0 +1,45 @@
+import pytest
+
+from benchmarks.data import DataShape, generate
+from benchmarks.measure import compare_results, summarize
+from web.base import database, storage
+from web.models import File, Piece
+
+
+@pytest.fixture()
+def context(app_context, tmp_path, monkeypatch):  # pylint: disable=unused-argument
+    monkeypatch.setattr(storage, "root", tmp_path)
+
+
+def _rows():
+    return [(piece.name, piece.instrument, piece.state, sorted(tag.tag for tag in piece.tags),
+             piece.file.size if piece.file else None)
+            for piece in Piece.query.order_by(Piece.id)]
+
+
+def test_data_is_generated_from_the_seed(context):
+    shape = DataShape(users=2, pieces_per_user=20, tags_per_user=5, files=0.5,
+                      file_size_median=2048, max_file_size=8192)
+    dataset = generate(7, shape)
+    assert len(dataset.emails) == 2
+    assert all(len(pieces) == 20 for pieces in dataset.pieces.values())
+    assert len(dataset.files) == File.query.count() > 0
+    assert all(1024 <= file.size <= 8192 for file in File.query)
+    rows = _rows()
+    database.session.commit()
+
+    database.drop_all()
+    database.create_all()
+    generate(7, shape)
+    assert _rows() == rows
+
+
+def test_compare_results_reports_regressions():
+    baseline = {"benchmarks": {"current_user": summarize([0.010] * 10, [3] * 10)}}
+    same = {"benchmarks": {"current_user": summarize([0.011] * 10, [3] * 10)}}
+    assert not compare_results(same, baseline, threshold=0.2)
+
+    slower = {"benchmarks": {"current_user": summarize([0.020] * 10, [4] * 10),
+                             "tags_edit": summarize([0.020] * 10, [4] * 10)}}
+    regressions = compare_results(slower, baseline, threshold=0.2)
+    assert [regression.split(":")[0] for regression in regressions] == ["current_user"] * 3
@@ -0,0 +1,59 @@
+import gzip
+import io
+import json
+
+import pytest
+
+from tests.conftest import add_user
+from web.base import app, database, hasher, storage
+from web.compression import response_compressor
+from web.models import File, Piece, Tag
+
+
+@pytest.fixture()
+def user(app_context):  # pylint: disable=unused-argument
+    tags = [Tag(tag=f"tag {i}", color="red") for i in range(5)]  # type: ignore
+    return add_user(tags=tags, pieces=[
+        Piece(name=f"piece {i}", description="description", instrument="Piano", state=0,
+              tags=tags) for i in range(50)])  # type: ignore
+
+
+def test_large_json_is_compressed(user, headers):
+    client = app.test_client()
+    plain = client.get('/api/auth/current_user', headers=headers)
+    assert "Content-Encoding" not in plain.headers
+    assert plain.headers["Vary"] == "Accept-Encoding"
+
+    compressed_before = response_compressor.stats()["compressed"]
+    response = client.get('/api/auth/current_user',
+                          headers={**headers, "Accept-Encoding": "gzip, deflate"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert int(response.headers["Content-Length"]) < len(plain.get_data()) / 5
+    assert json.loads(gzip.decompress(response.get_data())) == plain.json
+    assert response_compressor.stats()["compressed"] == compressed_before + 1
+
+
+def test_small_json_is_not_compressed(user, headers):
+    response = app.test_client().get('/api/pieces/stats',
+                                     headers={**headers, "Accept-Encoding": "gzip"})
+    assert len(response.get_data()) < app.config["COMPRESSION_MIN_SIZE"]
+    assert "Content-Encoding" not in response.headers
+
+
+def test_files_are_not_compressed(user, headers, tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "root", tmp_path)
+    content = json.dumps([{"key": "value"}] * 1000).encode()
+    piece_id = user.pieces[0].id
+    response = app.test_client().post('/api/files/upload_file', data={
+        "id": hasher.encode(piece_id),
+        "file": (io.BytesIO(content), "data.json", "application/json"),
+    }, headers=headers)
+    assert response.status_code == 200
+    file_id = database.session.get(Piece, piece_id).file_id
+
+    response = app.test_client().get(f'/api/files/file/{hasher.encode(file_id)}',
+                                     headers={"Accept-Encoding": "gzip"})
+    assert response.mimetype == "application/json"
+    assert "Content-Encoding" not in response.headers
+    assert response.get_data() == content
+    assert database.session.get(File, file_id) is not None
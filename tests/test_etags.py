@@ -0,0 +1,77 @@
+import pytest
+import sqlalchemy
+
+from tests.conftest import add_user
+from web.base import app, database, hasher
+from web.etags import clear_etag_cache
+from web.models import Piece, Tag
+
+
+@pytest.fixture()
+def user(app_context):  # pylint: disable=unused-argument
+    clear_etag_cache()
+    tags = [Tag(tag="tag", color="red")]  # type: ignore
+    return add_user(tags=tags, pieces=[
+        Piece(name="piece", description=None, instrument=None, state=0,
+              tags=tags)])  # type: ignore
+
+
+@pytest.fixture()
+def statements():
+    executed = []
+
+    def count(_conn, _cursor, statement, *_):
+        executed.append(statement)
+
+    sqlalchemy.event.listen(sqlalchemy.Engine, "before_cursor_execute", count)
+    yield executed
+    sqlalchemy.event.remove(sqlalchemy.Engine, "before_cursor_execute", count)
+
+
+def test_matching_etag_is_not_modified(user, headers, statements):
+    client = app.test_client()
+    first = client.get('/api/auth/current_user', headers=headers)
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    assert etag.startswith('W/"')
+
+    clear_etag_cache()
+    statements.clear()
+    second = client.get('/api/auth/current_user', headers={**headers, "If-None-Match": etag})
+    assert second.status_code == 304
+    assert second.headers["ETag"] == etag
+    assert len(statements) == 1
+    assert "FROM users" in statements[0]
+
+    # Served from the cache without querying at all
+    statements.clear()
+    third = client.get('/api/pieces', headers={**headers, "If-None-Match": etag})
+    assert third.status_code == 304
+    assert not statements
+
+
+def test_writes_change_the_etag(user, headers):
+    client = app.test_client()
+    etag = client.get('/api/auth/current_user', headers=headers).headers["ETag"]
+
+    response = client.post('/api/tags/edit', json={
+        "id": hasher.encode(user.tags[0].id), "tag": "renamed", "color": "red"
+    }, headers=headers)
+    assert response.status_code == 200
+    response = client.get('/api/auth/current_user', headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json["tags"][0]["tag"] == "renamed"  # type: ignore
+
+
+def test_writes_by_other_workers_change_the_etag(user, headers):
+    client = app.test_client()
+    etag = client.get('/api/pieces', headers=headers).headers["ETag"]
+
+    # Another worker's write is only seen by this one when its cached ETag expires
+    database.session.execute(sqlalchemy.text("DELETE FROM pieces_tags"))
+    database.session.commit()
+    clear_etag_cache()
+    response = client.get('/api/pieces', headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json["pieces"][0]["tags"] == []  # type: ignore
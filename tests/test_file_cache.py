@@ -0,0 +1,38 @@
+from web.file_cache import CachedFile, FileCache
+
+
+def _entry(size: int) -> CachedFile:
+    return CachedFile(b"A" * size, "text/plain", None)
+
+
+def test_file_cache_evicts_least_recently_used():
+    cache = FileCache(max_bytes=10, max_entry_bytes=10)
+    cache.set(1, _entry(4))
+    cache.set(2, _entry(4))
+    assert cache.get(1) is not None
+
+    cache.set(3, _entry(4))
+    assert cache.get(2) is None
+    assert cache.get(1) is not None
+    assert cache.get(3) is not None
+    assert cache.size == 8
+    assert cache.stats()["evictions"] == 1
+
+
+def test_file_cache_skips_large_entries():
+    cache = FileCache(max_bytes=100, max_entry_bytes=10)
+    cache.set(1, _entry(11))
+    assert cache.get(1) is None
+    assert cache.size == 0
+
+
+def test_file_cache_counts_hits_and_misses():
+    cache = FileCache(max_bytes=100, max_entry_bytes=10)
+    cache.set(1, _entry(5))
+    cache.get(1)
+    cache.get(2)
+    cache.delete(1)
+    cache.get(1)
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+    assert cache.size == 0
@@ -0,0 +1,22 @@
+import pytest
+
+from web.base import hasher
+from web.exceptions import SonataNotFoundException
+from web.ids import decode_id, decode_ids, encode_id, encode_ids, try_decode_id
+
+
+def test_round_trip():
+    assert encode_id(42) == hasher.encode(42)
+    assert decode_id(encode_id(42), "Piece") == 42
+    assert encode_ids([1, None, 3]) == [hasher.encode(1), None, hasher.encode(3)]
+    assert decode_ids(encode_ids([1, 2, 3])) == [1, 2, 3]
+
+
+@pytest.mark.parametrize("hashed_id", ["", "!!!", "not an id", hasher.encode(1, 2), 12, None])
+def test_invalid_ids(hashed_id):
+    assert try_decode_id(hashed_id) is None
+    assert decode_ids([hashed_id]) == [None]
+    with pytest.raises(SonataNotFoundException) as error:
+        decode_id(hashed_id, "Piece")
+    assert error.value.code == 404
+    assert error.value.error_message == f"Piece with ID {hashed_id} not found"
@@ -0,0 +1,138 @@
+import logging
+import os
+import re
+
+import pytest
+
+from tests.conftest import add_user
+from web.base import app
+from web.instrumentation import metrics_exporter, request_metrics
+from web.models import Piece
+
+
+@pytest.fixture()
+def user(app_context):  # pylint: disable=unused-argument
+    return add_user(pieces=[Piece(name=f"piece {i}", description=None, instrument=None,
+                                  state=0) for i in range(3)])  # type: ignore
+
+
+@pytest.fixture()
+def metrics_headers(monkeypatch):
+    monkeypatch.setitem(app.config, "METRICS_TOKEN", "token")
+    return {'Authorization': 'Bearer token'}
+
+
+def _server_timing(response) -> dict:
+    return {name: float(duration) for name, duration in
+            re.findall(r"(\w+);dur=([\d.]+)", response.headers["Server-Timing"])}
+
+
+def test_responses_have_server_timing(headers):
+    response = app.test_client().get('/api/pieces', headers=headers)
+    assert response.status_code == 200
+    timings = _server_timing(response)
+    assert set(timings) == {"sql", "serialize", "total"}
+    assert timings["total"] >= timings["sql"] + timings["serialize"]
+    queries = int(re.search(r'desc="(\d+) queries"', response.headers["Server-Timing"])[1])
+    assert queries > 0
+
+    app.config["SERVER_TIMING"] = False
+    try:
+        response = app.test_client().get('/api/pieces', headers=headers)
+        assert "Server-Timing" not in response.headers
+    finally:
+        app.config["SERVER_TIMING"] = True
+
+
+def _sample(metrics: str, name: str) -> float:
+    match = re.search(rf"^{re.escape(name)} (\S+)$", metrics, re.MULTILINE)
+    return float(match[1]) if match else 0
+
+
+def test_metrics_require_the_token(headers, monkeypatch):
+    assert app.test_client().get('/metrics').status_code == 404
+    monkeypatch.setitem(app.config, "METRICS_TOKEN", "token")
+    assert app.test_client().get('/metrics').status_code == 401
+    assert app.test_client().get('/metrics', headers=headers).status_code == 401
+    response = app.test_client().get('/metrics', headers={'Authorization': 'Bearer token'})
+    assert response.status_code == 200
+
+
+def test_metrics_aggregate_requests_per_route(headers, metrics_headers):
+    labels = '{route="/api/pieces/stats",method="GET"}'
+    before = app.test_client().get('/metrics', headers=metrics_headers).get_data(as_text=True)
+    for _ in range(2):
+        assert app.test_client().get('/api/pieces/stats', headers=headers).status_code == 200
+
+    response = app.test_client().get('/metrics', headers=metrics_headers)
+    assert response.mimetype == "text/plain"
+    metrics = response.get_data(as_text=True)
+    count = f"sonata_request_duration_seconds_count{labels}"
+    assert _sample(metrics, count) == _sample(before, count) + 2
+    assert _sample(metrics, f"sonata_request_sql_queries_sum{labels}") > 0
+    responses = 'sonata_responses_total{route="/api/pieces/stats",method="GET",status="200"}'
+    assert _sample(metrics, responses) == _sample(before, responses) + 2
+    assert "# TYPE sonata_request_duration_seconds histogram" in metrics
+    assert "sonata_file_cache_hits " in metrics
+    assert "sonata_hashing_pool_calls " in metrics
+
+
+def test_metrics_of_every_worker_are_returned(headers, metrics_headers, tmp_path):
+    metrics_exporter.directory = tmp_path
+    try:
+        (tmp_path / "1.prom").write_text("\n".join([
+            "# HELP sonata_responses_total Responses sent.",
+            "# TYPE sonata_responses_total counter",
+            'sonata_responses_total{worker="1",route="/api/pieces",method="GET",status="200"} 5',
+            "# TYPE sonata_file_cache_hits untyped",
+            'sonata_file_cache_hits{worker="1"} 3',
+        ]) + "\n")
+        assert app.test_client().get('/api/pieces', headers=headers).status_code == 200
+        response = app.test_client().get('/metrics', headers=metrics_headers)
+        metrics = response.get_data(as_text=True)
+    finally:
+        metrics_exporter.stop()
+        metrics_exporter.directory = None
+
+    assert metrics.count("# TYPE sonata_responses_total counter") == 1
+    assert metrics.count("# TYPE sonata_file_cache_hits untyped") == 1
+    worker = f'worker="{os.getpid()}"'
+    assert _sample(metrics, 'sonata_responses_total{worker="1",route="/api/pieces",'
+                            'method="GET",status="200"}') == 5
+    assert _sample(metrics, f'sonata_responses_total{{{worker},route="/api/pieces",'
+                            'method="GET",status="200"}') >= 1
+    assert _sample(metrics, 'sonata_file_cache_hits{worker="1"}') == 3
+    assert f"sonata_file_cache_hits{{{worker}}} " in metrics
+    # The samples of a metric are not split by the ones of other metrics
+    lines = metrics.splitlines()
+    responses = [index for index, line in enumerate(lines)
+                 if line.startswith("sonata_responses_total")]
+    assert responses == list(range(responses[0], responses[-1] + 1))
+    # The process removes its file when it stops
+    assert [path.name for path in tmp_path.iterdir()] == ["1.prom"]
+
+
+def test_metrics_of_exited_workers_are_removed(tmp_path):
+    metrics_exporter.directory = tmp_path
+    try:
+        (tmp_path / "1.prom").write_text('sonata_file_cache_hits{worker="1"} 3\n')
+        (tmp_path / "2.prom").write_text('sonata_file_cache_hits{worker="2"} 4\n')
+        metrics_exporter.remove(1)
+        metrics_exporter.remove(3)
+    finally:
+        metrics_exporter.directory = None
+    assert [path.name for path in tmp_path.iterdir()] == ["2.prom"]
+
+
+def test_slow_queries_are_logged(headers, caplog):
+    slow_queries = request_metrics.slow_queries
+    app.config["SLOW_QUERY_MS"] = 1e-9
+    try:
+        with caplog.at_level(logging.WARNING, logger="web.slow_queries"):
+            app.test_client().get('/api/pieces', headers=headers)
+    finally:
+        app.config["SLOW_QUERY_MS"] = 200
+    messages = [record.getMessage() for record in caplog.records
+                if record.name == "web.slow_queries"]
+    assert any("during /api/pieces: SELECT" in message for message in messages)
+    assert request_metrics.slow_queries >= slow_queries + len(messages)
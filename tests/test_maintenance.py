@@ -0,0 +1,165 @@
+import io
+import os
+import time
+
+import pytest
+from sqlalchemy import text
+
+from tests.conftest import add_user
+from web.base import app, database, file_cache, storage
+from web.file_cache import CachedFile
+from web.maintenance import MaintenanceWorker, maintenance_lock
+from web.models import File, Piece, UploadSession
+
+
+@pytest.fixture()
+def user_id(app_context, tmp_path, monkeypatch):  # pylint: disable=unused-argument
+    monkeypatch.setattr(storage, "root", tmp_path)
+    new_user_id = add_user().id
+    # Loading the id began a transaction, which would hold the only writer connection
+    database.session.commit()
+    return new_user_id
+
+
+def _worker(dry_run=False, grace=60):
+    return MaintenanceWorker(app, batch_size=2, grace=grace, vacuum_pages=1000, dry_run=dry_run)
+
+
+def _add_file(content: bytes, age: float = 0) -> File:
+    blob = storage.save(io.BytesIO(content))
+    if age:
+        os.utime(storage.local_path(blob.path), (0, 0))
+    file = File(file_type="application/pdf", size=blob.size, sha256=blob.sha256,
+                path=blob.path)  # type: ignore
+    database.session.add(file)
+    database.session.flush()
+    if age:
+        database.session.execute(
+            text("UPDATE files SET created_at = datetime('now', :age) WHERE id = :id"),
+            {"age": f"-{age} seconds", "id": file.id})
+    return file
+
+
+def test_orphaned_files_are_deleted_in_batches(user_id):
+    orphans = [_add_file(f"orphan {i}".encode(), age=120) for i in range(3)]
+    recent = _add_file(b"recent")
+    used = _add_file(b"used", age=120)
+    database.session.add(Piece(name="piece", description=None, instrument=None, state=0,
+                               user_id=user_id, file_id=used.id))  # type: ignore
+    orphan_ids = [orphan.id for orphan in orphans]
+    orphan_paths = [orphan.path for orphan in orphans]
+    recent_id, used_id = recent.id, used.id
+    database.session.commit()
+    file_cache.set(orphan_ids[0], CachedFile(b"orphan 0", "application/pdf", None))
+
+    worker = _worker()
+    summary = worker.run()
+    assert summary["orphaned_files"] == 3
+    assert summary["orphaned_blobs"] == 3
+    assert summary["freed_bytes"] == sum(len(f"orphan {i}") for i in range(3))
+    assert {file.id for file in File.query} == {recent_id, used_id}
+    assert not any(storage.exists(path) for path in orphan_paths)
+    assert file_cache.get(orphan_ids[0]) is None
+    assert worker.stats()["runs"] == 1
+    assert worker.stats()["orphaned_files"] == 3
+    database.session.commit()
+
+    assert worker.run()["orphaned_files"] == 0
+
+
+def test_dry_run_deletes_nothing(user_id):
+    file = _add_file(b"orphan", age=120)
+    file_id, path = file.id, file.path
+    database.session.commit()
+    unreferenced = storage.save(io.BytesIO(b"unreferenced"))
+    os.utime(storage.local_path(unreferenced.path), (0, 0))
+
+    summary = _worker(dry_run=True).run()
+    assert summary["orphaned_files"] == 1
+    assert summary["orphaned_blobs"] == 1
+    assert database.session.get(File, file_id) is not None
+    assert storage.exists(path)
+    assert storage.exists(unreferenced.path)
+    database.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["maintenance", "--dry-run", "--grace", "60"])
+    assert result.exit_code == 0
+    assert "Would delete 1 orphaned files and 1 blobs" in result.output
+
+
+def test_recently_written_blobs_are_kept(user_id):
+    blob = storage.save(io.BytesIO(b"uploading"))
+    assert _worker().run()["orphaned_blobs"] == 0
+    assert storage.exists(blob.path)
+
+    # Storing the same content again marks an old blob as used
+    os.utime(storage.local_path(blob.path), (0, 0))
+    storage.save(io.BytesIO(b"uploading"))
+    assert _worker().run()["orphaned_blobs"] == 0
+    assert storage.exists(blob.path)
+
+
+def _add_upload(user_id: int, piece_id: int, age: float) -> str:
+    upload = UploadSession(user_id=user_id, piece_id=piece_id,
+                           file_type="application/pdf")  # type: ignore
+    database.session.add(upload)
+    database.session.flush()
+    database.session.execute(
+        text("UPDATE upload_sessions SET created_at = datetime('now', :age) WHERE id = :id"),
+        {"age": f"-{age} seconds", "id": upload.id})
+    temp = storage.temp_path(upload.temp_name)
+    temp.write_bytes(b"chunk")
+    os.utime(temp, (time.time() - age, time.time() - age))
+    return upload.temp_name
+
+
+def test_abandoned_uploads_expire(user_id):
+    piece = Piece(name="piece", description=None, instrument=None, state=0,
+                  user_id=user_id)  # type: ignore
+    database.session.add(piece)
+    database.session.flush()
+    abandoned = _add_upload(user_id, piece.id, age=7200)
+    recent = _add_upload(user_id, piece.id, age=0)
+    # Started long ago, but still receiving chunks
+    resumed = _add_upload(user_id, piece.id, age=7200)
+    os.utime(storage.temp_path(resumed))
+    database.session.commit()
+    orphaned = storage.temp_path("upload-999")
+    orphaned.write_bytes(b"chunk")
+    os.utime(orphaned, (0, 0))
+
+    app.config["MAINTENANCE_UPLOAD_TTL_S"] = 3600
+    try:
+        assert _worker(dry_run=True).run()["expired_uploads"] == 2
+        assert orphaned.exists()
+        assert _worker().run()["expired_uploads"] == 2
+    finally:
+        app.config["MAINTENANCE_UPLOAD_TTL_S"] = 86400
+    assert {upload.temp_name for upload in UploadSession.query} == {recent, resumed}
+    assert not storage.temp_path(abandoned).exists()
+    assert not orphaned.exists()
+    assert storage.temp_path(recent).exists()
+
+
+def test_incremental_vacuum_frees_pages(user_id):
+    database.session.execute(text("CREATE TABLE filler (data BLOB)"))
+    for _ in range(100):
+        database.session.execute(text("INSERT INTO filler VALUES (zeroblob(4000))"))
+    database.session.execute(text("DROP TABLE filler"))
+    database.session.commit()
+    free_pages = database.session.execute(text("PRAGMA freelist_count")).scalar()
+    database.session.commit()
+    assert free_pages >= 100
+
+    assert _worker(dry_run=True).run()["vacuumed_pages"] == free_pages
+    assert _worker().run()["vacuumed_pages"] == free_pages
+    assert database.session.execute(text("PRAGMA freelist_count")).scalar() == 0
+
+
+def test_one_process_runs_at_a_time(user_id):
+    worker = _worker()
+    with maintenance_lock() as locked:
+        assert locked
+        assert worker.run_exclusive() is None
+    assert worker.stats()["skipped_runs"] == 1
+    assert worker.run_exclusive() is not None
@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+from web.exceptions import SonataException
+from web.passwords import HashingPool, LegacyMd5Hasher, ScryptHasher
+
+_LEGACY_HASH = 'b305cadbb3bce54f3aa59c64fec00dea'
+
+
+def test_scrypt_hasher_round_trip():
+    hasher = ScryptHasher(n=2 ** 10, r=8, p=1)
+    hashed = hasher.hash("password", "salt")
+    assert hashed.startswith("scrypt$1024$8$1$")
+    assert hasher.verify("password", "salt", hashed)
+    assert not hasher.verify("wrong", "salt", hashed)
+    assert not hasher.needs_rehash(hashed)
+    assert ScryptHasher(n=2 ** 11, r=8, p=1).needs_rehash(hashed)
+    # Hashes keep verifying after the cost parameters change
+    assert ScryptHasher(n=2 ** 11, r=8, p=1).verify("password", "salt", hashed)
+
+
+def test_legacy_hasher():
+    hasher = LegacyMd5Hasher()
+    assert hasher.identifies(_LEGACY_HASH)
+    assert hasher.verify("password", "salt", _LEGACY_HASH)
+    assert ScryptHasher(n=2 ** 10, r=8, p=1).needs_rehash(_LEGACY_HASH)
+
+
+def test_hashing_pool_runs_in_worker_processes():
+    pool = HashingPool(workers=1, max_concurrency=1, queue_timeout=30)
+    start = time.perf_counter()
+    try:
+        hashed = pool.run(LegacyMd5Hasher().hash, "password", "salt")
+    finally:
+        pool.shutdown()
+    elapsed = time.perf_counter() - start
+    assert hashed == _LEGACY_HASH
+    stats = pool.stats()
+    assert stats["calls"] == 1
+    assert stats["in_flight"] == 0
+    # Both measured as durations, so they add up to at most the time of the call
+    assert stats["queue_seconds_total"] >= 0
+    assert stats["run_seconds_total"] >= 0
+    assert stats["queue_seconds_total"] + stats["run_seconds_total"] <= elapsed
+
+
+def test_hashing_pool_rejects_when_saturated():
+    pool = HashingPool(workers=0, max_concurrency=1, queue_timeout=0.01)
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    thread = threading.Thread(target=pool.run, args=(block,))
+    thread.start()
+    started.wait()
+    with pytest.raises(SonataException) as error:
+        pool.run(LegacyMd5Hasher().hash, "password", "salt")
+    release.set()
+    thread.join()
+    assert error.value.code == 503
+    assert pool.stats()["rejected"] == 1
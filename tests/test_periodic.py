@@ -0,0 +1,27 @@
+import threading
+import time
+
+from web.periodic import PeriodicTask
+
+
+def test_periodic_task_runs_until_stopped():
+    calls = []
+    called_twice = threading.Event()
+
+    def call():
+        calls.append(threading.current_thread().name)
+        if len(calls) >= 2:
+            called_twice.set()
+
+    task = PeriodicTask("sonata-test")
+    task.start(0.01, call)
+    # Already running, so no second thread is started
+    task.start(0.01, call)
+    assert called_twice.wait(5)
+    task.stop()
+
+    stopped_at = len(calls)
+    time.sleep(0.05)
+    assert len(calls) == stopped_at
+    assert set(calls) == {"sonata-test"}
+    assert [thread for thread in threading.enumerate() if thread.name == "sonata-test"] == []
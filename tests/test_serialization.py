@@ -0,0 +1,75 @@
+from flask_jwt_extended import create_access_token
+import pytest
+
+from tests.conftest import add_user
+from web.base import app, database
+from web.models import Piece, Tag, User
+from web.serialization import clear_serialization_cache
+
+
+@pytest.fixture()
+def user(app_context):  # pylint: disable=unused-argument
+    clear_serialization_cache()
+    tags = [Tag(tag="tag", color="red")]  # type: ignore
+    return add_user(tags=tags, pieces=[
+        Piece(name=f"piece {i}", description=None, instrument=None, state=0,
+              tags=tags) for i in range(20)])  # type: ignore
+
+
+@pytest.fixture()
+def builds(monkeypatch):
+    calls = []
+    for model in (Piece, Tag, User):
+        def counting_build(self, build=model._columns_dict):  # pylint: disable=protected-access
+            calls.append(self)
+            return build(self)
+
+        monkeypatch.setattr(model, "_columns_dict", counting_build)
+    return calls
+
+
+def test_to_dict_is_cached_until_updated(user, builds):
+    tag = user.tags[0]
+    assert tag.to_dict()["tag"] == "tag"
+    assert len(builds) == 1
+    assert tag.to_dict()["tag"] == "tag"
+    assert len(builds) == 1
+
+    version = tag.version
+    tag.tag = "renamed"
+    database.session.commit()
+    assert tag.version == version + 1
+    assert tag.to_dict()["tag"] == "renamed"
+    assert len(builds) == 2
+
+
+def test_collection_changes_do_not_bump_version(user):
+    piece = user.pieces[0]
+    version = piece.version
+    piece.tags = []  # type: ignore
+    database.session.commit()
+    assert piece.version == version
+    assert piece.to_dict()["tags"] == []
+
+
+def test_uncommitted_changes_are_not_cached(user):
+    piece = user.pieces[0]
+    name = piece.name
+    piece.name = "rolled back"
+    database.session.flush()
+    assert piece.to_dict()["name"] == "rolled back"
+    database.session.rollback()
+    assert piece.to_dict()["name"] == name
+
+
+def test_current_user_payload_is_served_from_cache(user, builds):
+    client = app.test_client()
+    headers = {'Authorization': f'Bearer {create_access_token(identity=user.email)}'}
+    first = client.get('/api/auth/current_user', headers=headers)
+    # The user, its tag and its 20 pieces
+    assert len(builds) == 22
+    database.session.expunge_all()
+
+    second = client.get('/api/auth/current_user', headers=headers)
+    assert second.json == first.json
+    assert len(builds) == 22
@@ -0,0 +1,85 @@
+import gzip
+
+import pytest
+
+from web.base import app
+
+
+@pytest.fixture()
+def website(tmp_path, monkeypatch):
+    (tmp_path / "index.html").write_text("<html>app</html>")
+    assets = tmp_path / "assets"
+    assets.mkdir()
+    (assets / "index-4f9a2c1b.js").write_text("console.log('app')")
+    (assets / "index-4f9a2c1b.js.gz").write_bytes(gzip.compress(b"console.log('app')"))
+    (tmp_path / "favicon.ico").write_bytes(b"icon")
+    monkeypatch.setitem(app.config, "STATIC_PATH", tmp_path)
+    return tmp_path
+
+
+def test_unknown_paths_fall_back_to_index(website):
+    client = app.test_client()
+    for path in ("/", "/pieces/abc", "/index.html"):
+        response = client.get(path)
+        assert response.status_code == 200
+        assert response.get_data() == b"<html>app</html>"
+        assert response.headers["Cache-Control"] == "no-cache"
+
+
+def test_index_is_revalidated_with_etag(website):
+    client = app.test_client()
+    etag = client.get("/").headers["ETag"]
+    response = client.get("/library", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    (website / "index.html").write_text("<html>new release</html>")
+    response = client.get("/library", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.get_data() == b"<html>new release</html>"
+
+
+def test_index_is_compressed(website):
+    client = app.test_client()
+    response = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.get_data()) == b"<html>app</html>"
+
+    # Each encoding has its own tag
+    etag = response.headers["ETag"]
+    assert etag != client.get("/").headers["ETag"]
+    response = client.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert response.status_code == 304
+    assert client.get("/", headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_hashed_assets_are_immutable(website):
+    client = app.test_client()
+    response = client.get("/assets/index-4f9a2c1b.js")
+    assert response.get_data() == b"console.log('app')"
+    assert "immutable" in response.headers["Cache-Control"]
+    assert "Accept-Encoding" in response.headers["Vary"]
+
+    response = client.get("/assets/index-4f9a2c1b.js", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.mimetype == "text/javascript"
+    assert gzip.decompress(response.get_data()) == b"console.log('app')"
+
+
+@pytest.mark.parametrize("name", ["main.3b2e8f61.css", "index-BxK3_9aZ.js", "index-B-xYz_Qa.js"])
+def test_bundler_hashes_are_immutable(website, name):
+    (website / name).write_text("asset")
+    assert "immutable" in app.test_client().get(f"/{name}").headers["Cache-Control"]
+
+
+@pytest.mark.parametrize("name", ["favicon.ico", "logo-20240101.png", "hero-Homepage.png",
+                                  "app.deadbeef.js"])
+def test_other_assets_are_revalidated(website, name):
+    (website / name).write_bytes(b"icon")
+    response = app.test_client().get(f"/{name}")
+    assert response.get_data() == b"icon"
+    assert response.headers["Cache-Control"] == "no-cache"
+
+
+def test_paths_outside_the_website_are_not_served(website):
+    response = app.test_client().get("/../secret")
+    assert response.get_data() == b"<html>app</html>"
@@ -0,0 +1,130 @@
+import sqlite3
+import threading
+
+from flask_jwt_extended import create_access_token
+import pytest
+import sqlalchemy
+
+from tests.conftest import add_user
+from web import writes
+from web.base import app, database
+from web.exceptions import SonataException
+from web.models import Tag, User
+from web.writes import WriteCoordinator, run_write
+
+
+@pytest.fixture()
+def user_id(app_context):  # pylint: disable=unused-argument
+    new_user_id = add_user().id
+    # Loading the id began a transaction, which would hold the only writer connection
+    database.session.commit()
+    return new_user_id
+
+
+@pytest.fixture()
+def coordinator():
+    write_coordinator = WriteCoordinator(app, max_batch=64, max_delay=0.2, busy_retries=2,
+                                         busy_backoff=0.001)
+    yield write_coordinator
+    write_coordinator.stop()
+
+
+def _add_tag(user_id: int, name: str):
+    tag = Tag(user_id=user_id, tag=name, color="red")  # type: ignore
+    database.session.add(tag)
+    database.session.flush()
+    return tag.to_dict()
+
+
+def test_group_commit_returns_each_result(user_id, coordinator):
+    futures = [coordinator.submit(lambda i=i: _add_tag(user_id, f"tag {i}")) for i in range(10)]
+    futures.append(coordinator.submit(lambda: _add_tag(user_id, "tag 0")))
+
+    assert [future.result()["tag"] for future in futures[:10]] == [f"tag {i}" for i in range(10)]
+    with pytest.raises(sqlalchemy.exc.IntegrityError):
+        futures[10].result()
+    assert Tag.query.filter_by(user_id=user_id).count() == 10
+    assert coordinator.stats()["batches"] < 11
+    assert coordinator.stats()["units"] == 11
+
+
+def test_retries_locked_database(user_id, coordinator):
+    attempts = []
+
+    def unit():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise sqlalchemy.exc.OperationalError(
+                "INSERT", {}, sqlite3.OperationalError("database is locked"))
+        return _add_tag(user_id, "retried")
+
+    assert coordinator.submit(unit).result()["tag"] == "retried"
+    assert len(attempts) == 2
+    assert coordinator.stats()["busy_retries"] == 1
+
+
+def test_run_write_maps_conflicts_per_request(user_id, coordinator, monkeypatch):
+    monkeypatch.setattr(writes, "write_coordinator", coordinator)
+    client = app.test_client()
+    headers = {'Authorization': f'Bearer {create_access_token(identity="user@example.com")}'}
+    responses = []
+
+    def add(name: str):
+        with app.app_context():
+            responses.append(client.post('/api/tags/add', json={
+                'tag': name, 'color': 'blue'}, headers=headers))
+
+    threads = [threading.Thread(target=add, args=(name,))
+               for name in ["first", "second", "first"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(response.status_code for response in responses) == [200, 200, 400]
+    conflict, = [response for response in responses if response.status_code == 400]
+    assert conflict.get_data(as_text=True) == "A tag with this name already exists!"
+    assert {tag.tag for tag in Tag.query.filter_by(user_id=user_id)} == {"first", "second"}
+
+
+def test_run_write_times_out_when_the_writer_is_busy(user_id, coordinator, monkeypatch):
+    monkeypatch.setattr(writes, "write_coordinator", coordinator)
+    monkeypatch.setitem(app.config, "WRITE_TIMEOUT_S", 0.1)
+    release = threading.Event()
+    blocking = coordinator.submit(release.wait)
+
+    with pytest.raises(SonataException) as error:
+        run_write(lambda: _add_tag(user_id, "late"), "conflict")
+    assert error.value.code == 503
+
+    release.set()
+    assert blocking.result()
+    coordinator.stop()
+    # The unit of the caller that gave up is not applied
+    assert Tag.query.filter_by(user_id=user_id).count() == 0
+    assert coordinator.stats()["units"] == 1
+
+
+def _can_take_write_lock() -> bool:
+    other = sqlite3.connect(str(database.engine.url.database), timeout=0, isolation_level=None)
+    try:
+        other.execute("BEGIN IMMEDIATE")
+        other.execute("ROLLBACK")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        other.close()
+
+
+def test_only_units_of_work_take_the_write_lock(user_id):
+    assert database.session.get(User, user_id) is not None
+    assert _can_take_write_lock()
+
+    def unit():
+        locked = not _can_take_write_lock()
+        _add_tag(user_id, "written")
+        return locked
+
+    assert run_write(unit, "conflict")
+    assert _can_take_write_lock()
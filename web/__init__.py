@@ -1,2 +1,6 @@
+# Imported first, so its request hooks wrap the others
+from .instrumentation import *
 from .models import *
 from .api import *
+from .commands import *
+from .spa import *
@@ -2,3 +2,6 @@ from .auth import *
 from .tags import *
 from .pieces import *
 from .files import *
+from .health import *
+from .sync import *
+from .metrics import *
@@ -1,18 +1,24 @@
-import hashlib
 import random
 from string import printable
 from typing import Any, Dict, List
 
 from flask import request, jsonify
-from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required
+from flask_jwt_extended import create_access_token, jwt_required
 import sqlalchemy
+from sqlalchemy.orm import selectinload
 
+from web.api.identity import get_current_user, identity_claims
 from web.base import app, database
+from web.database_config import read_only
+from web.etags import conditional
 from web.api.utils import get_json_keys
 from web.exceptions import SonataException, SonataUnauthorizedException
+from web.models.piece import Piece
 from web.models.tags import Tag
 from web.models.user import User
 from web.api.result import Result
+from web.passwords import hash_password, verify_password
+from web.writes import run_write
 
 _SALT_SIZE = 32
 
@@ -36,12 +42,28 @@ def _generate_new_salt() -> str:
     return "".join(random.choices(printable, k=_SALT_SIZE))
 
 
-def _get_hash(password: str, salt: str) -> str:
-    return hashlib.md5(password.encode() + salt.encode()).hexdigest()
+# Skipped when the password was changed since it was verified
+def _store_rehash(user_id: int, old_hash: str, new_hash: str):
+    database.session.execute(sqlalchemy.update(User).where(
+        User.id == user_id, User.password_hash == old_hash).values(password_hash=new_hash))
 
 
-def _check_password(password: str, salt: str, hashed: str):
-    return _get_hash(password, salt) == hashed
+def _check_password(user: User, password: str) -> bool:
+    user_id, old_hash = user.id, user.password_hash
+    matches, new_hash = verify_password(password, user.salt, old_hash)
+    if new_hash is not None:
+        run_write(lambda: _store_rehash(user_id, old_hash, new_hash),
+                  "The password was changed meanwhile")
+    return matches
+
+
+def _load_full_user(user: User) -> User:
+    tags = selectinload(User.tags)
+    pieces = selectinload(User.pieces).joinedload(Piece.tags)  # type: ignore
+    return User.query \
+        .options(tags, pieces) \
+        .filter_by(id=user.id) \
+        .one()
 
 
 def _get_full_user_dict(user: User) -> Dict[str, Any]:
@@ -65,7 +87,9 @@ def _insert_new_user(user: User) -> User:
             400, "A user with this email already exists") from e
 
 
+# Only a password rehash writes, so the lookup stays off the write lock while hashing
 @app.route("/api/auth/login", methods=["POST"])
+@read_only
 def auth_login():
     result: Result[List[str]] = Result.instantiate(
         lambda: get_json_keys(request, ["email", "password"])
@@ -79,10 +103,14 @@ def auth_login():
         return user_result.response_value
 
     user = user_result.value
-    if not _check_password(password, user.salt, user.password_hash):
+    check_result = Result.instantiate(lambda: _check_password(user, password))
+    if not check_result.is_ok:
+        return check_result.response_value
+    if not check_result.value:
         return "Invalid credentials", 401
 
-    access_token = create_access_token(identity=user.email)
+    access_token = create_access_token(
+        identity=user.email, additional_claims=identity_claims(user))
     return jsonify(access_token=access_token)
 
 
@@ -95,19 +123,20 @@ def auth_register():
         return result.response_value
     email, name, password = result.value
     salt = _generate_new_salt()
-    password = _get_hash(password, salt)
-    user = User(email=email, name=name, password_hash=password,
-                salt=salt, tags=_get_base_tags())  # type: ignore
-    return Result(user, 200) \
+    return Result.instantiate(lambda: hash_password(password, salt)) \
+        .bind(lambda x: User(email=email, name=name, password_hash=x,  # type: ignore
+                             salt=salt, tags=_get_base_tags())) \
         .bind(_insert_new_user) \
-        .bind(lambda x: create_access_token(x.email)) \
+        .bind(lambda x: create_access_token(x.email, additional_claims=identity_claims(x))) \
         .jsonify("access_token")
 
 
 @app.route("/api/auth/current_user")
 @jwt_required()
+@read_only
+@conditional
 def auth_current_user():
-    return Result.instantiate(get_jwt_identity) \
-        .bind(get_user_by_email) \
+    return Result.instantiate(get_current_user) \
+        .bind(_load_full_user) \
         .bind(_get_full_user_dict) \
         .jsonify()
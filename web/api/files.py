@@ -1,17 +1,34 @@
+import hashlib
 import io
-from typing import List
+import pathlib
+import threading
+from typing import Any, Callable, Dict, IO, List, Optional, Tuple
 from flask import request, send_file
-from flask_jwt_extended import get_jwt_identity, jwt_required
+from flask_jwt_extended import jwt_required
 from werkzeug.datastructures.file_storage import FileStorage
 import sqlalchemy
 
-from web.api.auth import get_user_by_email
-from web.api.pieces import get_piece_by_id
+from web.api.identity import get_current_user
+from web.api.pieces import PIECE_CONFLICT_MESSAGE, get_piece_by_id, piece_and_user_ids
 from web.api.result import Result
 from web.api.utils import get_data_keys, get_json_keys
-from web.base import app, database, hasher, cache
-from web.exceptions import SonataAlreadyExistsException, SonataException, SonataNotFoundException
-from web.models import User, Piece, File
+from web.base import app, database, file_cache, storage
+from web.database_config import read_only
+from web.exceptions import (SonataException, SonataInvalidParametersException,
+                            SonataNotFoundException)
+from web.file_cache import CachedFile
+from web.file_refs import ReleasedFile, find_file, release_files, released_files
+from web.ids import decode_id
+from web.models import User, Piece, File, UploadSession
+from web.storage import StoredBlob
+from web.writes import run_write
+
+_MAX_FILE_SIZE = 30 * (1024 * 1024)
+_UPLOAD_READ_SIZE = 64 * 1024
+
+# Running SHA-256 of each chunked upload this worker received, with the offset it covers
+_upload_digests: Dict[int, Tuple[int, Any]] = {}
+_upload_digests_lock = threading.Lock()
 
 
 def _get_file_by_id(file_id: int) -> File:
@@ -21,54 +38,198 @@ def _get_file_by_id(file_id: int) -> File:
     raise SonataNotFoundException(f"File with ID {file_id} not found")
 
 
-def _commit_piece_changes():
-    try:
-        database.session.commit()
-    except sqlalchemy.exc.IntegrityError as e:
-        database.session.rollback()
-        raise SonataAlreadyExistsException(
-            "A piece with this name already exists for this instrument!") from e
-
-
-def _upload_file(file: FileStorage) -> File:
-    new_file = File(content=file.read(),
-                    file_type=file.content_type)  # type: ignore
+# Content that is already stored is shared with the existing row instead of adding another
+def _store_blob(blob: StoredBlob, file_type: str) -> File:
+    existing = find_file(blob.sha256, file_type)
+    if existing is not None:
+        return existing
+    new_file = File(file_type=file_type, size=blob.size,
+                    sha256=blob.sha256, path=blob.path)  # type: ignore
     database.session.add(new_file)
-    database.session.commit()
+    database.session.flush()
     return new_file
 
 
-def _edit_piece(user: User, new_piece: Piece):
-    piece: Piece = get_piece_by_id(new_piece.id)
-    if piece.user_id != user.id:
+# Links a newly stored blob to the piece, or unlinks its file when there is no blob.
+# Returns the piece and the file it no longer uses, for cleaning up once committed
+def _set_piece_file(user_id: int, piece_id: int, file_type: str, blob: Optional[StoredBlob]
+                    ) -> Tuple[Dict[str, Any], List[ReleasedFile]]:
+    piece: Piece = get_piece_by_id(piece_id)
+    if piece.user_id != user_id:
         raise SonataNotFoundException(
             f"Piece with ID {piece.id} not found for this user")
 
-    piece.file_type = new_piece.file_type
-    if new_piece.file_id is None and piece.file_id is not None:
-        file = piece.file
-        database.session.delete(file)
-        cache.delete(f"file_{file.id}")
-    piece.file_id = new_piece.file_id
-    _commit_piece_changes()
+    released = released_files([piece.file_id])
+    piece.file_type = file_type
+    piece.file_id = _store_blob(blob, file_type).id if blob is not None else None
+    database.session.flush()
+    return piece.to_dict(), [file for file in released if file[0] != piece.file_id]
+
+
+def _edit_piece(unit: Callable[[], Tuple[Dict[str, Any], List[ReleasedFile]]]
+                ) -> Dict[str, Any]:
+    piece, released = run_write(unit, PIECE_CONFLICT_MESSAGE)
+    release_files(released)
     return piece
 
 
-def _check_file_size(file: FileStorage):
-    max_file_size = 30 * (1024 * 1024)
+def _read_file_content(file: File) -> bytes:
+    if file.path is None:
+        if isinstance(file.content, str):
+            return file.content.encode()
+        return file.content
+    with storage.open(file.path) as stored:
+        return stored.read()
+
 
+def _raise_file_too_large(size: int):
+    raise SonataException(
+        400, f"File too large! ({size / (1024*1024)}MB > 30MB)")
+
+
+def _check_file_size(file: FileStorage):
     file.seek(0, 2)
     size = file.tell()
     file.seek(0)
-    if size > max_file_size:
-        raise SonataException(
-            400, f"File too large! ({size / (1024*1024)}MB > 30MB)")
+    if size > _MAX_FILE_SIZE:
+        _raise_file_too_large(size)
     return file
 
 
-def _to_piece(piece_id: int, uploaded_file: FileStorage, stored_file: File) -> Piece:
-    return Piece(id=piece_id, file_id=stored_file.id,
-                 file_type=uploaded_file.content_type)  # type: ignore
+def _get_upload_session(user: User, upload_id: int) -> UploadSession:
+    upload = UploadSession.query.filter_by(id=upload_id).first()
+    if upload is None or upload.user_id != user.id:
+        raise SonataNotFoundException(
+            f"Upload with ID {upload_id} not found for this user")
+    return upload
+
+
+def _check_upload_size(size: Optional[int]):
+    if size is not None and size > _MAX_FILE_SIZE:
+        _raise_file_too_large(size)
+    return size
+
+
+# The size a client declares when it starts an upload is optional
+def _check_declared_size(size: Any) -> Optional[int]:
+    if size is None:
+        return None
+    if isinstance(size, bool) or not isinstance(size, int) or size < 0:
+        raise SonataInvalidParametersException("Invalid size")
+    return _check_upload_size(size)
+
+
+def _start_upload(user: User, piece_id: int, file_type: str, size: Any):
+    _check_declared_size(size)
+    piece: Piece = get_piece_by_id(piece_id)
+    if piece.user_id != user.id:
+        raise SonataNotFoundException(
+            f"Piece with ID {piece.id} not found for this user")
+
+    upload = UploadSession(user_id=user.id, piece_id=piece.id,
+                           file_type=file_type)  # type: ignore
+    database.session.add(upload)
+    database.session.commit()
+    storage.temp_path(upload.temp_name).touch()
+    with _upload_digests_lock:
+        _upload_digests[upload.id] = (0, hashlib.sha256())
+    return upload
+
+
+def _discard_upload(upload: UploadSession):
+    with _upload_digests_lock:
+        _upload_digests.pop(upload.id, None)
+    storage.temp_path(upload.temp_name).unlink(missing_ok=True)
+    database.session.delete(upload)
+    database.session.commit()
+
+
+# Returns the size of the file with the chunk, which stops growing once it is too large
+def _append_chunk(path: pathlib.Path, size: int, stream: IO[bytes], digest: Any) -> int:
+    with open(path, "r+b") as temp:
+        # Drops any bytes left over from an interrupted attempt at this chunk
+        temp.truncate(size)
+        temp.seek(size)
+        while chunk := stream.read(_UPLOAD_READ_SIZE):
+            size += len(chunk)
+            if size > _MAX_FILE_SIZE:
+                break
+            temp.write(chunk)
+            if digest is not None:
+                digest.update(chunk)
+    return size
+
+
+def _write_chunk(upload: UploadSession, index: int, stream: IO[bytes]):
+    if index < upload.next_chunk:
+        return upload
+    if index > upload.next_chunk:
+        raise SonataException(
+            400, f"Expected chunk {upload.next_chunk}, got chunk {index}")
+    upload_id, size, temp_name = upload.id, upload.received_size, upload.temp_name
+    # The body may take long to arrive, so no transaction is kept open while it is read
+    database.session.commit()
+
+    with _upload_digests_lock:
+        offset, digest = _upload_digests.get(upload_id, (-1, None))
+    # The digest only lives in the worker that received the previous chunks
+    digest = digest.copy() if digest is not None and offset == size else None
+
+    try:
+        size = _append_chunk(storage.temp_path(temp_name), size, stream, digest)
+    except FileNotFoundError as e:
+        # Finalized or expired since it was loaded
+        raise SonataNotFoundException(f"Upload with ID {upload_id} not found") from e
+
+    if size > _MAX_FILE_SIZE:
+        _discard_upload(upload)
+        _raise_file_too_large(size)
+
+    # Another attempt at the same chunk may have finished first
+    written = database.session.execute(sqlalchemy.update(UploadSession).where(
+        UploadSession.id == upload_id, UploadSession.next_chunk == index
+    ).values(received_size=size, next_chunk=index + 1)).rowcount
+    database.session.commit()
+    if written and digest is not None:
+        with _upload_digests_lock:
+            _upload_digests[upload_id] = (size, digest)
+    current = database.session.get(UploadSession, upload_id)
+    if current is None:
+        raise SonataNotFoundException(f"Upload with ID {upload_id} not found")
+    return current
+
+
+def _finish_upload(upload: UploadSession) -> StoredBlob:
+    upload_id, size, temp_name = upload.id, upload.received_size, upload.temp_name
+    # Hashing the file may take long, so no transaction is kept open meanwhile
+    database.session.commit()
+    with _upload_digests_lock:
+        offset, digest = _upload_digests.pop(upload_id, (-1, None))
+    sha256 = digest.hexdigest() if digest is not None and offset == size else None
+    try:
+        return storage.save_file(storage.temp_path(temp_name), sha256)
+    except FileNotFoundError as e:
+        # Finalized by another request
+        raise SonataNotFoundException(f"Upload with ID {upload_id} not found") from e
+
+
+def _attach_upload(user_id: int, upload_id: int, piece_id: int, file_type: str,
+                   blob: StoredBlob):
+    database.session.execute(sqlalchemy.delete(UploadSession).where(
+        UploadSession.id == upload_id))
+    return _set_piece_file(user_id, piece_id, file_type, blob)
+
+
+def _attach_finished_upload(user_id: int, upload_id: int, piece_id: int, file_type: str,
+                            blob: StoredBlob) -> Dict[str, Any]:
+    try:
+        return _edit_piece(lambda: _attach_upload(user_id, upload_id, piece_id, file_type, blob))
+    except SonataException:
+        # The received bytes were moved into the store, so the upload can not be finalized again
+        database.session.execute(sqlalchemy.delete(UploadSession).where(
+            UploadSession.id == upload_id))
+        database.session.commit()
+        raise
 
 
 @app.route("/api/files/upload_link", methods=["POST"])
@@ -80,18 +241,13 @@ def files_upload_link():
     if not result.is_ok:
         return result
     piece_id_hash, link = result.value
-    piece_id, = hasher.decode(piece_id_hash)  # type: ignore
-
-    user_result = Result.instantiate(get_jwt_identity) \
-        .bind(get_user_by_email)
-
-    if not user_result.is_ok:
-        return result
-    user = user_result.value
+    ids_result = Result.instantiate(lambda: piece_and_user_ids(piece_id_hash))
+    if not ids_result.is_ok:
+        return ids_result
+    piece_id, user_id = ids_result.value
 
-    new_piece = Piece(user_id=-1, id=piece_id, file_type=link)  # type: ignore
-    return Result.instantiate(lambda: _edit_piece(user, new_piece)) \
-        .bind(lambda x: x.to_dict()) \
+    return Result.instantiate(lambda: _edit_piece(
+        lambda: _set_piece_file(user_id, piece_id, link, None))) \
         .jsonify()
 
 
@@ -103,42 +259,124 @@ def files_upload_file():
     )
     if not request.files or not result.is_ok:
         return "Missing fields", 400
-    print(f"{request.files=}")
     file = request.files["file"]
     piece_id_hash, = result.value
-    piece_id, = hasher.decode(piece_id_hash)  # type: ignore
-
-    user_result = Result.instantiate(get_jwt_identity) \
-        .bind(get_user_by_email)
-    if not user_result.is_ok:
-        return result
-    user = user_result.value
+    ids_result = Result.instantiate(lambda: piece_and_user_ids(piece_id_hash))
+    if not ids_result.is_ok:
+        return ids_result
+    piece_id, user_id = ids_result.value
+    file_type = file.content_type
 
     return Result(file, 200) \
         .bind(_check_file_size) \
-        .bind(_upload_file) \
-        .bind(lambda x: _to_piece(piece_id, file, x)) \
-        .bind(lambda x: _edit_piece(user, x)) \
+        .bind(lambda x: storage.save(x.stream)) \
+        .bind(lambda x: _edit_piece(lambda: _set_piece_file(user_id, piece_id, file_type, x))) \
+        .jsonify()
+
+
+@app.route("/api/files/uploads", methods=["POST"])
+@jwt_required()
+def files_start_upload():
+    result: Result[List[Any]] = Result.instantiate(
+        lambda: get_json_keys(request, ["id", "file_type"])
+    )
+    if not result.is_ok:
+        return result
+    piece_id_hash, file_type = result.value
+    piece_id_result = Result.instantiate(lambda: decode_id(piece_id_hash, "Piece"))
+    if not piece_id_result.is_ok:
+        return piece_id_result
+    piece_id = piece_id_result.value
+    size = (request.get_json() or {}).get("size")
+
+    return Result.instantiate(get_current_user) \
+        .bind(lambda x: _start_upload(x, piece_id, file_type, size)) \
+        .bind(lambda x: x.to_dict()) \
+        .jsonify()
+
+
+@app.route("/api/files/uploads/<string:hashed_id>", methods=["GET"])
+@jwt_required()
+@read_only
+def files_get_upload(hashed_id: str):
+    upload_id_result = Result.instantiate(lambda: decode_id(hashed_id, "Upload"))
+    if not upload_id_result.is_ok:
+        return upload_id_result
+    upload_id = upload_id_result.value
+    return Result.instantiate(get_current_user) \
+        .bind(lambda x: _get_upload_session(x, upload_id)) \
         .bind(lambda x: x.to_dict()) \
         .jsonify()
 
 
+@app.route("/api/files/uploads/<string:hashed_id>/<int:index>", methods=["PUT"])
+@jwt_required()
+def files_upload_chunk(hashed_id: str, index: int):
+    upload_id_result = Result.instantiate(lambda: decode_id(hashed_id, "Upload"))
+    if not upload_id_result.is_ok:
+        return upload_id_result
+    upload_id = upload_id_result.value
+
+    return Result(request.content_length, 200) \
+        .bind(_check_upload_size) \
+        .bind(lambda _: get_current_user()) \
+        .bind(lambda x: _get_upload_session(x, upload_id)) \
+        .bind(lambda x: _write_chunk(x, index, request.stream)) \
+        .bind(lambda x: x.to_dict()) \
+        .jsonify()
+
+
+@app.route("/api/files/uploads/<string:hashed_id>/finalize", methods=["POST"])
+@jwt_required()
+def files_finalize_upload(hashed_id: str):
+    upload_id_result = Result.instantiate(lambda: decode_id(hashed_id, "Upload"))
+    if not upload_id_result.is_ok:
+        return upload_id_result
+    upload_id = upload_id_result.value
+
+    user_result = Result.instantiate(get_current_user)
+    if not user_result.is_ok:
+        return user_result.response_value
+    user = user_result.value
+    user_id = user.id
+
+    upload_result = Result.instantiate(
+        lambda: _get_upload_session(user, upload_id))
+    if not upload_result.is_ok:
+        return upload_result.response_value
+    piece_id = upload_result.value.piece_id
+    file_type = upload_result.value.file_type
+
+    return upload_result \
+        .bind(_finish_upload) \
+        .bind(lambda x: _attach_finished_upload(user_id, upload_id, piece_id, file_type, x)) \
+        .jsonify()
+
+
 @app.route("/api/files/file/<string:hashed_id>", methods=["GET"])
+@read_only
 def get_file(hashed_id: str):
     try:
-        file_id, = hasher.decode(hashed_id)  # type: ignore
-        file_response = cache.get(f"file_{file_id}")
-        if file_response is None:
+        file_id = decode_id(hashed_id, "File")
+        cached = file_cache.get(file_id)
+        if cached is None:
             file = _get_file_by_id(file_id)
-            if file.content is str:
-                file.content = file.content.encode()
-            file_response = send_file(
-                io.BytesIO(file.content),
-                as_attachment=False,
-                mimetype=file.file_type,
-            )
-            cache.set(f"file_{file_id}", file_response)
-
-        return file_response
+            if file.path is not None and not file_cache.cacheable(file.size):
+                return send_file(
+                    storage.local_path(file.path),
+                    as_attachment=False,
+                    mimetype=file.file_type,
+                    etag=file.sha256,
+                )
+            cached = CachedFile(_read_file_content(file),
+                                file.file_type, file.sha256)
+            file_cache.set(file_id, cached)
+
+        return send_file(
+            io.BytesIO(cached.content),
+            as_attachment=False,
+            mimetype=cached.mimetype,
+            etag=cached.etag or False,
+        )
     except SonataException as e:
         return e.error_message, e.code
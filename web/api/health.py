@@ -0,0 +1,20 @@
+from flask import jsonify
+
+from web.base import app, database
+from web.compression import response_compressor
+from web.database_config import database_health, reader_engine
+from web.maintenance import maintenance_worker
+from web import writes
+
+
+@app.route("/api/health", methods=["GET"])
+def health():
+    status = {
+        "status": "ok",
+        "database": database_health(database.engine, reader_engine(app, database.engine)),
+        "compression": response_compressor.stats(),
+        "maintenance": maintenance_worker.stats(),
+    }
+    if writes.write_coordinator is not None:
+        status["writes"] = writes.write_coordinator.stats()
+    return jsonify(status)
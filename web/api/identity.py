@@ -0,0 +1,109 @@
+from typing import Any, Dict, Optional, Set
+
+from flask import g
+from flask_jwt_extended import get_jwt, get_jwt_identity
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from web.base import app, database
+from web.exceptions import SonataUnauthorizedException
+from web.models.user import User
+from web.ttl_cache import TTLCache
+
+_USER_ID_CLAIM = "uid"
+
+# Credentials are left out of the cache, a restored user loads them on access
+_UNCACHED_COLUMNS = {"password_hash", "salt"}
+
+# Column values of recently resolved users, keyed by their JWT identity
+_user_cache: TTLCache[Dict[str, Any]] = TTLCache(
+    app.config["USER_CACHE_SIZE"], app.config["USER_CACHE_TTL"])
+
+
+def identity_claims(user: User) -> Dict[str, Any]:
+    return {_USER_ID_CLAIM: user.id}
+
+
+def jwt_user_id() -> Optional[int]:
+    return get_jwt().get(_USER_ID_CLAIM)
+
+
+def _snapshot(user: User) -> Dict[str, Any]:
+    return {column.key: getattr(user, column.key)
+            for column in User.__mapper__.column_attrs
+            if column.key not in _UNCACHED_COLUMNS}
+
+
+def _restore(state: Dict[str, Any]) -> User:
+    user = User(**state)
+    make_transient_to_detached(user)
+    return database.session.merge(user, load=False)
+
+
+# For units of work, which only get the id of the current user. The user may have been deleted
+# since it was resolved
+def get_user_by_id(user_id: int) -> User:
+    user = database.session.get(User, user_id)
+    if user is None:
+        raise SonataUnauthorizedException("Invalid Credentials")
+    return user
+
+
+def _load_user(identity: str) -> User:
+    user_id = jwt_user_id()
+    user = database.session.get(User, user_id) if user_id else None
+    if user is None or user.email != identity:
+        user = User.query.filter_by(email=identity).first()
+    if user is None:
+        raise SonataUnauthorizedException("Invalid Credentials")
+    return user
+
+
+def get_current_user() -> User:
+    identity = get_jwt_identity()
+    current_user = g.get("current_user")
+    if current_user is not None and g.current_user_identity == identity:
+        return current_user
+
+    state = _user_cache.get(identity)
+    if state is not None:
+        user = _restore(state)
+    else:
+        user = _load_user(identity)
+        _user_cache.set(identity, _snapshot(user))
+
+    g.current_user = user
+    g.current_user_identity = identity
+    return user
+
+
+def invalidate_user(user_id: int, email: str):
+    _user_cache.delete_where(
+        lambda identity, state: identity == email or state["id"] == user_id)
+
+
+@app.teardown_request
+def _forget_current_user(_):
+    g.pop("current_user", None)
+    g.pop("current_user_identity", None)
+
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_flushed_users(session: Session, _):
+    changed: Set = session.info.setdefault("changed_users", set())
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(instance, User):
+            changed.add((instance.id, instance.email))
+            invalidate_user(instance.id, instance.email)
+
+
+# Invalidated again on commit, in case another request cached the old row in between
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed_users(session: Session):
+    for user_id, email in session.info.pop("changed_users", ()):
+        invalidate_user(user_id, email)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_users(session: Session):
+    session.info.pop("changed_users", None)
@@ -0,0 +1,45 @@
+import hmac
+from typing import List
+
+from flask import Response, request
+
+from web.api.result import Result
+from web.base import app, file_cache
+from web.compression import response_compressor
+from web.exceptions import SonataNotFoundException, SonataUnauthorizedException
+from web.instrumentation import format_stats, metrics_exporter, request_metrics
+from web.maintenance import maintenance_worker
+from web.passwords import hashing_pool
+from web import writes
+
+
+# The metrics of this process
+def collect_metrics() -> List[str]:
+    lines = request_metrics.render()
+    lines += format_stats("sonata_file_cache", file_cache.stats())
+    lines += format_stats("sonata_hashing_pool", hashing_pool.stats())
+    lines += format_stats("sonata_compression", response_compressor.stats())
+    lines += format_stats("sonata_maintenance", maintenance_worker.stats())
+    if writes.write_coordinator is not None:
+        lines += format_stats("sonata_writes", writes.write_coordinator.stats())
+    return lines
+
+
+def _check_metrics_token():
+    token = app.config["METRICS_TOKEN"]
+    if not token:
+        raise SonataNotFoundException("Not found")
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+        raise SonataUnauthorizedException("Invalid Credentials")
+
+
+# Counters are kept per process. With METRICS_DIR set, the samples of every server worker are
+# returned, labelled with its pid
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    checked = Result.instantiate(_check_metrics_token)
+    if not checked.is_ok:
+        return checked.response_value
+    lines = metrics_exporter.collect(collect_metrics)
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
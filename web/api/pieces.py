@@ -1,20 +1,33 @@
-from typing import Any, List
+import base64
+import json
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
 from flask import request
-from flask_jwt_extended import get_jwt_identity, jwt_required
+from flask_jwt_extended import jwt_required
 import sqlalchemy
-from web.api.auth import get_user_by_email
+from sqlalchemy.orm import selectinload
+from web.api.identity import get_current_user, get_user_by_id
 from web.api.result import Result
-from web.api.tags import get_tag_by_id
-from web.api.utils import get_json_keys
-from web.base import app, database, hasher
-from web.exceptions import SonataAlreadyExistsException, SonataNotFoundException
+from web.api.tags import decode_tag_ids, get_user_tags, pick_tags, resolve_tags
+from web.api.utils import get_dict_keys, get_json_keys, parse_int
+from web.base import app, database
+from web.database_config import read_only
+from web.etags import conditional
+from web.exceptions import SonataException, SonataInvalidParametersException, \
+    SonataNotFoundException
+from web.file_refs import ReleasedFile, release_files, released_files
+from web.ids import decode_id, try_decode_id
 from web.models.piece import Piece
-from web.models.tags import Tag
+from web.models.tags import Tag, pieces_tags
 from web.models.user import User
+from web.search import search_pieces
+from web.stats import get_piece_stats
+from web.writes import run_write
 
-
-def _decode_tags(tag_ids_str: List[str]) -> List[int]:
-    return [hasher.decode(tag)[0] for tag in tag_ids_str]  # type: ignore
+_DEFAULT_PAGE_SIZE = 50
+_MAX_PAGE_SIZE = 200
+_DEFAULT_SEARCH_SIZE = 20
+_SORT_COLUMNS = {"added_at": Piece.added_at, "name": Piece.name}
+PIECE_CONFLICT_MESSAGE = "A piece with this name already exists for this instrument!"
 
 
 def get_piece_by_id(piece_id: int):
@@ -24,55 +37,294 @@ def get_piece_by_id(piece_id: int):
     raise SonataNotFoundException(f"Piece with ID {piece_id} not found")
 
 
-def _get_tags(user: User, tag_ids: List[int]) -> List[Tag]:
-    tags = []
-    for tag_id in tag_ids:
-        tag = get_tag_by_id(tag_id)
-        if tag.user_id != user.id:
-            raise SonataNotFoundException(
-                f"Tag with id {tag_id} not found for user")
-        tags.append(tag)
-    return tags
-
+# For views that hand both to a unit of work, which runs outside of the request
+def piece_and_user_ids(piece_id_hash: str) -> Tuple[int, int]:
+    return decode_id(piece_id_hash, "Piece"), get_current_user().id
 
-def _commit_piece_changes():
-    try:
-        database.session.commit()
-    except sqlalchemy.exc.IntegrityError as e:
-        database.session.rollback()
-        raise SonataAlreadyExistsException(
-            "A piece with this name already exists for this instrument!") from e
 
-
-def _edit_piece(user: User, new_piece: Piece):
-    piece: Piece = get_piece_by_id(new_piece.id)
-    if piece.user_id != user.id:
+def _get_user_piece(user_id: int, piece_id: int) -> Piece:
+    piece: Piece = get_piece_by_id(piece_id)
+    if piece.user_id != user_id:
         raise SonataNotFoundException(
             f"Piece with ID {piece.id} not found for this user")
+    return piece
+
+
+def _edit_piece(user_id: int, new_piece: Piece, tag_id_hashes: List[str]) -> Dict[str, Any]:
+    tags = resolve_tags(get_user_by_id(user_id), tag_id_hashes)
+    piece = _get_user_piece(user_id, new_piece.id)
 
     piece.name = new_piece.name
     piece.description = new_piece.description
-    piece.tags = new_piece.tags  # type: ignore
+    piece.tags = tags  # type: ignore
     piece.state = new_piece.state
     piece.instrument = new_piece.instrument
-    _commit_piece_changes()
-    return piece
+    database.session.flush()
+    return piece.to_dict()
 
 
-def _add_piece(piece: Piece):
+def _add_piece(user_id: int, piece: Piece, tag_id_hashes: List[str]) -> Dict[str, Any]:
+    piece.tags = resolve_tags(get_user_by_id(user_id), tag_id_hashes)  # type: ignore
+    piece.user_id = user_id
     database.session.add(piece)
-    _commit_piece_changes()
-    return piece
+    database.session.flush()
+    return piece.to_dict()
 
 
-def _delete_piece(user: User, piece_id: int):
-    piece: Piece = get_piece_by_id(piece_id)
-    if piece.user_id != user.id:
-        raise SonataNotFoundException(
-            f"Piece with ID {piece.id} not found for this user")
+def _delete_piece(user_id: int, piece_id: int) -> List[ReleasedFile]:
+    piece = _get_user_piece(user_id, piece_id)
+    released = released_files([piece.file_id])
     database.session.delete(piece)
-    database.session.commit()
-    return ""
+    return released
+
+
+def _release(result: Tuple[Any, List[ReleasedFile]]) -> Any:
+    value, released = result
+    release_files(released)
+    return value
+
+
+def _encode_cursor(sort_value: str, piece_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([sort_value, piece_id]).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> List[Any]:
+    try:
+        sort_value, piece_id = json.loads(base64.urlsafe_b64decode(cursor))
+        return [str(sort_value), int(piece_id)]
+    except (ValueError, TypeError) as e:
+        raise SonataInvalidParametersException("Invalid cursor") from e
+
+
+def _get_page_size(limit: Optional[str], default: int = _DEFAULT_PAGE_SIZE) -> int:
+    if limit is None:
+        return default
+    return max(1, min(parse_int(limit, "limit"), _MAX_PAGE_SIZE))
+
+
+def _list_pieces(user: User, args: Dict[str, str]) -> Dict[str, Any]:
+    sort = args.get("sort", "added_at")
+    order = args.get("order", "desc" if sort == "added_at" else "asc")
+    if sort not in _SORT_COLUMNS or order not in ("asc", "desc"):
+        raise SonataInvalidParametersException("Invalid sort order")
+    page_size = _get_page_size(args.get("limit"))
+    # Compared as the stored text so the cursor round-trips the exact column value
+    sort_column = sqlalchemy.type_coerce(_SORT_COLUMNS[sort], sqlalchemy.String)
+
+    query = Piece.query.filter(Piece.user_id == user.id)
+    if "instrument" in args:
+        query = query.filter(Piece.instrument == args["instrument"])
+    if "state" in args:
+        query = query.filter(Piece.state == parse_int(args["state"], "state"))
+    if args.get("tag_ids"):
+        tag_ids = {decode_id(tag_id, "Tag") for tag_id in args["tag_ids"].split(",")}
+        tagged_piece_ids = sqlalchemy.select(pieces_tags.c.piece_id) \
+            .where(pieces_tags.c.tag_id.in_(tag_ids)) \
+            .group_by(pieces_tags.c.piece_id) \
+            .having(sqlalchemy.func.count(sqlalchemy.distinct(pieces_tags.c.tag_id))
+                    == len(tag_ids))
+        query = query.filter(Piece.id.in_(tagged_piece_ids))
+
+    key = sqlalchemy.tuple_(sort_column, Piece.id)
+    if args.get("cursor"):
+        after = sqlalchemy.tuple_(*_decode_cursor(args["cursor"]))
+        query = query.filter(key < after if order == "desc" else key > after)
+    if order == "desc":
+        query = query.order_by(sort_column.desc(), Piece.id.desc())
+    else:
+        query = query.order_by(sort_column.asc(), Piece.id.asc())
+
+    rows = query.add_columns(sort_column) \
+        .options(selectinload(Piece.tags)) \
+        .limit(page_size + 1) \
+        .all()  # type: ignore
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last_piece, last_sort_value = rows[-1]
+        next_cursor = _encode_cursor(last_sort_value, last_piece.id)
+    return {
+        "pieces": [piece.to_dict() for piece, _ in rows],
+        "next_cursor": next_cursor
+    }
+
+
+@app.route("/api/pieces", methods=["GET"])
+@jwt_required()
+@read_only
+@conditional
+def pieces_list():
+    return Result.instantiate(get_current_user) \
+        .bind(lambda x: _list_pieces(x, request.args)) \
+        .jsonify()
+
+
+def _search_pieces(user: User, args: Dict[str, str]) -> Dict[str, Any]:
+    query = args.get("q", "").strip()
+    if not query:
+        raise SonataInvalidParametersException("Missing search query")
+    matches = search_pieces(database.session, user.id, query,
+                            _get_page_size(args.get("limit"), _DEFAULT_SEARCH_SIZE))
+    pieces = {piece.id: piece for piece in Piece.query
+              .filter(Piece.id.in_([match.piece_id for match in matches]))
+              .options(selectinload(Piece.tags))}
+    return {
+        "results": [{
+            "piece": pieces[match.piece_id].to_dict(),
+            "snippet": match.snippet
+        } for match in matches]
+    }
+
+
+@app.route("/api/pieces/search", methods=["GET"])
+@jwt_required()
+@read_only
+@conditional
+def pieces_search():
+    return Result.instantiate(get_current_user) \
+        .bind(lambda x: _search_pieces(x, request.args)) \
+        .jsonify()
+
+
+@app.route("/api/pieces/stats", methods=["GET"])
+@jwt_required()
+@read_only
+@conditional
+def pieces_stats():
+    return Result.instantiate(get_current_user) \
+        .bind(lambda x: get_piece_stats(database.session, x.id)) \
+        .jsonify()
+
+
+def _get_user_pieces_by_ids(user: User, piece_ids: Set[int]) -> Dict[int, Piece]:
+    if not piece_ids:
+        return {}
+    pieces = Piece.query.filter(
+        Piece.id.in_(piece_ids), Piece.user_id == user.id)
+    return {piece.id: piece for piece in pieces}
+
+
+class _BulkContext(NamedTuple):
+    user: User
+    pieces: Dict[int, Piece]
+    tags: Dict[int, Tag]
+    # Tag ids of every added or edited piece, written with one set of statements
+    piece_tags: Dict[int, List[int]]
+    # Their tags are removed with the ones of the added and edited pieces
+    deleted_ids: Set[int]
+    deleted_file_ids: List[Optional[int]]
+
+
+def _get_bulk_piece(context: _BulkContext, operation: Dict[str, Any]) -> Piece:
+    piece_id_hash, = get_dict_keys(operation, ["id"])
+    piece_id = try_decode_id(piece_id_hash)
+    piece = context.pieces.get(piece_id)  # type: ignore
+    if piece is None:
+        raise SonataNotFoundException(
+            f"Piece with ID {piece_id_hash} not found for this user")
+    return piece
+
+
+def _get_bulk_tag_ids(context: _BulkContext, tag_id_hashes: List[str]) -> List[int]:
+    tags = pick_tags(context.tags, tag_id_hashes,
+                     decode_tag_ids(tag_id_hashes))
+    return [tag.id for tag in tags]
+
+
+def _apply_bulk_operation(context: _BulkContext, operation: Dict[str, Any]) -> Optional[Piece]:
+    kind, = get_dict_keys(operation, ["op"])
+    if kind == "delete":
+        piece = _get_bulk_piece(context, operation)
+        # Deleted right away, so the later operations can reuse its name
+        database.session.expunge(piece)
+        database.session.execute(sqlalchemy.delete(Piece).where(Piece.id == piece.id))
+        del context.pieces[piece.id]
+        context.piece_tags.pop(piece.id, None)
+        context.deleted_ids.add(piece.id)
+        context.deleted_file_ids.append(piece.file_id)
+        return None
+
+    if kind == "add":
+        name, description, instrument, state, tag_id_hashes = get_dict_keys(
+            operation, ["name", "description", "instrument", "state", "tag_ids"])
+        tag_ids = _get_bulk_tag_ids(context, tag_id_hashes)
+        piece = Piece(name=name, description=description, instrument=instrument,
+                      state=state, user_id=context.user.id)  # type: ignore
+        database.session.add(piece)
+    elif kind == "edit":
+        piece = _get_bulk_piece(context, operation)
+        name, description, instrument, state, tag_id_hashes = get_dict_keys(
+            operation, ["name", "description", "instrument", "state", "tag_ids"])
+        tag_ids = _get_bulk_tag_ids(context, tag_id_hashes)
+        piece.name = name
+        piece.description = description
+        piece.instrument = instrument
+        piece.state = state
+    else:
+        raise SonataInvalidParametersException(f"Unknown operation {kind}")
+
+    database.session.flush()
+    context.piece_tags[piece.id] = tag_ids
+    return piece
+
+
+def _write_bulk_piece_tags(context: _BulkContext):
+    replaced_ids = set(context.piece_tags) | context.deleted_ids
+    if replaced_ids:
+        database.session.execute(pieces_tags.delete().where(
+            pieces_tags.c.piece_id.in_(replaced_ids)))
+    rows = [{"piece_id": piece_id, "tag_id": tag_id}
+            for piece_id, tag_ids in context.piece_tags.items()
+            for tag_id in tag_ids]
+    if rows:
+        database.session.execute(pieces_tags.insert(), rows)
+
+
+def _apply_bulk(user_id: int, operations: List[Dict[str, Any]]
+                ) -> Tuple[Dict[str, Any], List[ReleasedFile]]:
+    if not isinstance(operations, list):
+        raise SonataInvalidParametersException("Operations must be a list")
+
+    piece_ids: Set[int] = set()
+    tag_id_hashes: List[str] = []
+    for operation in operations:
+        if not isinstance(operation, dict):
+            continue
+        piece_id = try_decode_id(operation.get("id"))
+        if piece_id is not None:
+            piece_ids.add(piece_id)
+        if isinstance(operation.get("tag_ids"), list):
+            tag_id_hashes.extend(operation["tag_ids"])
+
+    user = get_user_by_id(user_id)
+    context = _BulkContext(user, _get_user_pieces_by_ids(user, piece_ids),
+                           get_user_tags(user, decode_tag_ids(tag_id_hashes)), {}, set(), [])
+    results: List[Dict[str, Any]] = []
+    for operation in operations:
+        try:
+            with database.session.begin_nested():
+                piece = _apply_bulk_operation(context, operation)
+            results.append({"ok": True, "piece_id": piece.id if piece else None})
+        except SonataException as e:
+            results.append(
+                {"ok": False, "code": e.code, "error": e.error_message})
+        except sqlalchemy.exc.IntegrityError:
+            results.append({"ok": False, "code": 400, "error": PIECE_CONFLICT_MESSAGE})
+
+    released = released_files(context.deleted_file_ids)
+    _write_bulk_piece_tags(context)
+
+    saved_ids = [result["piece_id"] for result in results
+                 if result.get("piece_id") is not None]
+    saved = {piece.id: piece for piece in Piece.query
+             .filter(Piece.id.in_(saved_ids))
+             .options(selectinload(Piece.tags))
+             .populate_existing()}
+    for result in results:
+        piece_id = result.pop("piece_id", None)
+        if piece_id is not None:
+            result["piece"] = saved[piece_id].to_dict()
+    return {"results": results}, released
 
 
 @app.route("/api/pieces/edit", methods=["POST"])
@@ -85,25 +337,15 @@ def pieces_edit():
     if not result.is_ok:
         return result
     piece_id_hash, name, description, instrument, state, tag_ids = result.value
-    piece_id, = hasher.decode(piece_id_hash)  # type: ignore
-
-    user_result = Result.instantiate(get_jwt_identity) \
-        .bind(get_user_by_email)
-
-    if not user_result.is_ok:
-        return result
-    user = user_result.value
-    tags_result = Result(tag_ids, 200) \
-        .bind(_decode_tags) \
-        .bind(lambda x: _get_tags(user, x)) \
-
-    if not tags_result.is_ok:
-        return tags_result
+    ids_result = Result.instantiate(lambda: piece_and_user_ids(piece_id_hash))
+    if not ids_result.is_ok:
+        return ids_result
+    piece_id, user_id = ids_result.value
 
     new_piece = Piece(id=piece_id, user_id=-1, name=name, description=description,
-                      instrument=instrument, state=state, tags=tags_result.value)  # type: ignore
-    return Result.instantiate(lambda: _edit_piece(user, new_piece)) \
-        .bind(lambda x: x.to_dict()) \
+                      instrument=instrument, state=state)  # type: ignore
+    return Result.instantiate(lambda: run_write(
+        lambda: _edit_piece(user_id, new_piece, tag_ids), PIECE_CONFLICT_MESSAGE)) \
         .jsonify()
 
 
@@ -118,25 +360,17 @@ def pieces_add():
         return result
 
     name, description, instrument, state, tag_ids = result.value
-    user_result = Result.instantiate(get_jwt_identity) \
-        .bind(get_user_by_email)
+    user_result = Result.instantiate(get_current_user)
 
     if not user_result.is_ok:
         return result
-    user = user_result.value
-
-    tags_result = Result(tag_ids, 200) \
-        .bind(_decode_tags) \
-        .bind(lambda x: _get_tags(user, x)) \
-
-    if not tags_result.is_ok:
-        return tags_result
+    user_id = user_result.value.id
 
     piece = Piece(
         name=name, description=description, instrument=instrument,
-        state=state, tags=tags_result.value, user_id=user.id)  # type: ignore
-    return Result.instantiate(lambda: _add_piece(piece)) \
-        .bind(lambda x: x.to_dict()) \
+        state=state)  # type: ignore
+    return Result.instantiate(lambda: run_write(
+        lambda: _add_piece(user_id, piece, tag_ids), PIECE_CONFLICT_MESSAGE)) \
         .jsonify()
 
 
@@ -147,12 +381,30 @@ def pieces_delete():
         lambda: get_json_keys(request, ["id"])
     ) \
         .bind(lambda x: x[0]) \
-        .bind(hasher.decode) \
-        .bind(lambda x: x[0])  # type: ignore
+        .bind(lambda x: decode_id(x, "Piece"))
     if not result.is_ok:
         return result
 
     piece_id = result.value
-    return Result.instantiate(get_jwt_identity) \
-        .bind(get_user_by_email) \
-        .bind(lambda x: _delete_piece(x, piece_id))
+    return Result.instantiate(get_current_user) \
+        .bind(lambda x: x.id) \
+        .bind(lambda x: run_write(lambda: _delete_piece(x, piece_id), PIECE_CONFLICT_MESSAGE)) \
+        .bind(release_files) \
+        .bind(lambda _: "")
+
+
+@app.route("/api/pieces/bulk", methods=["POST"])
+@jwt_required()
+def pieces_bulk():
+    result: Result[List[Any]] = Result.instantiate(
+        lambda: get_json_keys(request, ["operations"])
+    )
+    if not result.is_ok:
+        return result
+    operations, = result.value
+
+    return Result.instantiate(get_current_user) \
+        .bind(lambda x: x.id) \
+        .bind(lambda x: run_write(lambda: _apply_bulk(x, operations), PIECE_CONFLICT_MESSAGE)) \
+        .bind(_release) \
+        .jsonify()
@@ -0,0 +1,94 @@
+import heapq
+from typing import Any, Dict, List, Sequence
+
+from flask import request
+from flask_jwt_extended import jwt_required
+import sqlalchemy
+from sqlalchemy.orm import selectinload
+
+from web.api.identity import get_current_user
+from web.api.result import Result
+from web.api.utils import parse_int
+from web.base import app, database
+from web.database_config import read_only
+from web.etags import conditional
+from web.ids import encode_id
+from web.models.piece import Piece
+from web.models.tags import Tag
+from web.models.tombstones import tombstones
+from web.models.user import User
+
+_DEFAULT_SYNC_SIZE = 500
+_MAX_SYNC_SIZE = 1000
+
+
+def _changed_rows(model: Any, user_id: int, since: int, limit: int) -> List[Any]:
+    query = model.query \
+        .filter(model.user_id == user_id, model.change_seq > since) \
+        .order_by(model.change_seq) \
+        .limit(limit)
+    if model is Piece:
+        query = query.options(selectinload(Piece.tags))
+    return query.all()
+
+
+def _deleted_rows(user_id: int, since: int, limit: int) -> Sequence[sqlalchemy.Row]:
+    return database.session.execute(
+        sqlalchemy.select(tombstones.c.kind, tombstones.c.row_id, tombstones.c.change_seq)
+        .where(tombstones.c.user_id == user_id, tombstones.c.change_seq > since)
+        .order_by(tombstones.c.change_seq)
+        .limit(limit)
+    ).all()
+
+
+def _with_updated_at(row: Any) -> Dict[str, Any]:
+    serialized = row.to_dict()
+    serialized["updated_at"] = row.updated_at.isoformat() if row.updated_at else None
+    return serialized
+
+
+# Every change of a user gets its own sequence number, so the three streams are merged by it and
+# cut after a page of changes
+def _sync(user: User, args: Dict[str, str]) -> Dict[str, Any]:
+    # Rows that were never changed since the sequence was added have 0, so a full sync starts
+    # before it
+    since = parse_int(args["since"], "since") if "since" in args else -1
+    page_size = max(1, min(parse_int(args.get("limit", _DEFAULT_SYNC_SIZE), "limit"),
+                           _MAX_SYNC_SIZE))
+    data_version = database.session.execute(
+        sqlalchemy.select(User.data_version).where(User.id == user.id)).scalar_one()
+
+    changes = heapq.merge(
+        (("piece", piece.change_seq, piece)
+         for piece in _changed_rows(Piece, user.id, since, page_size + 1)),
+        (("tag", tag.change_seq, tag)
+         for tag in _changed_rows(Tag, user.id, since, page_size + 1)),
+        ((f"deleted_{row.kind}", row.change_seq, row.row_id)
+         for row in _deleted_rows(user.id, since, page_size + 1)),
+        key=lambda change: change[1])
+    page = [change for change, _ in zip(changes, range(page_size + 1))]
+    has_more = len(page) > page_size
+    page = page[:page_size]
+
+    result: Dict[str, Any] = {
+        "pieces": [], "tags": [], "deleted_pieces": [], "deleted_tags": []
+    }
+    for kind, _, value in page:
+        if kind.startswith("deleted_"):
+            result[f"{kind}s"].append(encode_id(value))
+        else:
+            result[f"{kind}s"].append(_with_updated_at(value))
+    # The last page includes every change up to the data version read in the same snapshot
+    result["cursor"] = page[-1][1] if has_more else max(data_version, since)
+    result["has_more"] = has_more
+    return result
+
+
+@app.route("/api/sync", methods=["GET"])
+@jwt_required()
+@read_only
+@conditional
+def sync():
+    return Result.instantiate(get_current_user) \
+        .bind(lambda x: _sync(x, request.args)) \
+        .jsonify()
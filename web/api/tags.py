@@ -1,14 +1,17 @@
-from typing import List
+from typing import Any, Dict, Iterable, List, Optional
 from flask import request
-from flask_jwt_extended import get_jwt_identity, jwt_required
-import sqlalchemy
-from web.api.auth import get_user_by_email
+from flask_jwt_extended import jwt_required
+from web.api.identity import get_current_user
 from web.api.result import Result
 from web.api.utils import get_json_keys
-from web.base import app, database, hasher
-from web.exceptions import SonataAlreadyExistsException, SonataNotFoundException
+from web.base import app, database
+from web.exceptions import SonataNotFoundException
+from web.ids import decode_id, decode_ids
 from web.models.tags import Tag
 from web.models.user import User
+from web.writes import run_write
+
+_TAG_CONFLICT_MESSAGE = "A tag with this name already exists!"
 
 
 def get_tag_by_id(tag_id: int) -> Tag:
@@ -18,41 +21,67 @@ def get_tag_by_id(tag_id: int) -> Tag:
     raise SonataNotFoundException(f"Tag with ID {tag_id} not found")
 
 
-def _commit_tag_changes():
-    try:
-        database.session.commit()
-    except sqlalchemy.exc.IntegrityError as e:
-        database.session.rollback()
-        raise SonataAlreadyExistsException(
-            "A tag with this name already exists!") from e
+def decode_tag_ids(tag_id_hashes: List[str]) -> List[Optional[int]]:
+    return decode_ids(tag_id_hashes)
+
+
+def get_user_tags(user: User, tag_ids: Iterable[Optional[int]]) -> Dict[int, Tag]:
+    unique_ids = {tag_id for tag_id in tag_ids if tag_id is not None}
+    if not unique_ids:
+        return {}
+    tags = Tag.query.filter(Tag.id.in_(unique_ids), Tag.user_id == user.id)
+    return {tag.id: tag for tag in tags}
 
 
-def _edit_tag(user: User, new_tag: Tag):
-    tag = get_tag_by_id(new_tag.id)
-    if tag.user_id != user.id:
+def pick_tags(tags_by_id: Dict[int, Tag], tag_id_hashes: List[str],
+              tag_ids: List[Optional[int]]) -> List[Tag]:
+    tags: List[Tag] = []
+    missing = []
+    for tag_id_hash, tag_id in zip(tag_id_hashes, tag_ids):
+        tag = tags_by_id.get(tag_id)  # type: ignore
+        if tag is None:
+            missing.append(str(tag_id_hash))
+        elif tag not in tags:
+            tags.append(tag)
+    if len(missing) == 1:
         raise SonataNotFoundException(
-            f"Tag with ID {new_tag.id} not found for this user")
+            f"Tag with ID {missing[0]} not found for this user")
+    if missing:
+        raise SonataNotFoundException(
+            f"Tags with IDs {', '.join(missing)} not found for this user")
+    return tags
+
 
+def resolve_tags(user: User, tag_id_hashes: List[str]) -> List[Tag]:
+    tag_ids = decode_tag_ids(tag_id_hashes)
+    return pick_tags(get_user_tags(user, tag_ids), tag_id_hashes, tag_ids)
+
+
+def _get_user_tag(user_id: int, tag_id: int) -> Tag:
+    tag = get_tag_by_id(tag_id)
+    if tag.user_id != user_id:
+        raise SonataNotFoundException(
+            f"Tag with ID {tag_id} not found for this user")
+    return tag
+
+
+def _edit_tag(user_id: int, new_tag: Tag) -> Dict[str, Any]:
+    tag = _get_user_tag(user_id, new_tag.id)
     tag.tag = new_tag.tag
     tag.color = new_tag.color
-    _commit_tag_changes()
-    return tag
+    database.session.flush()
+    return tag.to_dict()
 
 
-def _add_tag(user: User, tag: Tag):
-    tag.user_id = user.id
+def _add_tag(user_id: int, tag: Tag) -> Dict[str, Any]:
+    tag.user_id = user_id
     database.session.add(tag)
-    _commit_tag_changes()
-    return tag
+    database.session.flush()
+    return tag.to_dict()
 
 
-def _delete_tag(user: User, tag_id: int):
-    tag = get_tag_by_id(tag_id)
-    if tag.user_id != user.id:
-        raise SonataNotFoundException(
-            f"Tag with ID {tag_id} not found for this user")
-    database.session.delete(tag)
-    database.session.commit()
+def _delete_tag(user_id: int, tag_id: int):
+    database.session.delete(_get_user_tag(user_id, tag_id))
     return ""
 
 
@@ -65,13 +94,15 @@ def tags_edit():
     if not result.is_ok:
         return result
     tag_id_hash, name, color = result.value
-    tag_id, = hasher.decode(tag_id_hash)  # type: ignore
+    tag_id_result = Result.instantiate(lambda: decode_id(tag_id_hash, "Tag"))
+    if not tag_id_result.is_ok:
+        return tag_id_result
+    tag_id = tag_id_result.value
     new_tag = Tag(id=tag_id, user_id=-1, tag=name, color=color)  # type: ignore
 
-    return Result.instantiate(get_jwt_identity) \
-        .bind(get_user_by_email) \
-        .bind(lambda x: _edit_tag(x, new_tag)) \
-        .bind(lambda x: x.to_dict()) \
+    return Result.instantiate(get_current_user) \
+        .bind(lambda x: x.id) \
+        .bind(lambda x: run_write(lambda: _edit_tag(x, new_tag), _TAG_CONFLICT_MESSAGE)) \
         .jsonify()
 
 
@@ -86,10 +117,9 @@ def tags_add():
     name, color = result.value
     new_tag = Tag(tag=name, color=color)  # type: ignore
 
-    return Result.instantiate(get_jwt_identity) \
-        .bind(get_user_by_email) \
-        .bind(lambda x: _add_tag(x, new_tag)) \
-        .bind(lambda x: x.to_dict()) \
+    return Result.instantiate(get_current_user) \
+        .bind(lambda x: x.id) \
+        .bind(lambda x: run_write(lambda: _add_tag(x, new_tag), _TAG_CONFLICT_MESSAGE)) \
         .jsonify()
 
 
@@ -102,8 +132,11 @@ def tags_delete():
     if not result.is_ok:
         return result
     tag_id_hashed, = result.value
-    tag_id, = hasher.decode(tag_id_hashed)  # type: ignore
-
-    return Result.instantiate(get_jwt_identity) \
-        .bind(get_user_by_email) \
-        .bind(lambda x: _delete_tag(x, tag_id))
+    tag_id_result = Result.instantiate(lambda: decode_id(tag_id_hashed, "Tag"))
+    if not tag_id_result.is_ok:
+        return tag_id_result
+    tag_id = tag_id_result.value
+
+    return Result.instantiate(get_current_user) \
+        .bind(lambda x: x.id) \
+        .bind(lambda x: run_write(lambda: _delete_tag(x, tag_id), _TAG_CONFLICT_MESSAGE))
@@ -1,21 +1,31 @@
-from typing import Any, List
+from typing import Any, Dict, List
 
 from flask import Request
 
-from web.exceptions import SonataMissingParametersException
+from web.exceptions import SonataInvalidParametersException, SonataMissingParametersException
 
 
-def get_json_keys(request: Request, keys: List[str]) -> List[Any]:
-    data = request.get_json()
+def get_dict_keys(data: Dict[str, Any], keys: List[str]) -> List[Any]:
     try:
         return [data[key] for key in keys]
-    except KeyError as e:
+    except (KeyError, TypeError) as e:
         raise SonataMissingParametersException("Missing fields") from e
 
 
+def get_json_keys(request: Request, keys: List[str]) -> List[Any]:
+    return get_dict_keys(request.get_json(), keys)
+
+
 def get_data_keys(request: Request, keys: List[str]) -> List[Any]:
     data = request.form
     try:
         return [data[key] for key in keys]
     except KeyError as e:
         raise SonataMissingParametersException("Missing fields") from e
+
+
+def parse_int(value: Any, name: str) -> int:
+    try:
+        return int(value)
+    except ValueError as e:
+        raise SonataInvalidParametersException(f"Invalid {name}") from e
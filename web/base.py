@@ -4,38 +4,55 @@ import pathlib
 from flask_jwt_extended import JWTManager
 import hashids
 
-from flask import Flask, send_from_directory
+from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flask_caching import Cache
 
+from web.database_config import RoutingSession, engine_options
 from web.hidden import SECRET, JWT_SECRET_KEY
+from web.file_cache import FileCache
+from web.storage import DiskBlobStorage
 
 _DATABASE_LOCATION = pathlib.Path(__file__).parent.parent / "sonata.db"
+_STORAGE_LOCATION = pathlib.Path(__file__).parent.parent / "storage"
 _STATIC_FOLDER = pathlib.Path(__file__).parent.parent / "website"
 
-app = Flask(__name__, static_folder=str(_STATIC_FOLDER), static_url_path="/")
+# The SPA is served by web.spa, which also handles client side routes
+app = Flask(__name__, static_folder=None)
 
 app.config["SECRET"] = SECRET
 app.config["JWT_SECRET_KEY"] = JWT_SECRET_KEY
 app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(days=30)
+app.config["USER_CACHE_TTL"] = float(os.environ.get("USER_CACHE_TTL", 30))
+app.config["USER_CACHE_SIZE"] = int(os.environ.get("USER_CACHE_SIZE", 1024))
 
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{
     os.environ.get('DATABASE_PATH', _DATABASE_LOCATION)}"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-
-app.config['CACHE_TYPE'] = 'simple'
-
-cache = Cache(app)
+app.config["WORKER_THREADS"] = int(os.environ.get("WEB_THREADS", 4))
+app.config["DATABASE_READ_SPLIT"] = os.environ.get("DATABASE_READ_SPLIT", "1") == "1"
+# With the read split, writes share a single pooled connection, without overflow, and queue for
+# it in the pool instead of busy-waiting on the SQLite write lock. Readers get one connection per
+# thread
+if app.config["DATABASE_READ_SPLIT"]:
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        int(os.environ.get("DATABASE_WRITER_POOL_SIZE", 1)), max_overflow=0)
+else:
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        int(os.environ.get("DATABASE_POOL_SIZE", app.config["WORKER_THREADS"])))
+app.config["DATABASE_READER_ENGINE_OPTIONS"] = engine_options(
+    int(os.environ.get("DATABASE_POOL_SIZE", app.config["WORKER_THREADS"])))
+
+app.config["STATIC_PATH"] = os.environ.get("STATIC_PATH", _STATIC_FOLDER)
+app.config["STORAGE_PATH"] = os.environ.get("STORAGE_PATH", _STORAGE_LOCATION)
+app.config["FILE_CACHE_MAX_BYTES"] = int(
+    os.environ.get("FILE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+app.config["FILE_CACHE_MAX_ENTRY_BYTES"] = int(
+    os.environ.get("FILE_CACHE_MAX_ENTRY_BYTES", 4 * 1024 * 1024))
+
+storage = DiskBlobStorage(app.config["STORAGE_PATH"])
+file_cache = FileCache(app.config["FILE_CACHE_MAX_BYTES"],
+                       app.config["FILE_CACHE_MAX_ENTRY_BYTES"])
 hasher = hashids.Hashids()
-database = SQLAlchemy(app, session_options={"autoflush": False})
+database = SQLAlchemy(app, session_options={
+    "autoflush": False, "class_": RoutingSession})
 jwt = JWTManager(app)
-
-
-@app.route("/", defaults={'path': ''})
-@app.route("/<path:path>")
-def serve(path):
-    print(repr(path), app.static_url_path, app.static_folder)
-    # if path and os.path.exists(os.path.join(app.static_folder, path)):
-    # return send_from_directory(app.static_folder, path)
-
-    return send_from_directory(app.static_folder, "index.html")
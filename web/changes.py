@@ -0,0 +1,66 @@
+import sqlalchemy
+from sqlalchemy import event
+
+from web.base import database
+
+
+def _bump(user_id: str) -> str:
+    return f"UPDATE users SET data_version = data_version + 1 WHERE id = {user_id};"
+
+
+# The user's data version after the bump is the change sequence of the row, so the rows and
+# tombstones of a user are ordered by when they last changed
+def _touch(table: str, row_id: str, user_id: str) -> str:
+    return f"""{_bump(user_id)}
+        UPDATE {table} SET updated_at = CURRENT_TIMESTAMP,
+            change_seq = (SELECT data_version FROM users WHERE id = {user_id})
+        WHERE id = {row_id};"""
+
+
+def _tombstone(kind: str, row_id: str, user_id: str) -> str:
+    return f"""{_bump(user_id)}
+        INSERT INTO tombstones(user_id, kind, row_id, change_seq, deleted_at)
+        SELECT id, '{kind}', {row_id}, data_version, CURRENT_TIMESTAMP FROM users
+        WHERE id = {user_id};"""
+
+
+_PIECE_OWNER = "(SELECT user_id FROM pieces WHERE id = {}.piece_id)"
+
+# Every change to a user's pieces and tags bumps their data version. The update triggers skip the
+# updates they make themselves, which are the only ones that change change_seq
+_CHANGE_TRIGGERS = {
+    "data_version_piece_insert": f"""AFTER INSERT ON pieces BEGIN
+        {_touch("pieces", "new.id", "new.user_id")}
+    END""",
+    "data_version_piece_update": f"""AFTER UPDATE ON pieces
+    WHEN new.change_seq IS old.change_seq BEGIN
+        {_touch("pieces", "new.id", "new.user_id")}
+    END""",
+    "data_version_piece_delete": f"""AFTER DELETE ON pieces BEGIN
+        {_tombstone("piece", "old.id", "old.user_id")}
+    END""",
+    "data_version_tag_insert": f"""AFTER INSERT ON tags BEGIN
+        {_touch("tags", "new.id", "new.user_id")}
+    END""",
+    "data_version_tag_update": f"""AFTER UPDATE ON tags
+    WHEN new.change_seq IS old.change_seq BEGIN
+        {_touch("tags", "new.id", "new.user_id")}
+    END""",
+    "data_version_tag_delete": f"""AFTER DELETE ON tags BEGIN
+        {_tombstone("tag", "old.id", "old.user_id")}
+    END""",
+    "data_version_piece_tag_insert": f"""AFTER INSERT ON pieces_tags BEGIN
+        {_touch("pieces", "new.piece_id", _PIECE_OWNER.format("new"))}
+    END""",
+    "data_version_piece_tag_delete": f"""AFTER DELETE ON pieces_tags BEGIN
+        {_touch("pieces", "old.piece_id", _PIECE_OWNER.format("old"))}
+    END""",
+}
+
+
+# Recreated on every create_all, so databases pick up changes to the trigger bodies
+@event.listens_for(database.metadata, "after_create")
+def _create_change_triggers(_, connection: sqlalchemy.Connection, **__):
+    for name, body in _CHANGE_TRIGGERS.items():
+        connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+        connection.exec_driver_sql(f"CREATE TRIGGER {name} {body}")
@@ -0,0 +1,109 @@
+import io
+from typing import Optional
+
+import click
+from sqlalchemy.orm import undefer
+
+from web.base import app, database, storage
+from web.file_refs import recount_file_refs, storage_report
+from web.maintenance import MaintenanceWorker, enable_incremental_vacuum
+from web.models.file import File
+from web.schema import upgrade_schema
+from web.search import rebuild_search_index
+from web.stats import rebuild_facet_counts
+
+
+@app.cli.command("init-db")
+def init_db():
+    for statement in upgrade_schema():
+        click.echo(statement)
+    click.echo("Database schema is up to date")
+
+
+@app.cli.command("rebuild-search-index")
+def rebuild_search():
+    upgrade_schema()
+    with database.engine.begin() as connection:
+        rebuild_search_index(connection)
+    click.echo("Search index rebuilt")
+
+
+@app.cli.command("rebuild-piece-stats")
+def rebuild_piece_stats():
+    upgrade_schema()
+    with database.engine.begin() as connection:
+        rebuild_facet_counts(connection)
+    click.echo("Piece stats rebuilt")
+
+
+@app.cli.command("migrate-files")
+@click.option("--batch-size", default=100, show_default=True,
+              help="Number of files moved per transaction.")
+def migrate_files(batch_size: int):
+    upgrade_schema()
+    moved = 0
+    while True:
+        files = File.query \
+            .filter(File.path.is_(None)) \
+            .order_by(File.id) \
+            .options(undefer(File.content)) \
+            .limit(batch_size) \
+            .all()
+        if not files:
+            break
+
+        for file in files:
+            content = file.content
+            if isinstance(content, str):
+                content = content.encode()
+            blob = storage.save(io.BytesIO(content))
+            file.size = blob.size
+            file.sha256 = blob.sha256
+            file.path = blob.path
+            file.content = b""
+        database.session.commit()
+        database.session.expunge_all()
+
+        moved += len(files)
+        click.echo(f"Moved {moved} files to {storage.root}")
+    click.echo(f"Done, {moved} files moved")
+
+
+@app.cli.command("recount-file-refs")
+def recount_file_references():
+    upgrade_schema()
+    with database.engine.begin() as connection:
+        merged = recount_file_refs(connection)
+    click.echo(f"Merged {merged} duplicate files, reference counts are up to date")
+
+
+@app.cli.command("storage-report")
+def report_storage():
+    for key, value in storage_report(database.session).items():
+        click.echo(f"{key}: {value}")
+
+
+@app.cli.command("maintenance")
+@click.option("--dry-run", is_flag=True, help="Report what would be deleted without deleting it.")
+@click.option("--grace", type=float, default=None,
+              help="Minimum age in seconds of what is deleted, MAINTENANCE_GRACE_S by default.")
+@click.option("--enable-incremental-vacuum", "convert", is_flag=True,
+              help="Rewrite the database so freed pages can be returned incrementally.")
+def run_maintenance(dry_run: bool, grace: Optional[float], convert: bool):
+    upgrade_schema()
+    if convert:
+        enable_incremental_vacuum(database.engine)
+        click.echo("Incremental vacuum enabled")
+    worker = MaintenanceWorker(app,
+                               app.config["MAINTENANCE_BATCH_SIZE"],
+                               app.config["MAINTENANCE_GRACE_S"] if grace is None else grace,
+                               app.config["MAINTENANCE_VACUUM_PAGES"],
+                               dry_run)
+    summary = worker.run_exclusive()
+    if summary is None:
+        raise click.ClickException("Maintenance is already running in another process")
+    prefix = "Would delete" if dry_run else "Deleted"
+    click.echo(f"{prefix} {summary['orphaned_files']} orphaned files and "
+               f"{summary['orphaned_blobs']} blobs ({summary['freed_bytes']} bytes), "
+               f"{summary['expired_uploads']} expired uploads, "
+               f"{summary['vacuumed_pages']} pages vacuumed")
@@ -0,0 +1,80 @@
+import gzip
+import os
+import threading
+import time
+from typing import Dict, Union
+
+from flask import Response, request
+
+from web.base import app
+
+app.config["COMPRESSION_MIN_SIZE"] = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+app.config["COMPRESSION_LEVEL"] = int(os.environ.get("COMPRESSION_LEVEL", 6))
+
+
+class ResponseCompressor:
+    def __init__(self, min_size: int, level: int) -> None:
+        self.min_size = min_size
+        self.level = level
+        self._metrics: Dict[str, Union[int, float]] = {
+            "compressed": 0,
+            "skipped": 0,
+            "bytes_in": 0,
+            "bytes_out": 0,
+            "cpu_seconds": 0.0,
+        }
+        self._lock = threading.Lock()
+
+    def _should_compress(self, response: Response) -> bool:
+        # Files are streamed as they are, and are mostly compressed formats already
+        return response.mimetype == "application/json" \
+            and not response.direct_passthrough \
+            and "Content-Encoding" not in response.headers \
+            and response.status_code not in (204, 206, 304)
+
+    def compress(self, response: Response) -> Response:
+        if not self._should_compress(response):
+            return response
+        # Varies whether or not this one ends up compressed
+        response.vary.add("Accept-Encoding")
+        if "gzip" not in request.accept_encodings:
+            return response
+        data = response.get_data()
+        if len(data) < self.min_size:
+            with self._lock:
+                self._metrics["skipped"] += 1
+            return response
+
+        start = time.thread_time()
+        compressed = gzip.compress(data, compresslevel=self.level, mtime=0)
+        cpu_seconds = time.thread_time() - start
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = "gzip"
+        with self._lock:
+            self._metrics["compressed"] += 1
+            self._metrics["bytes_in"] += len(data)
+            self._metrics["bytes_out"] += len(compressed)
+            self._metrics["cpu_seconds"] += cpu_seconds
+        return response
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self._lock:
+            metrics = dict(self._metrics)
+        cpu_seconds = metrics.pop("cpu_seconds")
+        return {
+            "level": self.level,
+            "min_size": self.min_size,
+            **metrics,
+            "bytes_saved": metrics["bytes_in"] - metrics["bytes_out"],
+            "cpu_ms_per_response":
+                cpu_seconds * 1000 / metrics["compressed"] if metrics["compressed"] else 0.0,
+        }
+
+
+response_compressor = ResponseCompressor(app.config["COMPRESSION_MIN_SIZE"],
+                                         app.config["COMPRESSION_LEVEL"])
+
+
+@app.after_request
+def _compress_response(response: Response):
+    return response_compressor.compress(response)
@@ -0,0 +1,164 @@
+import contextlib
+import functools
+import os
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, Iterator, Optional, TypeVar
+
+from flask import Flask, current_app, g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Connection, Engine, create_engine, event, text
+
+_T = TypeVar("_T")
+
+# PRAGMA name -> (environment variable, default), applied to every new connection
+_SQLITE_PRAGMAS = {
+    # Only takes effect on new databases, before their first table. `flask maintenance
+    # --enable-incremental-vacuum` converts existing ones
+    "auto_vacuum": ("SQLITE_AUTO_VACUUM", "INCREMENTAL"),
+    "journal_mode": ("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": ("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": ("SQLITE_BUSY_TIMEOUT_MS", "5000"),
+    "mmap_size": ("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+    "cache_size": ("SQLITE_CACHE_SIZE", str(-64 * 1024)),
+    "temp_store": ("SQLITE_TEMP_STORE", "MEMORY"),
+}
+
+
+def sqlite_pragmas() -> Dict[str, str]:
+    return {pragma: os.environ.get(variable, default)
+            for pragma, (variable, default) in _SQLITE_PRAGMAS.items()}
+
+
+def engine_options(pool_size: int, max_overflow: Optional[int] = None) -> Dict[str, Any]:
+    busy_timeout_ms = int(sqlite_pragmas()["busy_timeout"])
+    if max_overflow is None:
+        max_overflow = int(os.environ.get("DATABASE_POOL_OVERFLOW", 2))
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": float(os.environ.get("DATABASE_POOL_TIMEOUT", 30)),
+        "connect_args": {
+            "timeout": busy_timeout_ms / 1000,
+            "check_same_thread": False,
+        },
+    }
+
+
+@event.listens_for(Engine, "connect")
+def _configure_sqlite_connection(dbapi_connection, _):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    # pysqlite opens transactions lazily and would commit on the release of an outermost
+    # SAVEPOINT, so transactions are begun explicitly to make nested transactions work
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    for pragma, value in sqlite_pragmas().items():
+        cursor.execute(f"PRAGMA {pragma} = {value}")
+    cursor.close()
+
+
+# A deferred transaction that reads before writing fails with "database is locked" instead of
+# waiting for the busy timeout when another connection committed in between, so writes take the
+# write lock up front with BEGIN IMMEDIATE. Other transactions stay deferred, so reading a request
+# body or a file does not hold the lock
+WRITE_LOCK_OPTIONS = {"sqlite_begin": "IMMEDIATE"}
+
+
+@event.listens_for(Engine, "begin")
+def _begin_sqlite_transaction(connection):
+    if connection.dialect.name == "sqlite":
+        begin = connection.get_execution_options().get("sqlite_begin", "")
+        connection.exec_driver_sql(f"BEGIN {begin}".strip())
+
+
+@contextlib.contextmanager
+def begin_write(engine: Engine) -> Iterator[Connection]:
+    with engine.connect() as connection:
+        with connection.execution_options(**WRITE_LOCK_OPTIONS).begin():
+            yield connection
+
+
+def _set_query_only(dbapi_connection, _):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only = ON")
+    cursor.close()
+
+
+_reader_lock = threading.Lock()
+
+
+# A second pool of connections that can only read. Under WAL they read from the last
+# committed snapshot and never wait on the write lock
+def reader_engine(app: Flask, writer: Engine) -> Optional[Engine]:
+    if not app.config["DATABASE_READ_SPLIT"]:
+        return None
+    with _reader_lock:
+        engine = app.extensions.get("sonata_reader_engine")
+        if engine is None:
+            engine = create_engine(writer.url, **app.config["DATABASE_READER_ENGINE_OPTIONS"])
+            event.listen(engine, "connect", _set_query_only)
+            app.extensions["sonata_reader_engine"] = engine
+        return engine
+
+
+def dispose_reader_engine(app: Flask, close: bool = True):
+    engine = app.extensions.get("sonata_reader_engine")
+    if engine is not None:
+        engine.dispose(close=close)
+
+
+# Sends the queries of a view to the reader engine. Anything it flushes still goes to the writer
+def read_only(view: Callable[..., _T]) -> Callable[..., _T]:
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.database_read_only = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            g.pop("database_read_only", None)
+    return wrapper
+
+
+# Sends the queries of a unit of work to the writer, also when it runs in a read-only view
+@contextlib.contextmanager
+def writing() -> Iterator[None]:
+    view_read_only = g.pop("database_read_only", None) if has_app_context() else None
+    try:
+        yield
+    finally:
+        if view_read_only:
+            g.database_read_only = view_read_only
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context() \
+                and g.get("database_read_only"):
+            engine = reader_engine(current_app, self._db.engine)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _pool_health(engine: Engine) -> Dict[str, int]:
+    pool = engine.pool
+    return {
+        "size": pool.size(),  # type: ignore
+        "checked_out": pool.checkedout(),  # type: ignore
+        "overflow": pool.overflow(),  # type: ignore
+    }
+
+
+def database_health(engine: Engine, reader: Optional[Engine] = None) -> Dict[str, Any]:
+    # Read through the reader, so the health check never waits on the write lock
+    with (reader or engine).connect() as connection:
+        settings = {pragma: connection.execute(text(f"PRAGMA {pragma}")).scalar()
+                    for pragma in _SQLITE_PRAGMAS}
+    health: Dict[str, Any] = {
+        "settings": settings,
+        "pool": _pool_health(engine),
+    }
+    if reader is not None:
+        health["reader_pool"] = _pool_health(reader)
+    return health
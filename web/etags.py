@@ -0,0 +1,72 @@
+import functools
+import os
+from typing import Callable, Optional
+
+import sqlalchemy
+from flask import Response, g, make_response, request
+from flask_jwt_extended import get_jwt_identity
+
+from web.api.identity import jwt_user_id
+from web.base import app, database
+from web import changes  # pylint: disable=unused-import
+from web.models.user import User
+from web.ttl_cache import TTLCache
+
+app.config["DATA_VERSION_CACHE_TTL"] = float(os.environ.get("DATA_VERSION_CACHE_TTL", 1))
+
+_SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# ETags of recently checked users, keyed by their JWT identity. Writes made by this worker evict
+# the entry, writes made by other workers show up once it expires
+_etags: TTLCache[str] = TTLCache(
+    app.config["USER_CACHE_SIZE"], app.config["DATA_VERSION_CACHE_TTL"])
+
+
+def _load_etag(identity: str) -> Optional[str]:
+    user_id = jwt_user_id()
+    query = sqlalchemy.select(User.id, User.version, User.data_version) \
+        .where(User.email == identity)
+    if user_id:
+        query = query.where(User.id == user_id)
+    row = database.session.execute(query).first()
+    if row is None:
+        return None
+    return f"{row.id}-{row.version}-{row.data_version}"
+
+
+def current_etag() -> Optional[str]:
+    identity = get_jwt_identity()
+    etag = _etags.get(identity)
+    if etag is None:
+        etag = _load_etag(identity)
+        if etag is not None:
+            _etags.set(identity, etag)
+    return etag
+
+
+# Answers with 304 when the client already has the current user's data, before the view runs
+def conditional(view: Callable):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        etag = current_etag()
+        if etag is not None and request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if etag is None or response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        return response
+    return wrapper
+
+
+@app.after_request
+def _forget_written_etag(response: Response):
+    identity = g.get("current_user_identity")
+    if identity is not None and request.method not in _SAFE_METHODS:
+        _etags.delete(identity)
+    return response
+
+
+def clear_etag_cache():
+    _etags.clear()
@@ -23,3 +23,8 @@ class SonataNotFoundException(SonataException):
 class SonataAlreadyExistsException(SonataException):
     def __init__(self, error_message: str, *args: object) -> None:
         super().__init__(400, error_message, *args)
+
+
+class SonataInvalidParametersException(SonataException):
+    def __init__(self, error_message: str, *args: object) -> None:
+        super().__init__(400, error_message, *args)
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+
+
+class CachedFile(NamedTuple):
+    content: bytes
+    mimetype: str
+    etag: Optional[str]
+
+
+class FileCache:
+    def __init__(self, max_bytes: int, max_entry_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self._metrics = {"hits": 0, "misses": 0, "evictions": 0}
+        self._entries: OrderedDict[int, CachedFile] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file_id: int) -> Optional[CachedFile]:
+        with self._lock:
+            entry = self._entries.get(file_id)
+            if entry is None:
+                self._metrics["misses"] += 1
+                return None
+            self._entries.move_to_end(file_id)
+            self._metrics["hits"] += 1
+            return entry
+
+    def cacheable(self, size: int) -> bool:
+        return size <= min(self.max_entry_bytes, self.max_bytes)
+
+    def set(self, file_id: int, entry: CachedFile) -> None:
+        if not self.cacheable(len(entry.content)):
+            return
+        with self._lock:
+            self._remove(file_id)
+            self._entries[file_id] = entry
+            self.size += len(entry.content)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.content)
+                self._metrics["evictions"] += 1
+
+    def delete(self, file_id: int) -> None:
+        with self._lock:
+            self._remove(file_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, file_id: int) -> None:
+        entry = self._entries.pop(file_id, None)
+        if entry is not None:
+            self.size -= len(entry.content)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                **self._metrics,
+            }
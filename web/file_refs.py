@@ -0,0 +1,137 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import sqlalchemy
+from sqlalchemy import event, text
+
+from web.base import database, file_cache
+from web.models.file import File
+
+# (id, path) of a file that lost a reference, to clean up once the transaction is committed
+ReleasedFile = Tuple[int, Optional[str]]
+
+
+def _add_ref(file_id: str) -> str:
+    return f"UPDATE files SET ref_count = ref_count + 1 WHERE id = {file_id};"
+
+
+# A file row goes away with its last reference. Its blob is left to the maintenance sweep, since
+# another upload of the same content may be about to use it again
+def _drop_ref(file_id: str) -> str:
+    return f"""UPDATE files SET ref_count = ref_count - 1 WHERE id = {file_id};
+        DELETE FROM files WHERE id = {file_id} AND ref_count <= 0;"""
+
+
+def _ref_triggers(table: str, column: str) -> Dict[str, str]:
+    return {
+        f"file_refs_{table}_insert": f"""AFTER INSERT ON {table}
+        WHEN new.{column} IS NOT NULL BEGIN
+            {_add_ref(f"new.{column}")}
+        END""",
+        f"file_refs_{table}_update": f"""AFTER UPDATE OF {column} ON {table}
+        WHEN old.{column} IS NOT new.{column} BEGIN
+            {_add_ref(f"new.{column}")}
+            {_drop_ref(f"old.{column}")}
+        END""",
+        f"file_refs_{table}_delete": f"""AFTER DELETE ON {table}
+        WHEN old.{column} IS NOT NULL BEGIN
+            {_drop_ref(f"old.{column}")}
+        END""",
+    }
+
+
+_FILE_REF_TRIGGERS = {**_ref_triggers("pieces", "file_id"),
+                      **_ref_triggers("users", "profile_picture_id")}
+
+_RECOUNT = """UPDATE files SET ref_count =
+    (SELECT count(*) FROM pieces WHERE pieces.file_id = files.id)
+    + (SELECT count(*) FROM users WHERE users.profile_picture_id = files.id)"""
+
+# Every file with the same content and type is pointed at the oldest one, which leaves the others
+# without references
+_DUPLICATES = """SELECT files.id, (
+        SELECT min(original.id) FROM files AS original
+        WHERE original.sha256 = files.sha256 AND original.file_type = files.file_type
+            AND original.path IS NOT NULL
+    ) AS original_id
+    FROM files WHERE files.path IS NOT NULL"""
+
+
+def _has_ref_count(connection: sqlalchemy.Connection) -> bool:
+    columns = connection.exec_driver_sql("PRAGMA table_info(files)").all()
+    return any(column[1] == "ref_count" for column in columns)
+
+
+def _file_ref_triggers_exist(connection: sqlalchemy.Connection) -> bool:
+    return connection.execute(text(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'file_refs_%'"
+    )).scalar() == len(_FILE_REF_TRIGGERS)
+
+
+def recount_file_refs(connection: sqlalchemy.Connection) -> int:
+    duplicates = [(file_id, original_id)
+                  for file_id, original_id in connection.execute(text(_DUPLICATES))
+                  if file_id != original_id]
+    for file_id, original_id in duplicates:
+        for table, column in (("pieces", "file_id"), ("users", "profile_picture_id")):
+            connection.execute(
+                text(f"UPDATE {table} SET {column} = :original_id WHERE {column} = :file_id"),
+                {"original_id": original_id, "file_id": file_id})
+    connection.execute(text(_RECOUNT))
+    if duplicates:
+        connection.execute(File.__table__.delete().where(
+            File.id.in_([file_id for file_id, _ in duplicates])))
+    return len(duplicates)
+
+
+# Databases that predate the reference counts get their columns from upgrade_schema after
+# create_all, so this runs from both
+def ensure_file_refs(connection: sqlalchemy.Connection):
+    if _has_ref_count(connection) and not _file_ref_triggers_exist(connection):
+        for name, body in _FILE_REF_TRIGGERS.items():
+            connection.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+        recount_file_refs(connection)
+
+
+@event.listens_for(database.metadata, "after_create")
+def _create_file_ref_triggers(_, connection: sqlalchemy.Connection, **__):
+    ensure_file_refs(connection)
+
+
+def find_file(sha256: str, file_type: str) -> Optional[File]:
+    return File.query \
+        .filter(File.sha256 == sha256, File.file_type == file_type, File.path.isnot(None)) \
+        .order_by(File.id) \
+        .first()
+
+
+def released_files(file_ids: Iterable[Optional[int]]) -> List[ReleasedFile]:
+    file_ids = {file_id for file_id in file_ids if file_id is not None}
+    if not file_ids:
+        return []
+    return list(database.session.execute(
+        sqlalchemy.select(File.id, File.path).where(File.id.in_(file_ids))).tuples())
+
+
+def release_files(files: Iterable[ReleasedFile]):
+    for file_id, _ in files:
+        if database.session.get(File, file_id, populate_existing=True) is None:
+            file_cache.delete(file_id)
+
+
+def storage_report(session: Any) -> Dict[str, int]:
+    files, references, stored_bytes, referenced_bytes = session.execute(text("""
+        SELECT count(*), coalesce(sum(ref_count), 0), coalesce(sum(size), 0),
+            coalesce(sum(size * ref_count), 0)
+        FROM files""")).one()
+    blobs, blob_bytes = session.execute(text("""
+        SELECT count(*), coalesce(sum(size), 0) FROM (
+            SELECT max(size) AS size FROM files WHERE path IS NOT NULL GROUP BY path)""")).one()
+    return {
+        "files": files,
+        "references": references,
+        "blobs": blobs,
+        "blob_bytes": blob_bytes,
+        "file_bytes": stored_bytes,
+        "referenced_bytes": referenced_bytes,
+        "saved_bytes": referenced_bytes - blob_bytes,
+    }
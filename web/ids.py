@@ -0,0 +1,50 @@
+import functools
+import os
+from typing import Any, Iterable, List, Optional, Tuple
+
+from web.base import app, hasher
+from web.exceptions import SonataNotFoundException
+
+app.config["ID_CACHE_SIZE"] = int(os.environ.get("ID_CACHE_SIZE", 65536))
+
+
+# Hashids is pure Python string arithmetic, and the same ids are encoded for every response
+@functools.lru_cache(maxsize=app.config["ID_CACHE_SIZE"])
+def _encode(value: int) -> str:
+    return hasher.encode(value)
+
+
+@functools.lru_cache(maxsize=app.config["ID_CACHE_SIZE"])
+def _decode(hashed_id: str) -> Tuple[int, ...]:
+    return hasher.decode(hashed_id)  # type: ignore
+
+
+def encode_id(value: int) -> str:
+    return _encode(value)
+
+
+def encode_ids(values: Iterable[Optional[int]]) -> List[Optional[str]]:
+    return [None if value is None else _encode(value) for value in values]
+
+
+def try_decode_id(hashed_id: Any) -> Optional[int]:
+    if not isinstance(hashed_id, str):
+        return None
+    decoded = _decode(hashed_id)
+    return decoded[0] if len(decoded) == 1 else None
+
+
+def decode_ids(hashed_ids: Iterable[Any]) -> List[Optional[int]]:
+    return [try_decode_id(hashed_id) for hashed_id in hashed_ids]
+
+
+def decode_id(hashed_id: Any, name: str) -> int:
+    value = try_decode_id(hashed_id)
+    if value is None:
+        raise SonataNotFoundException(f"{name} with ID {hashed_id} not found")
+    return value
+
+
+def clear_id_cache():
+    _encode.cache_clear()
+    _decode.cache_clear()
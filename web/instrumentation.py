@@ -0,0 +1,321 @@
+import bisect
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from flask import Response, g, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import Engine, event
+
+from web.base import app
+from web.periodic import PeriodicTask
+
+_logger = logging.getLogger(__name__)
+_slow_query_logger = logging.getLogger("web.slow_queries")
+
+_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+_MAX_LOGGED_STATEMENT = 1000
+
+app.config["SERVER_TIMING"] = os.environ.get("SERVER_TIMING", "1") == "1"
+# Statements that take longer are logged to `web.slow_queries`, 0 disables the log
+app.config["SLOW_QUERY_MS"] = float(os.environ.get("SLOW_QUERY_MS", 200))
+# Every process writes its samples there, labelled with its pid, and a scrape of any of them
+# returns the samples of all of them. Empty to only serve the metrics of the scraped process
+app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR", "")
+app.config["METRICS_FLUSH_INTERVAL_S"] = float(os.environ.get("METRICS_FLUSH_INTERVAL_S", 5))
+# GET /metrics is disabled without it
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN", "")
+
+Labels = Tuple[str, ...]
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, label_names: Labels,
+                 buckets: Tuple[float, ...]) -> None:
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        # Observations per bucket, the last one for +Inf
+        self._counts: Dict[Labels, List[int]] = {}
+        self._sums: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Labels, value: float):
+        with self._lock:
+            counts = self._counts.setdefault(labels, [0] * (len(self.buckets) + 1))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sums[labels] = self._sums.get(labels, 0.0) + value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(labels, list(counts), self._sums[labels])
+                      for labels, counts in sorted(self._counts.items())]
+        for labels, counts, total in series:
+            label_text = _format_labels(self.label_names, labels)
+            separator = "," if label_text else ""
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                lines.append(
+                    f'{self.name}_bucket{{{label_text}{separator}le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {total}")
+            lines.append(f"{self.name}_count{{{label_text}}} {cumulative}")
+        return lines
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Labels, values: Labels) -> str:
+    return ",".join(f'{name}="{_escape_label(value)}"' for name, value in zip(names, values))
+
+
+# Component counters, such as the stats of the file cache, as `<prefix>_<key>` samples
+def format_stats(prefix: str, stats: Dict[str, Any]) -> List[str]:
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, (int, float)):
+            lines.append(f"# TYPE {prefix}_{key} untyped")
+            lines.append(f"{prefix}_{key} {value}")
+    return lines
+
+
+def _add_label(sample: str, label: str) -> str:
+    if "{" not in sample:
+        name, value = sample.split(" ", 1)
+        return f"{name}{{{label}}} {value}"
+    start = sample.index("{") + 1
+    separator = "" if sample[start] == "}" else ","
+    return f"{sample[:start]}{label}{separator}{sample[start:]}"
+
+
+# Groups the samples of several processes by metric, since a metric is described once. Every
+# sample follows the comments of its metric
+def merge_expositions(expositions: List[List[str]]) -> List[str]:
+    families: Dict[str, Tuple[List[str], List[str]]] = {}
+    for lines in expositions:
+        comments: List[str] = []
+        samples: List[str] = []
+        for line in lines:
+            if line.startswith("#"):
+                comments, samples = families.setdefault(line.split(" ", 3)[2], ([], []))
+                if line not in comments:
+                    comments.append(line)
+            else:
+                samples.append(line)
+    merged = []
+    for comments, samples in families.values():
+        merged += comments + samples
+    return merged
+
+
+class RequestMetrics:
+    def __init__(self) -> None:
+        labels = ("route", "method")
+        self.duration = Histogram("sonata_request_duration_seconds",
+                                  "Time spent handling requests.", labels, _LATENCY_BUCKETS)
+        self.sql_duration = Histogram("sonata_request_sql_duration_seconds",
+                                      "Time spent in SQL statements per request.", labels,
+                                      _LATENCY_BUCKETS)
+        self.sql_queries = Histogram("sonata_request_sql_queries",
+                                     "SQL statements executed per request.", labels,
+                                     _QUERY_BUCKETS)
+        self.serialization_duration = Histogram("sonata_request_serialization_duration_seconds",
+                                                "Time spent encoding JSON per request.", labels,
+                                                _LATENCY_BUCKETS)
+        self._lock = threading.Lock()
+        self._responses: Dict[Labels, int] = {}
+        self.slow_queries = 0
+
+    def record(self, labels: Labels, status: int, duration: float, timings: "_RequestTimings"):
+        self.duration.observe(labels, duration)
+        self.sql_duration.observe(labels, timings.sql_seconds)
+        self.sql_queries.observe(labels, timings.sql_queries)
+        self.serialization_duration.observe(labels, timings.serialization_seconds)
+        with self._lock:
+            key = (*labels, str(status))
+            self._responses[key] = self._responses.get(key, 0) + 1
+
+    def count_slow_query(self):
+        with self._lock:
+            self.slow_queries += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            responses = dict(self._responses)
+            slow_queries = self.slow_queries
+        lines = ["# HELP sonata_responses_total Responses sent.",
+                 "# TYPE sonata_responses_total counter"]
+        for labels, count in sorted(responses.items()):
+            lines.append("sonata_responses_total{"
+                         f"{_format_labels(('route', 'method', 'status'), labels)}}} {count}")
+        lines += ["# HELP sonata_slow_queries_total SQL statements slower than SLOW_QUERY_MS.",
+                  "# TYPE sonata_slow_queries_total counter",
+                  f"sonata_slow_queries_total {slow_queries}"]
+        for histogram in (self.duration, self.sql_duration, self.sql_queries,
+                          self.serialization_duration):
+            lines += histogram.render()
+        return lines
+
+
+request_metrics = RequestMetrics()
+
+
+# Shares the metrics of the server workers through files in METRICS_DIR, one per process
+class MetricsExporter:
+    def __init__(self, directory: str) -> None:
+        self.directory = pathlib.Path(directory) if directory else None
+        self._task = PeriodicTask("sonata-metrics")
+
+    def _path(self, pid: Optional[int] = None) -> pathlib.Path:
+        assert self.directory is not None
+        return self.directory / f"{pid or os.getpid()}.prom"
+
+    def write(self, render: Callable[[], List[str]]):
+        if self.directory is None:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        label = f'worker="{os.getpid()}"'
+        lines = [line if line.startswith("#") else _add_label(line, label) for line in render()]
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp:
+            tmp.write("\n".join(lines) + "\n")
+        os.replace(tmp_name, self._path())
+
+    # The samples of every process, with the ones of this process up to date
+    def collect(self, render: Callable[[], List[str]]) -> List[str]:
+        if self.directory is None:
+            return render()
+        self.write(render)
+        expositions = []
+        for path in sorted(self.directory.glob("*.prom")):
+            try:
+                expositions.append(path.read_text(encoding="utf-8").splitlines())
+            except FileNotFoundError:
+                # The worker exited since the directory was listed
+                continue
+        return merge_expositions(expositions)
+
+    # Removes the file of a process that exited, so its samples are no longer returned
+    def remove(self, pid: int):
+        if self.directory is not None:
+            self._path(pid).unlink(missing_ok=True)
+
+    # Removes the files of processes of an earlier run of the server
+    def clear(self):
+        if self.directory is not None:
+            for path in self.directory.glob("*.prom"):
+                path.unlink(missing_ok=True)
+
+    def start(self, interval: float, render: Callable[[], List[str]]):
+        if self.directory is not None:
+            self._task.start(interval, lambda: self._flush(render))
+
+    def stop(self):
+        self._task.stop()
+        self.remove(os.getpid())
+
+    def _flush(self, render: Callable[[], List[str]]):
+        try:
+            self.write(render)
+        except OSError:
+            _logger.exception("Writing the metrics failed")
+
+
+metrics_exporter = MetricsExporter(app.config["METRICS_DIR"])
+
+
+class _RequestTimings:
+    def __init__(self) -> None:
+        self.started_at = time.perf_counter()
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.serialization_seconds = 0.0
+
+
+def _current_timings() -> Optional[_RequestTimings]:
+    if not has_request_context():
+        return None
+    return g.get("request_timings")
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query(connection, *_):
+    connection.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_query(connection, _, statement, *__):
+    elapsed = time.perf_counter() - connection.info["query_started_at"].pop()
+    timings = _current_timings()
+    if timings is not None:
+        timings.sql_queries += 1
+        timings.sql_seconds += elapsed
+
+    threshold_ms = app.config["SLOW_QUERY_MS"]
+    if threshold_ms and elapsed * 1000 >= threshold_ms:
+        request_metrics.count_slow_query()
+        _slow_query_logger.warning(
+            "Slow query (%.1fms) during %s: %s", elapsed * 1000,
+            _route_label() if has_request_context() else "background work",
+            " ".join(statement.split())[:_MAX_LOGGED_STATEMENT])
+
+
+@event.listens_for(Engine, "handle_error")
+def _fail_query(context):
+    started = context.connection.info.get("query_started_at") if context.connection else None
+    if started:
+        started.pop()
+
+
+# Times the encoding of JSON responses
+class TimedJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        start = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            timings = _current_timings()
+            if timings is not None:
+                timings.serialization_seconds += time.perf_counter() - start
+
+
+app.json = TimedJSONProvider(app)
+
+
+def _route_label() -> str:
+    # Unmatched paths are grouped, so scanners do not create a series per path
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@app.before_request
+def _start_request_timings():
+    g.request_timings = _RequestTimings()
+
+
+# Registered before the other after_request hooks, so it runs last and its total includes them
+@app.after_request
+def _record_request_timings(response: Response):
+    timings = g.pop("request_timings", None)
+    if timings is None:
+        return response
+    total = time.perf_counter() - timings.started_at
+    request_metrics.record((_route_label(), request.method), response.status_code, total,
+                           timings)
+    if app.config["SERVER_TIMING"]:
+        response.headers.add("Server-Timing", ", ".join([
+            f'sql;dur={timings.sql_seconds * 1000:.2f};desc="{timings.sql_queries} queries"',
+            f"serialize;dur={timings.serialization_seconds * 1000:.2f}",
+            f"total;dur={total * 1000:.2f}",
+        ]))
+    return response
@@ -0,0 +1,295 @@
+import atexit
+import contextlib
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+import sqlalchemy
+from flask import Flask
+from sqlalchemy import text
+
+from web.base import app, database, file_cache, storage
+from web.database_config import begin_write
+from web.models.upload import UPLOAD_TEMP_PREFIX
+from web.periodic import PeriodicTask
+from web.storage import BlobInfo
+
+if sys.platform == "win32":
+    import msvcrt  # pylint: disable=import-error
+else:
+    import fcntl
+
+_logger = logging.getLogger(__name__)
+
+# Files nothing points at. New rows get a grace period, since an upload inserts its row before
+# the piece or user that references it
+_ORPHANED_FILES = """SELECT id, size FROM files
+    WHERE id > :after AND ref_count <= 0
+        AND (created_at IS NULL OR created_at < datetime('now', :grace))
+        AND NOT EXISTS (SELECT 1 FROM pieces WHERE pieces.file_id = files.id)
+        AND NOT EXISTS (SELECT 1 FROM users WHERE users.profile_picture_id = files.id)
+    ORDER BY id LIMIT :limit"""
+
+_OLD_UPLOADS = """SELECT id FROM upload_sessions
+    WHERE id > :after AND created_at < datetime('now', :ttl)
+    ORDER BY id LIMIT :limit"""
+
+# The value of PRAGMA auto_vacuum once it is set to INCREMENTAL
+_AUTO_VACUUM_INCREMENTAL = 2
+
+
+def _freelist_count(connection: sqlalchemy.Connection) -> int:
+    return connection.exec_driver_sql("PRAGMA freelist_count").scalar_one()
+
+
+# Deletes orphaned files and unreferenced blobs in small write transactions, so requests only
+# wait for one batch, and gives the freed pages back to the file system. One process runs it at a
+# time, the one holding the lock file in the blob storage
+class MaintenanceWorker:  # pylint: disable=too-many-instance-attributes
+    def __init__(self, flask_app: Flask, batch_size: int, grace: float, vacuum_pages: int,
+                 dry_run: bool) -> None:
+        self.app = flask_app
+        self.batch_size = batch_size
+        self.grace = grace
+        self.vacuum_pages = vacuum_pages
+        self.dry_run = dry_run
+        self._task = PeriodicTask("sonata-maintenance")
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Any] = {
+            "runs": 0,
+            "skipped_runs": 0,
+            "failed_runs": 0,
+            "orphaned_files": 0,
+            "orphaned_blobs": 0,
+            "freed_bytes": 0,
+            "expired_uploads": 0,
+            "vacuumed_pages": 0,
+            "last_run_at": None,
+            "last_run_ms": None,
+        }
+
+    def start(self, interval: float):
+        self._task.start(interval, self._run_scheduled)
+
+    def stop(self):
+        self._task.stop()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._metrics, "dry_run": self.dry_run}
+
+    def _run_scheduled(self):
+        try:
+            with self.app.app_context():
+                self.run_exclusive()
+        except Exception:  # pylint: disable=broad-except
+            _logger.exception("Maintenance run failed")
+            self._count("failed_runs")
+
+    # Returns None when another process is already running the maintenance
+    def run_exclusive(self) -> Optional[Dict[str, int]]:
+        with maintenance_lock() as locked:
+            if not locked:
+                self._count("skipped_runs")
+                return None
+            return self.run()
+
+    def run(self) -> Dict[str, int]:
+        start = time.perf_counter()
+        summary = {
+            "orphaned_files": self._collect_files(),
+            **self._collect_blobs(),
+            "expired_uploads": self._expire_uploads(),
+            "vacuumed_pages": self._vacuum(),
+        }
+        with self._lock:
+            self._metrics["runs"] += 1
+            for key, value in summary.items():
+                self._metrics[key] += value
+            self._metrics["last_run_at"] = time.time()
+            self._metrics["last_run_ms"] = (time.perf_counter() - start) * 1000
+        return summary
+
+    def _count(self, key: str):
+        with self._lock:
+            self._metrics[key] += 1
+
+    def _collect_files(self) -> int:
+        found = 0
+        after = 0
+        while True:
+            with begin_write(database.engine) as connection:
+                rows = connection.execute(text(_ORPHANED_FILES), {
+                    "after": after, "grace": f"-{self.grace} seconds", "limit": self.batch_size,
+                }).all()
+                if not rows:
+                    return found
+                file_ids = [file_id for file_id, _ in rows]
+                if not self.dry_run:
+                    connection.execute(text("DELETE FROM files WHERE id IN :ids").bindparams(
+                        sqlalchemy.bindparam("ids", expanding=True)), {"ids": file_ids})
+            if not self.dry_run:
+                for file_id in file_ids:
+                    file_cache.delete(file_id)
+            found += len(rows)
+            after = file_ids[-1]
+
+    def _collect_blobs(self) -> Dict[str, int]:
+        found = 0
+        freed = 0
+        batch: List[BlobInfo] = []
+        blobs = storage.blobs()
+        while True:
+            cutoff = time.time() - self.grace
+            for blob in blobs:
+                # Blobs that were just written or reused may be about to get their row
+                if blob.modified_at < cutoff:
+                    batch.append(blob)
+                    if len(batch) >= self.batch_size:
+                        break
+            if not batch:
+                return {"orphaned_blobs": found, "freed_bytes": freed}
+            for blob in self._delete_unreferenced(batch):
+                found += 1
+                freed += blob.size
+            batch = []
+
+    def _delete_unreferenced(self, batch: List[BlobInfo]) -> List[BlobInfo]:
+        # The write lock keeps uploads from adding rows for these paths until they are deleted
+        with begin_write(database.engine) as connection:
+            referenced = set(connection.execute(
+                text("SELECT path FROM files WHERE path IN :paths").bindparams(
+                    sqlalchemy.bindparam("paths", expanding=True)),
+                {"paths": [blob.path for blob in batch]}).scalars())
+            cutoff = time.time() - self.grace
+            unreferenced = []
+            for blob in batch:
+                if blob.path in referenced:
+                    continue
+                try:
+                    modified_at = os.stat(storage.local_path(blob.path)).st_mtime
+                except FileNotFoundError:
+                    continue
+                if modified_at < cutoff:
+                    unreferenced.append(blob)
+                    if not self.dry_run:
+                        storage.delete(blob.path)
+            return unreferenced
+
+    # Upload sessions that received nothing for MAINTENANCE_UPLOAD_TTL_S, and the temporary files
+    # of uploads without a session
+    def _expire_uploads(self) -> int:
+        ttl = self.app.config["MAINTENANCE_UPLOAD_TTL_S"]
+        cutoff = time.time() - ttl
+        expired = 0
+        after = 0
+        while True:
+            with begin_write(database.engine) as connection:
+                upload_ids = connection.execute(text(_OLD_UPLOADS), {
+                    "after": after, "ttl": f"-{ttl} seconds", "limit": self.batch_size,
+                }).scalars().all()
+                if not upload_ids:
+                    break
+                stale = [upload_id for upload_id in upload_ids
+                         if _temp_modified_at(f"{UPLOAD_TEMP_PREFIX}{upload_id}") < cutoff]
+                if stale and not self.dry_run:
+                    connection.execute(
+                        text("DELETE FROM upload_sessions WHERE id IN :ids").bindparams(
+                            sqlalchemy.bindparam("ids", expanding=True)), {"ids": stale})
+            if not self.dry_run:
+                for upload_id in stale:
+                    storage.temp_path(f"{UPLOAD_TEMP_PREFIX}{upload_id}").unlink(missing_ok=True)
+            expired += len(stale)
+            after = upload_ids[-1]
+        return expired + self._delete_upload_files(cutoff)
+
+    # Files left by uploads whose session was finished or deleted while a chunk was written
+    def _delete_upload_files(self, cutoff: float) -> int:
+        temp_files = {}
+        for temp in storage.temp_files(UPLOAD_TEMP_PREFIX):
+            upload_id = temp.path[len(UPLOAD_TEMP_PREFIX):]
+            if upload_id.isdigit() and temp.modified_at < cutoff:
+                temp_files[int(upload_id)] = temp.path
+        if not temp_files:
+            return 0
+        with database.engine.connect() as connection:
+            sessions = set(connection.execute(
+                text("SELECT id FROM upload_sessions WHERE id IN :ids").bindparams(
+                    sqlalchemy.bindparam("ids", expanding=True)),
+                {"ids": list(temp_files)}).scalars())
+        orphaned = [name for upload_id, name in temp_files.items() if upload_id not in sessions]
+        if not self.dry_run:
+            for name in orphaned:
+                storage.temp_path(name).unlink(missing_ok=True)
+        return len(orphaned)
+
+    def _vacuum(self) -> int:
+        with begin_write(database.engine) as connection:
+            if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() \
+                    != _AUTO_VACUUM_INCREMENTAL:
+                return 0
+            free_pages = _freelist_count(connection)
+            if self.dry_run:
+                return min(free_pages, self.vacuum_pages)
+            # Each step of the pragma frees one page, so the cursor has to be read to the end
+            cursor = connection.connection.cursor()
+            try:
+                cursor.execute(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)})")
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            return free_pages - _freelist_count(connection)
+
+
+# Yields whether the lock file in the blob storage was taken. It is released when the file is
+# closed, also when the process dies
+@contextlib.contextmanager
+def maintenance_lock() -> Iterator[bool]:
+    with open(storage.temp_path("maintenance.lock"), "w", encoding="utf-8") as lock:
+        try:
+            if sys.platform == "win32":
+                msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        yield True
+
+
+def _temp_modified_at(name: str) -> float:
+    try:
+        return storage.temp_path(name).stat().st_mtime
+    except FileNotFoundError:
+        return 0
+
+
+# Converts an existing database, since auto_vacuum only changes with a full VACUUM
+def enable_incremental_vacuum(engine: sqlalchemy.Engine):
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+        cursor.close()
+    finally:
+        connection.close()
+
+
+app.config["MAINTENANCE_INTERVAL_S"] = float(os.environ.get("MAINTENANCE_INTERVAL_S", 0))
+app.config["MAINTENANCE_BATCH_SIZE"] = int(os.environ.get("MAINTENANCE_BATCH_SIZE", 100))
+app.config["MAINTENANCE_GRACE_S"] = float(os.environ.get("MAINTENANCE_GRACE_S", 3600))
+app.config["MAINTENANCE_VACUUM_PAGES"] = int(os.environ.get("MAINTENANCE_VACUUM_PAGES", 1000))
+# Upload sessions are expired once they received nothing for this long
+app.config["MAINTENANCE_UPLOAD_TTL_S"] = float(os.environ.get("MAINTENANCE_UPLOAD_TTL_S", 86400))
+app.config["MAINTENANCE_DRY_RUN"] = os.environ.get("MAINTENANCE_DRY_RUN", "0") == "1"
+
+maintenance_worker = MaintenanceWorker(app,
+                                       app.config["MAINTENANCE_BATCH_SIZE"],
+                                       app.config["MAINTENANCE_GRACE_S"],
+                                       app.config["MAINTENANCE_VACUUM_PAGES"],
+                                       app.config["MAINTENANCE_DRY_RUN"])
+atexit.register(maintenance_worker.stop)
@@ -2,3 +2,6 @@ from .file import *
 from .piece import *
 from .user import *
 from .tags import *
+from .upload import *
+from .facets import *
+from .tombstones import *
@@ -0,0 +1,13 @@
+from web.base import database
+
+# Per user piece counts for every state, instrument and tag, kept up to date by the triggers in
+# web.stats so the dashboard numbers never scan the pieces
+piece_facets = database.Table('piece_facets',
+                              database.Column(
+                                  'user_id', database.Integer, database.ForeignKey('users.id'),
+                                  primary_key=True),
+                              database.Column('facet', database.Text, primary_key=True),
+                              database.Column('value', database.Text, primary_key=True),
+                              database.Column(
+                                  'count', database.Integer, nullable=False, server_default="0")
+                              )
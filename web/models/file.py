@@ -1,4 +1,8 @@
-from web.base import database, hasher
+from sqlalchemy.orm import deferred
+from sqlalchemy.sql import func
+
+from web.base import database
+from web.ids import encode_id
 
 
 class File(database.Model):  # type: ignore
@@ -6,11 +10,24 @@ class File(database.Model):  # type: ignore
 
     id = database.Column(database.Integer, primary_key=True,
                          autoincrement=True, nullable=False)
-    content = database.Column(database.LargeBinary, nullable=False)
+    # Legacy inline content, emptied by the `migrate-files` command. New files only
+    # keep their metadata here and live in `storage` under `path`
+    content = deferred(database.Column(
+        database.LargeBinary, nullable=False, default=b""))
     file_type = database.Column(database.String, nullable=False)
+    size = database.Column(database.Integer)
+    sha256 = database.Column(database.String(64), index=True)
+    path = database.Column(database.String, index=True)
+    # Pieces and users pointing at this row, kept by the triggers in web.file_refs. Uploads of
+    # content that is already stored share the existing row
+    ref_count = database.Column(database.Integer, nullable=False, server_default="0")
+    created_at = database.Column(
+        database.DateTime, default=func.now())  # pylint: disable=not-callable
 
     def to_dict(self):
         return {
-            'id': hasher.encode(self.id),
-            'content': self.content
+            'id': encode_id(self.id),
+            'file_type': self.file_type,
+            'size': self.size,
+            'sha256': self.sha256
         }
@@ -1,13 +1,24 @@
 from sqlalchemy.sql import func
 
-from web.base import database, hasher
+from web.base import database
+from web.ids import encode_ids
+from web.serialization import Versioned, cached_dict
 
 
-class Piece(database.Model):  # type: ignore
+class Piece(Versioned, database.Model):  # type: ignore
     __tablename__ = 'pieces'
     __table_args__ = (
         database.UniqueConstraint(
             'user_id', 'name', 'instrument', name='unique_piece_name_per_user'),
+        # Keyset pagination indexes for the pieces listing
+        database.Index('ix_pieces_user_added_at', 'user_id', 'added_at', 'id'),
+        database.Index('ix_pieces_user_name', 'user_id', 'name', 'id'),
+        database.Index('ix_pieces_user_state_added_at',
+                       'user_id', 'state', 'added_at', 'id'),
+        database.Index('ix_pieces_user_instrument_added_at',
+                       'user_id', 'instrument', 'added_at', 'id'),
+        database.Index('ix_pieces_user_change_seq', 'user_id', 'change_seq'),
+        database.Index('ix_pieces_file_id', 'file_id'),
     )
 
     id = database.Column(database.Integer, primary_key=True,
@@ -23,20 +34,28 @@ class Piece(database.Model):  # type: ignore
     file_id = database.Column(
         database.Integer, database.ForeignKey('files.id'))
     file_type = database.Column(database.String)
+    # Set by the triggers in web.changes
+    change_seq = database.Column(database.Integer, nullable=False, server_default="0")
+    updated_at = database.Column(database.DateTime)
 
     user = database.relationship('User', back_populates='pieces')
     file = database.relationship('File', back_populates='pieces')
 
-    def to_dict(self):
+    def _columns_dict(self):
+        piece_id, user_id, file_id = encode_ids((self.id, self.user_id, self.file_id))
         return {
-            'id': hasher.encode(self.id),
+            'id': piece_id,
             'name': self.name,
             'description': self.description,
             'instrument': self.instrument,
             'state': self.state,
-            'user_id': hasher.encode(self.user_id),
+            'user_id': user_id,
             'added_at': self.added_at.isoformat(),
-            'file_id': hasher.encode(self.file_id) if self.file_id else None,
+            'file_id': file_id,
             'file_type': self.file_type,
-            "tags": [tag.to_dict() for tag in self.tags]  # type: ignore
         }
+
+    def to_dict(self):
+        piece = cached_dict(self, self._columns_dict)
+        piece["tags"] = [tag.to_dict() for tag in self.tags]  # type: ignore
+        return piece
@@ -1,12 +1,15 @@
-from web.base import database, hasher
+from web.base import database
+from web.ids import encode_ids
 from web.models import Piece, User, File
+from web.serialization import Versioned, cached_dict
 
 
-class Tag(database.Model):  # type: ignore
+class Tag(Versioned, database.Model):  # type: ignore
     __tablename__ = 'tags'
     __table_args__ = (
         database.UniqueConstraint(
             'user_id', 'tag', name='unique_tag_name_per_user'),
+        database.Index('ix_tags_user_change_seq', 'user_id', 'change_seq'),
     )
 
     id = database.Column(database.Integer, primary_key=True,
@@ -15,26 +18,37 @@ class Tag(database.Model):  # type: ignore
         database.Integer, database.ForeignKey('users.id'), nullable=False)
     tag = database.Column(database.Text, nullable=False)
     color = database.Column(database.Text, nullable=False)
+    # Set by the triggers in web.changes
+    change_seq = database.Column(database.Integer, nullable=False, server_default="0")
+    updated_at = database.Column(database.DateTime)
 
     user = database.relationship('User', back_populates='tags')
     pieces = database.relationship(
         'Piece', secondary='pieces_tags', back_populates='tags')
 
-    def to_dict(self):
+    def _columns_dict(self):
+        tag_id, user_id = encode_ids((self.id, self.user_id))
         return {
-            'id': hasher.encode(self.id),
-            'user_id': hasher.encode(self.user_id),
+            'id': tag_id,
+            'user_id': user_id,
             'tag': self.tag,
             'color': self.color
         }
 
+    def to_dict(self):
+        return cached_dict(self, self._columns_dict)
+
 
 # Creating relationships for the many-to-many association between pieces and tags
 pieces_tags = database.Table('pieces_tags',
                              database.Column(
                                  'piece_id', database.Integer, database.ForeignKey('pieces.id')),
                              database.Column(
-                                 'tag_id', database.Integer, database.ForeignKey('tags.id'))
+                                 'tag_id', database.Integer, database.ForeignKey('tags.id')),
+                             database.Index(
+                                 'ix_pieces_tags_piece_tag', 'piece_id', 'tag_id'),
+                             database.Index(
+                                 'ix_pieces_tags_tag_piece', 'tag_id', 'piece_id')
                              )
 
 Piece.tags = database.relationship(  # type:ignore
@@ -0,0 +1,14 @@
+from web.base import database
+
+# Pieces and tags deleted by a user, kept so clients syncing from an older change can drop them
+tombstones = database.Table('tombstones',
+                            database.Column(
+                                'user_id', database.Integer, database.ForeignKey('users.id'),
+                                nullable=False),
+                            database.Column('kind', database.Text, nullable=False),
+                            database.Column('row_id', database.Integer, nullable=False),
+                            database.Column('change_seq', database.Integer, nullable=False),
+                            database.Column('deleted_at', database.DateTime, nullable=False),
+                            database.Index(
+                                'ix_tombstones_user_change_seq', 'user_id', 'change_seq')
+                            )
@@ -0,0 +1,39 @@
+from sqlalchemy.sql import func
+
+from web.base import database
+from web.ids import encode_ids
+
+
+# The received bytes of an upload are kept in the temporary file upload-<id> of the storage
+UPLOAD_TEMP_PREFIX = "upload-"
+
+
+class UploadSession(database.Model):  # type: ignore
+    __tablename__ = 'upload_sessions'
+
+    id = database.Column(database.Integer, primary_key=True,
+                         autoincrement=True, nullable=False)
+    user_id = database.Column(
+        database.Integer, database.ForeignKey('users.id'), nullable=False)
+    piece_id = database.Column(
+        database.Integer, database.ForeignKey('pieces.id'), nullable=False)
+    file_type = database.Column(database.String, nullable=False)
+    received_size = database.Column(
+        database.Integer, nullable=False, default=0)
+    next_chunk = database.Column(database.Integer, nullable=False, default=0)
+    created_at = database.Column(
+        database.DateTime, nullable=False, default=func.now())  # pylint: disable=not-callable
+
+    @property
+    def temp_name(self) -> str:
+        return f"{UPLOAD_TEMP_PREFIX}{self.id}"
+
+    def to_dict(self):
+        upload_id, piece_id = encode_ids((self.id, self.piece_id))
+        return {
+            'id': upload_id,
+            'piece_id': piece_id,
+            'file_type': self.file_type,
+            'received_size': self.received_size,
+            'next_chunk': self.next_chunk
+        }
@@ -1,9 +1,11 @@
 from sqlalchemy.sql import func
 
-from web.base import database, hasher
+from web.base import database
+from web.ids import encode_ids
+from web.serialization import Versioned, cached_dict
 
 
-class User(database.Model):  # type: ignore
+class User(Versioned, database.Model):  # type: ignore
     __tablename__ = 'users'
 
     id = database.Column(database.Integer, primary_key=True,
@@ -16,15 +18,21 @@ class User(database.Model):  # type: ignore
         database.DateTime, nullable=False, default=func.now())  # pylint: disable=not-callable
     profile_picture_id = database.Column(
         database.Integer, database.ForeignKey('files.id'))
+    # Bumped by the triggers in web.changes on every change to the user's pieces and tags
+    data_version = database.Column(database.Integer, nullable=False, server_default="0")
 
     pieces = database.relationship('Piece', back_populates='user')
     profile_picture = database.relationship(
         'File', foreign_keys=[profile_picture_id])
 
-    def to_dict(self):
+    def _columns_dict(self):
+        user_id, profile_picture_id = encode_ids((self.id, self.profile_picture_id))
         return {
-            'id': hasher.encode(self.id),
+            'id': user_id,
             'name': self.name,
             'joined_at': self.joined_at.isoformat(),
-            'profile_picture_id': hasher.encode(self.profile_picture_id) if self.profile_picture_id else None  # pylint: disable=line-too-long
+            'profile_picture_id': profile_picture_id
         }
+
+    def to_dict(self):
+        return cached_dict(self, self._columns_dict)
@@ -0,0 +1,188 @@
+import abc
+import atexit
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from web.base import app
+from web.exceptions import SonataException
+
+_T = TypeVar("_T")
+
+
+class PasswordHasher(abc.ABC):
+    @abc.abstractmethod
+    def identifies(self, hashed: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def hash(self, password: str, salt: str) -> str:
+        ...
+
+    def verify(self, password: str, salt: str, hashed: str) -> bool:
+        return hmac.compare_digest(self.hash(password, salt), hashed)
+
+    def needs_rehash(self, hashed: str) -> bool:
+        return not self.identifies(hashed)
+
+
+# The original format: an unprefixed hex digest of a single MD5 pass
+class LegacyMd5Hasher(PasswordHasher):
+    def identifies(self, hashed: str) -> bool:
+        return "$" not in hashed
+
+    def hash(self, password: str, salt: str) -> str:
+        return hashlib.md5(password.encode() + salt.encode()).hexdigest()
+
+
+# Stored as scrypt$<n>$<r>$<p>$<hex digest>, so the cost can be raised later
+class ScryptHasher(PasswordHasher):
+    prefix = "scrypt"
+
+    def __init__(self, n: int, r: int, p: int, dklen: int = 64) -> None:
+        self.n = n
+        self.r = r
+        self.p = p
+        self.dklen = dklen
+
+    def identifies(self, hashed: str) -> bool:
+        return hashed.startswith(f"{self.prefix}$")
+
+    def _derive(self, password: str, salt: str, n: int, r: int, p: int) -> str:
+        digest = hashlib.scrypt(password.encode(), salt=salt.encode(), n=n, r=r, p=p,
+                                dklen=self.dklen, maxmem=256 * n * r + 1024 * 1024)
+        return f"{self.prefix}${n}${r}${p}${digest.hex()}"
+
+    def hash(self, password: str, salt: str) -> str:
+        return self._derive(password, salt, self.n, self.r, self.p)
+
+    def verify(self, password: str, salt: str, hashed: str) -> bool:
+        _, n, r, p, _ = hashed.split("$")
+        return hmac.compare_digest(self._derive(password, salt, int(n), int(r), int(p)), hashed)
+
+    def needs_rehash(self, hashed: str) -> bool:
+        return not hashed.startswith(f"{self.prefix}${self.n}${self.r}${self.p}$")
+
+
+# Returns how long the call ran, measured where it ran, since the clocks of processes differ
+def _timed_call(func: Callable[..., _T], *args: Any) -> Tuple[float, _T]:
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+class HashingPool:
+    def __init__(self, workers: int, max_concurrency: int, queue_timeout: float) -> None:
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._metrics = {
+            "calls": 0,
+            "rejected": 0,
+            "in_flight": 0,
+            "queue_seconds_total": 0.0,
+            "queue_seconds_max": 0.0,
+            "run_seconds_total": 0.0,
+        }
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Spawned rather than forked, the workers are started from a threaded process.
+                # Shut down by shutdown(), on exit and from gunicorn's worker_exit
+                self._executor = ProcessPoolExecutor(  # pylint: disable=consider-using-with
+                    self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def run(self, func: Callable[..., _T], *args: Any) -> _T:
+        queued_at = time.perf_counter()
+        # Released in the finally below, a with block cannot time out
+        if not self._slots.acquire(  # pylint: disable=consider-using-with
+                timeout=self.queue_timeout):
+            with self._lock:
+                self._metrics["rejected"] += 1
+            raise SonataException(503, "Server busy, try again later")
+        try:
+            with self._lock:
+                self._metrics["in_flight"] += 1
+            if self.workers > 0:
+                run_seconds, result = self._get_executor().submit(
+                    _timed_call, func, *args).result()
+            else:
+                run_seconds, result = _timed_call(func, *args)
+        finally:
+            self._slots.release()
+            finished_at = time.perf_counter()
+            with self._lock:
+                self._metrics["in_flight"] -= 1
+
+        # Waiting for a slot and a hashing process, and sending the call and its result
+        queue_seconds = max(finished_at - queued_at - run_seconds, 0.0)
+        with self._lock:
+            self._metrics["calls"] += 1
+            self._metrics["queue_seconds_total"] += queue_seconds
+            self._metrics["queue_seconds_max"] = max(
+                self._metrics["queue_seconds_max"], queue_seconds)
+            self._metrics["run_seconds_total"] += run_seconds
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._metrics)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+app.config["PASSWORD_SCRYPT_N"] = int(
+    os.environ.get("PASSWORD_SCRYPT_N", 2 ** 14))
+app.config["PASSWORD_SCRYPT_R"] = int(os.environ.get("PASSWORD_SCRYPT_R", 8))
+app.config["PASSWORD_SCRYPT_P"] = int(os.environ.get("PASSWORD_SCRYPT_P", 1))
+# Hashing processes per server process, so WEB_CONCURRENCY of them in total under gunicorn. Each
+# one imports the app, so the default is a single process
+app.config["PASSWORD_HASH_WORKERS"] = int(os.environ.get("PASSWORD_HASH_WORKERS", 1))
+app.config["PASSWORD_HASH_MAX_CONCURRENCY"] = int(os.environ.get(
+    "PASSWORD_HASH_MAX_CONCURRENCY", 2 * app.config["PASSWORD_HASH_WORKERS"] or 1))
+app.config["PASSWORD_HASH_QUEUE_TIMEOUT"] = float(
+    os.environ.get("PASSWORD_HASH_QUEUE_TIMEOUT", 10))
+
+current_hasher = ScryptHasher(app.config["PASSWORD_SCRYPT_N"],
+                              app.config["PASSWORD_SCRYPT_R"],
+                              app.config["PASSWORD_SCRYPT_P"])
+_hashers: List[PasswordHasher] = [current_hasher, LegacyMd5Hasher()]
+
+hashing_pool = HashingPool(app.config["PASSWORD_HASH_WORKERS"],
+                           app.config["PASSWORD_HASH_MAX_CONCURRENCY"],
+                           app.config["PASSWORD_HASH_QUEUE_TIMEOUT"])
+atexit.register(hashing_pool.shutdown)
+
+
+def _get_hasher(hashed: str) -> Optional[PasswordHasher]:
+    for hasher in _hashers:
+        if hasher.identifies(hashed):
+            return hasher
+    return None
+
+
+def hash_password(password: str, salt: str) -> str:
+    return hashing_pool.run(current_hasher.hash, password, salt)
+
+
+# Returns whether the password matches, and its new hash if the stored one is outdated
+def verify_password(password: str, salt: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    hasher = _get_hasher(hashed)
+    if hasher is None or not hashing_pool.run(hasher.verify, password, salt, hashed):
+        return False, None
+    if current_hasher.needs_rehash(hashed):
+        return True, hash_password(password, salt)
+    return True, None
@@ -0,0 +1,32 @@
+import threading
+from typing import Callable, Optional
+
+
+# Calls a function every interval seconds on a daemon thread, until stopped. Started again in
+# forked server workers, which do not inherit the thread
+class PeriodicTask:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, interval: float, func: Callable[[], None]):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval, func),
+                                            name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        self._stopped.set()
+        if thread is not None and thread.is_alive():
+            thread.join()
+
+    def _run(self, interval: float, func: Callable[[], None]):
+        while not self._stopped.wait(interval):
+            func()
@@ -0,0 +1,56 @@
+from typing import List
+
+import sqlalchemy
+from sqlalchemy.schema import CreateIndex
+
+from web.base import database
+from web.file_refs import ensure_file_refs
+from web.search import create_search_index, rebuild_search_index, search_index_exists
+
+
+def _add_column_sql(table: sqlalchemy.Table, column: sqlalchemy.Column) -> str:
+    dialect = database.engine.dialect
+    column_type = column.type.compile(dialect=dialect)
+    sql = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+    if column.server_default is not None:
+        default = column.server_default.arg  # type: ignore
+        if isinstance(default, str):
+            default = f"'{default}'"
+        else:
+            default = default.compile(dialect=dialect)
+        sql += f" DEFAULT {default}"
+        if not column.nullable:
+            sql += " NOT NULL"
+    return sql
+
+
+# create_all only creates missing tables, so columns and indexes added to existing
+# tables after a database was created are applied here
+def upgrade_schema() -> List[str]:
+    database.create_all()
+    inspector = sqlalchemy.inspect(database.engine)
+    statements = []
+    for table in database.metadata.sorted_tables:
+        existing_columns = {column["name"]
+                            for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                statements.append(_add_column_sql(table, column))
+
+        existing_indexes = {index["name"]
+                            for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                statements.append(
+                    str(CreateIndex(index).compile(dialect=database.engine.dialect)))
+
+    with database.engine.begin() as connection:
+        for statement in statements:
+            connection.exec_driver_sql(statement)
+        ensure_file_refs(connection)
+        # The search index of an existing database is filled from the rows it already has
+        if not search_index_exists(connection):
+            create_search_index(connection)
+            rebuild_search_index(connection)
+            statements.append("CREATE VIRTUAL TABLE pieces_fts")
+    return statements
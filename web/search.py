@@ -0,0 +1,108 @@
+import html
+import secrets
+from typing import Any, List, NamedTuple
+
+import sqlalchemy
+from sqlalchemy import event, text
+
+from web.models.piece import Piece
+
+# An external content index over the pieces table, so the text is not stored twice. The triggers
+# keep it in sync with every insert, update and delete, including raw SQL ones
+_SEARCH_INDEX_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS pieces_fts USING fts5(
+        name, description, instrument,
+        content='pieces', content_rowid='id', tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS pieces_fts_insert AFTER INSERT ON pieces BEGIN
+        INSERT INTO pieces_fts(rowid, name, description, instrument)
+        VALUES (new.id, new.name, new.description, new.instrument);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS pieces_fts_delete AFTER DELETE ON pieces BEGIN
+        INSERT INTO pieces_fts(pieces_fts, rowid, name, description, instrument)
+        VALUES ('delete', old.id, old.name, old.description, old.instrument);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS pieces_fts_update
+    AFTER UPDATE OF name, description, instrument ON pieces BEGIN
+        INSERT INTO pieces_fts(pieces_fts, rowid, name, description, instrument)
+        VALUES ('delete', old.id, old.name, old.description, old.instrument);
+        INSERT INTO pieces_fts(rowid, name, description, instrument)
+        VALUES (new.id, new.name, new.description, new.instrument);
+    END""",
+]
+
+# Column weights for bm25, in the order of the index columns
+_NAME_WEIGHT = 10.0
+_DESCRIPTION_WEIGHT = 1.0
+_INSTRUMENT_WEIGHT = 5.0
+
+_SNIPPET_TOKENS = 12
+# The highlighted parts are marked with a random token per query, which the stored text can not
+# contain, and turned into tags after the rest of the snippet is escaped
+_HIGHLIGHT_TOKEN_BYTES = 16
+
+_SEARCH_QUERY = text(f"""
+    SELECT pieces_fts.rowid AS id,
+           snippet(pieces_fts, -1, :start, :end, '…', {_SNIPPET_TOKENS}) AS snippet,
+           bm25(pieces_fts, {_NAME_WEIGHT}, {_DESCRIPTION_WEIGHT}, {_INSTRUMENT_WEIGHT}) AS rank
+    FROM pieces_fts JOIN pieces ON pieces.id = pieces_fts.rowid
+    WHERE pieces_fts MATCH :query AND pieces.user_id = :user_id
+    ORDER BY rank
+    LIMIT :limit
+""")
+
+
+class SearchMatch(NamedTuple):
+    piece_id: int
+    snippet: str
+    rank: float
+
+
+def search_index_exists(connection: sqlalchemy.Connection) -> bool:
+    return connection.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'pieces_fts'"
+    )).first() is not None
+
+
+def create_search_index(connection: sqlalchemy.Connection):
+    for statement in _SEARCH_INDEX_DDL:
+        connection.exec_driver_sql(statement)
+
+
+def rebuild_search_index(connection: sqlalchemy.Connection):
+    connection.exec_driver_sql("INSERT INTO pieces_fts(pieces_fts) VALUES ('rebuild')")
+
+
+@event.listens_for(Piece.__table__, "after_create")
+def _create_search_index(_, connection: sqlalchemy.Connection, **__):
+    create_search_index(connection)
+
+
+@event.listens_for(Piece.__table__, "before_drop")
+def _drop_search_index(_, connection: sqlalchemy.Connection, **__):
+    connection.exec_driver_sql("DROP TABLE IF EXISTS pieces_fts")
+
+
+# Every word is quoted, so user input can not use the FTS5 query syntax, and matched as a prefix
+# for search as you type
+def to_match_query(query: str) -> str:
+    terms = ['"' + term.replace('"', '""') + '"*' for term in query.split()]
+    return " ".join(terms)
+
+
+def _highlight(snippet: str, start: str, end: str) -> str:
+    return html.escape(snippet or "") \
+        .replace(start, "<mark>") \
+        .replace(end, "</mark>")
+
+
+def search_pieces(session: Any, user_id: int, query: str, limit: int) -> List[SearchMatch]:
+    token = secrets.token_hex(_HIGHLIGHT_TOKEN_BYTES)
+    start, end = f"[{token}[", f"]{token}]"
+    rows = session.execute(_SEARCH_QUERY, {
+        "query": to_match_query(query),
+        "user_id": user_id,
+        "limit": limit,
+        "start": start,
+        "end": end,
+    })
+    return [SearchMatch(row.id, _highlight(row.snippet, start, end), row.rank) for row in rows]
@@ -0,0 +1,74 @@
+import math
+import os
+import random
+from typing import Any, Callable, Dict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, SessionTransaction, object_session
+
+from web.base import app, database
+from web.ttl_cache import TTLCache
+
+_UNCOMMITTED_ROWS = "uncommitted_rows"
+
+app.config["SERIALIZATION_CACHE_SIZE"] = int(
+    os.environ.get("SERIALIZATION_CACHE_SIZE", 100_000))
+
+# Serialized columns of recently used rows, keyed by (table, id, version). Every update bumps the
+# row's version, so entries never go stale, and old versions age out of the LRU
+_serialized: TTLCache[Dict[str, Any]] = TTLCache(
+    app.config["SERIALIZATION_CACHE_SIZE"], math.inf)
+
+
+def _initial_version() -> int:
+    return random.getrandbits(52)
+
+
+class Versioned:
+    # SQLite can reuse the id of a deleted row, so new rows start from a random version
+    # instead of 0 to not be served the deleted row's entries
+    version = database.Column(database.Integer, nullable=False,
+                              default=_initial_version, server_default="0")
+
+
+def cached_dict(instance: Any, build: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    row = (instance.__tablename__, instance.id)
+    session = object_session(instance)
+    # Rows changed by a transaction that is still open may yet be rolled back
+    if instance.id is None or instance.version is None or \
+            (session is not None and row in session.info.get(_UNCOMMITTED_ROWS, ())):
+        return build()
+
+    key = (*row, instance.version)
+    serialized = _serialized.get(key)
+    if serialized is None:
+        serialized = build()
+        _serialized.set(key, serialized)
+    return dict(serialized)
+
+
+def clear_serialization_cache():
+    _serialized.clear()
+
+
+@event.listens_for(Session, "before_flush")
+def _bump_versions(session: Session, *_):
+    for instance in session.dirty:
+        if isinstance(instance, Versioned) and \
+                session.is_modified(instance, include_collections=False):
+            # Incremented by the UPDATE itself, so concurrent writers never reuse a version
+            instance.version = type(instance).version + 1  # type: ignore
+
+
+@event.listens_for(Session, "after_flush")
+def _remember_flushed_rows(session: Session, _):
+    rows = session.info.setdefault(_UNCOMMITTED_ROWS, set())
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(instance, Versioned):
+            rows.add((instance.__tablename__, instance.id))  # type: ignore
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _forget_flushed_rows(session: Session, transaction: SessionTransaction):
+    if transaction.parent is None:
+        session.info.pop(_UNCOMMITTED_ROWS, None)
@@ -0,0 +1,104 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from flask import Response, abort, request, send_file
+from werkzeug.security import safe_join
+
+from web.base import app
+
+_IMMUTABLE = "public, max-age=31536000, immutable"
+_REVALIDATE = "no-cache"
+# Bundler output is content hashed, so never changes: a hex hash with letters and digits like
+# main.3b2e8f61.css, or 8 base64url characters like index-BxK3_9aZ.js. Dates and words are not
+_HASHED_ASSETS = [
+    re.compile(r"[.-](?=[0-9a-f]*[a-f])(?=[0-9a-f]*\d)[0-9a-f]{8,}\.[A-Za-z0-9]+$"),
+    re.compile(r"-(?=[A-Za-z0-9_-]{0,7}[a-z])[A-Za-z0-9_-](?=[A-Za-z0-9_-]{0,6}[A-Z0-9])"
+               r"[A-Za-z0-9_-]{7}\.[A-Za-z0-9]+$"),
+]
+
+
+class _Index(NamedTuple):
+    stat: Tuple[int, int]
+    content: bytes
+    compressed: bytes
+    etag: str
+
+
+_indexes: Dict[str, _Index] = {}
+_indexes_lock = threading.Lock()
+
+
+def _load_index(path: str) -> Optional[_Index]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    index = _indexes.get(path)
+    if index is not None and index.stat == (stat.st_mtime_ns, stat.st_size):
+        return index
+
+    with _indexes_lock:
+        with open(path, "rb") as file:
+            content = file.read()
+        index = _Index((stat.st_mtime_ns, stat.st_size), content, gzip.compress(content, mtime=0),
+                       hashlib.sha256(content).hexdigest()[:32])
+        _indexes[path] = index
+    return index
+
+
+def _accepts_gzip() -> bool:
+    return "gzip" in request.accept_encodings
+
+
+# Reloaded only when the file changes on disk, so deploys are picked up without a restart
+def _serve_index(folder: str) -> Response:
+    index = _load_index(os.path.join(folder, "index.html"))
+    if index is None:
+        abort(404)
+
+    # The gzip and identity bodies are different representations, so they get different tags
+    gzipped = _accepts_gzip()
+    etag = f"{index.etag}-gzip" if gzipped else index.etag
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif gzipped:
+        response = Response(index.compressed, mimetype="text/html")
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(index.content, mimetype="text/html")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = _REVALIDATE
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def _serve_asset(path: str, file_path: str) -> Response:
+    compressed_path = file_path + ".gz"
+    has_compressed = os.path.isfile(compressed_path)
+    if has_compressed and _accepts_gzip():
+        mimetype = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+        response = send_file(compressed_path, mimetype=mimetype, conditional=True)
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = send_file(file_path, conditional=True)
+    if has_compressed:
+        response.vary.add("Accept-Encoding")
+    hashed = any(pattern.search(path) for pattern in _HASHED_ASSETS)
+    response.headers["Cache-Control"] = _IMMUTABLE if hashed else _REVALIDATE
+    return response
+
+
+@app.route("/", defaults={'path': ''})
+@app.route("/<path:path>")
+def serve(path):
+    folder = str(app.config["STATIC_PATH"])
+    file_path = safe_join(folder, path) if path else None
+    if path != "index.html" and file_path is not None and os.path.isfile(file_path):
+        return _serve_asset(path, file_path)
+    # Client side routes are handled by the app itself
+    return _serve_index(folder)
@@ -0,0 +1,130 @@
+from typing import Any, Dict, List, Optional
+
+import sqlalchemy
+from sqlalchemy import event, text
+
+from web.base import database
+from web.ids import encode_id
+
+
+def _increment(user_id: str, facet: str, value: str, source: str = "WHERE true") -> str:
+    return f"""INSERT INTO piece_facets(user_id, facet, value, count)
+        SELECT {user_id}, '{facet}', {value}, 1 {source}
+        ON CONFLICT(user_id, facet, value) DO UPDATE SET count = count + 1;"""
+
+
+def _decrement(user_id: str, facet: str, value: str) -> str:
+    return f"""UPDATE piece_facets SET count = count - 1
+        WHERE user_id = {user_id} AND facet = '{facet}' AND value = {value};
+        DELETE FROM piece_facets WHERE user_id = {user_id} AND count <= 0;"""
+
+
+_TAG_OWNER = "(SELECT user_id FROM tags WHERE id = {}.tag_id)"
+
+# Pieces without an instrument are not counted under one, they are the rest of the total
+_FACET_TRIGGERS = {
+    "piece_facets_piece_insert": f"""AFTER INSERT ON pieces BEGIN
+        {_increment("new.user_id", "state", "new.state")}
+        {_increment("new.user_id", "instrument", "new.instrument",
+                    "WHERE new.instrument IS NOT NULL")}
+    END""",
+    "piece_facets_piece_delete": f"""AFTER DELETE ON pieces BEGIN
+        {_decrement("old.user_id", "state", "old.state")}
+        {_decrement("old.user_id", "instrument", "old.instrument")}
+    END""",
+    "piece_facets_piece_update": f"""AFTER UPDATE OF user_id, state, instrument ON pieces
+    WHEN old.user_id IS NOT new.user_id OR old.state IS NOT new.state
+        OR old.instrument IS NOT new.instrument BEGIN
+        {_decrement("old.user_id", "state", "old.state")}
+        {_decrement("old.user_id", "instrument", "old.instrument")}
+        {_increment("new.user_id", "state", "new.state")}
+        {_increment("new.user_id", "instrument", "new.instrument",
+                    "WHERE new.instrument IS NOT NULL")}
+    END""",
+    "piece_facets_tag_insert": f"""AFTER INSERT ON pieces_tags BEGIN
+        {_increment("user_id", "tag", "new.tag_id", "FROM tags WHERE id = new.tag_id")}
+    END""",
+    "piece_facets_tag_delete": f"""AFTER DELETE ON pieces_tags BEGIN
+        {_decrement(_TAG_OWNER.format("old"), "tag", "old.tag_id")}
+    END""",
+    "piece_facets_tag_removed": """AFTER DELETE ON tags BEGIN
+        DELETE FROM piece_facets
+        WHERE user_id = old.user_id AND facet = 'tag' AND value = old.id;
+    END""",
+}
+
+# Grouped by the leading columns of the pieces and pieces_tags indexes, so the counts are read
+# from the indexes alone
+_REBUILD_STATEMENTS = [
+    """INSERT INTO piece_facets(user_id, facet, value, count)
+    SELECT user_id, 'state', state, count(*) FROM pieces
+    WHERE {user_filter} GROUP BY user_id, state""",
+    """INSERT INTO piece_facets(user_id, facet, value, count)
+    SELECT user_id, 'instrument', instrument, count(*) FROM pieces
+    WHERE instrument IS NOT NULL AND {user_filter} GROUP BY user_id, instrument""",
+    """INSERT INTO piece_facets(user_id, facet, value, count)
+    SELECT tags.user_id, 'tag', pieces_tags.tag_id, count(*)
+    FROM pieces_tags JOIN tags ON tags.id = pieces_tags.tag_id
+    WHERE {tags_user_filter} GROUP BY pieces_tags.tag_id""",
+]
+
+
+def facet_triggers_exist(connection: sqlalchemy.Connection) -> bool:
+    return connection.execute(text(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'piece_facets_%'"
+    )).scalar() == len(_FACET_TRIGGERS)
+
+
+def create_facet_triggers(connection: sqlalchemy.Connection):
+    for name, body in _FACET_TRIGGERS.items():
+        connection.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+
+def rebuild_facet_counts(connection: sqlalchemy.Connection, user_id: Optional[int] = None):
+    if user_id is None:
+        connection.execute(text("DELETE FROM piece_facets"))
+        filters = {"user_filter": "true", "tags_user_filter": "true"}
+    else:
+        connection.execute(text("DELETE FROM piece_facets WHERE user_id = :user_id"),
+                           {"user_id": user_id})
+        filters = {"user_filter": "user_id = :user_id",
+                   "tags_user_filter": "tags.user_id = :user_id"}
+    for statement in _REBUILD_STATEMENTS:
+        connection.execute(text(statement.format(**filters)), {"user_id": user_id})
+
+
+# Runs after every create_all, so databases created before the counters get them filled once
+@event.listens_for(database.metadata, "after_create")
+def _create_facet_triggers(_, connection: sqlalchemy.Connection, **__):
+    if not facet_triggers_exist(connection):
+        create_facet_triggers(connection)
+        rebuild_facet_counts(connection)
+
+
+def _sorted_counts(counts: Dict[Any, int], key: str) -> List[Dict[str, Any]]:
+    return [{key: value, "count": count}
+            for value, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))]
+
+
+def get_piece_stats(session: Any, user_id: int) -> Dict[str, Any]:
+    rows = session.execute(text(
+        "SELECT facet, value, count FROM piece_facets WHERE user_id = :user_id AND count > 0"
+    ), {"user_id": user_id})
+    facets: Dict[str, Dict[Any, int]] = {"state": {}, "instrument": {}, "tag": {}}
+    for facet, value, count in rows:
+        facets[facet][value] = count
+
+    total = sum(facets["state"].values())
+    instruments = _sorted_counts(facets["instrument"], "instrument")
+    without_instrument = total - sum(facets["instrument"].values())
+    if without_instrument:
+        instruments.append({"instrument": None, "count": without_instrument})
+    return {
+        "total": total,
+        "states": sorted(({"state": int(state), "count": count}
+                          for state, count in facets["state"].items()),
+                         key=lambda state: state["state"]),
+        "instruments": instruments,
+        "tags": _sorted_counts({encode_id(int(tag_id)): count
+                                for tag_id, count in facets["tag"].items()}, "id"),
+    }
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import abc
+import hashlib
+import os
+import pathlib
+import tempfile
+from typing import BinaryIO, Iterator, NamedTuple, Optional, Union
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+class StoredBlob(NamedTuple):
+    sha256: str
+    size: int
+    path: str
+
+
+class BlobInfo(NamedTuple):
+    path: str
+    size: int
+    modified_at: float
+
+
+class BlobStorage(abc.ABC):
+    @abc.abstractmethod
+    def save(self, stream: BinaryIO) -> StoredBlob:
+        ...
+
+    @abc.abstractmethod
+    def save_file(self, source: Union[str, os.PathLike],
+                  sha256: Optional[str] = None) -> StoredBlob:
+        ...
+
+    @abc.abstractmethod
+    def temp_path(self, name: str) -> pathlib.Path:
+        ...
+
+    # The temporary files whose names start with `prefix`, with their names as the paths
+    @abc.abstractmethod
+    def temp_files(self, prefix: str) -> Iterator[BlobInfo]:
+        ...
+
+    @abc.abstractmethod
+    def open(self, path: str) -> BinaryIO:
+        ...
+
+    @abc.abstractmethod
+    def local_path(self, path: str) -> pathlib.Path:
+        ...
+
+    @abc.abstractmethod
+    def delete(self, path: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def exists(self, path: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def blobs(self) -> Iterator[BlobInfo]:
+        ...
+
+
+# Write-once blobs keyed by the SHA-256 of their content, sharded as ab/cd/abcd...
+class DiskBlobStorage(BlobStorage):
+    def __init__(self, root: Union[str, os.PathLike]) -> None:
+        self.root = pathlib.Path(root)
+
+    @staticmethod
+    def key_for(sha256: str) -> str:
+        return f"{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+    def _tmp_dir(self) -> pathlib.Path:
+        tmp = self.root / "tmp"
+        tmp.mkdir(parents=True, exist_ok=True)
+        return tmp
+
+    def _commit(self, tmp_path: pathlib.Path, sha256: str, size: int) -> StoredBlob:
+        key = self.key_for(sha256)
+        target = self.root / key
+        if target.exists():
+            tmp_path.unlink()
+            # Marks the blob as in use, so the maintenance sweep leaves it alone while the new
+            # reference is being committed
+            os.utime(target)
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, target)
+        return StoredBlob(sha256, size, key)
+
+    def save(self, stream: BinaryIO) -> StoredBlob:
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_name = tempfile.mkstemp(dir=self._tmp_dir())
+        tmp_path = pathlib.Path(tmp_name)
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                while chunk := stream.read(_CHUNK_SIZE):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        return self._commit(tmp_path, digest.hexdigest(), size)
+
+    # Moves `source` into the store, hashing it first unless its digest is already known
+    def save_file(self, source: Union[str, os.PathLike],
+                  sha256: Optional[str] = None) -> StoredBlob:
+        source = pathlib.Path(source)
+        if sha256 is None:
+            digest = hashlib.sha256()
+            with open(source, "rb") as stream:
+                while chunk := stream.read(_CHUNK_SIZE):
+                    digest.update(chunk)
+            sha256 = digest.hexdigest()
+        return self._commit(source, sha256, source.stat().st_size)
+
+    def temp_path(self, name: str) -> pathlib.Path:
+        return self._tmp_dir() / name
+
+    def temp_files(self, prefix: str) -> Iterator[BlobInfo]:
+        for temp in self._tmp_dir().glob(f"{prefix}*"):
+            try:
+                stat = temp.stat()
+            except FileNotFoundError:
+                continue
+            yield BlobInfo(temp.name, stat.st_size, stat.st_mtime)
+
+    def open(self, path: str) -> BinaryIO:
+        return open(self.local_path(path), "rb")
+
+    def local_path(self, path: str) -> pathlib.Path:
+        return self.root / path
+
+    def delete(self, path: str) -> None:
+        self.local_path(path).unlink(missing_ok=True)
+
+    def exists(self, path: str) -> bool:
+        return self.local_path(path).is_file()
+
+    def blobs(self) -> Iterator[BlobInfo]:
+        for blob in self.root.glob("??/??/*"):
+            try:
+                stat = blob.stat()
+            except FileNotFoundError:
+                continue
+            yield BlobInfo(blob.relative_to(self.root).as_posix(), stat.st_size, stat.st_mtime)
@@ -0,0 +1,187 @@
+import atexit
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, TypeVar
+
+import sqlalchemy
+from flask import Flask
+
+from web.base import app, database
+from web.database_config import WRITE_LOCK_OPTIONS, writing
+from web.exceptions import SonataAlreadyExistsException, SonataException
+
+_T = TypeVar("_T")
+
+
+class _PendingWrite(NamedTuple):
+    unit: Callable[[], Any]
+    future: Future
+
+
+def _is_busy(error: BaseException) -> bool:
+    return isinstance(error, sqlalchemy.exc.OperationalError) \
+        and "database is locked" in str(error)
+
+
+# Begins the transaction of the session with the write lock
+def _begin_write():
+    database.session.connection(execution_options=WRITE_LOCK_OPTIONS)
+
+
+# Runs units of work on a single writer thread. Whatever is queued when the thread becomes free
+# is applied in one transaction (group commit), each unit in its own savepoint so a failing
+# unit only fails its own caller
+class WriteCoordinator:  # pylint: disable=too-many-instance-attributes
+    def __init__(self, flask_app: Flask, max_batch: int, max_delay: float,
+                 busy_retries: int, busy_backoff: float) -> None:
+        self.app = flask_app
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.busy_retries = busy_retries
+        self.busy_backoff = busy_backoff
+        self._queue: "queue.Queue[Optional[_PendingWrite]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._metrics = {
+            "units": 0,
+            "batches": 0,
+            "largest_batch": 0,
+            "busy_retries": 0,
+        }
+
+    def submit(self, unit: Callable[[], _T]) -> "Future[_T]":
+        future: "Future[_T]" = Future()
+        with self._lock:
+            # Started lazily, so forked server workers each start their own thread
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="sonata-writer", daemon=True)
+                self._thread.start()
+        self._queue.put(_PendingWrite(unit, future))
+        return future
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._metrics)
+
+    def _next_batch(self) -> Optional[List[_PendingWrite]]:
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                pending = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if pending is None:
+                # Stops once this batch is written
+                self._queue.put(None)
+                break
+            batch.append(pending)
+        return batch
+
+    def _run(self):
+        while (batch := self._next_batch()) is not None:
+            # Skips the units whose caller stopped waiting
+            batch = [pending for pending in batch
+                     if pending.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                with self.app.app_context():
+                    outcomes = self._write(batch)
+            except Exception as e:  # pylint: disable=broad-except
+                outcomes = [(None, e)] * len(batch)
+            for pending, (result, error) in zip(batch, outcomes):
+                if error is None:
+                    pending.future.set_result(result)
+                else:
+                    pending.future.set_exception(error)
+
+    def _write(self, batch: List[_PendingWrite]) -> List[Tuple[Any, Optional[BaseException]]]:
+        with self._lock:
+            self._metrics["batches"] += 1
+            self._metrics["units"] += len(batch)
+            self._metrics["largest_batch"] = max(self._metrics["largest_batch"], len(batch))
+
+        attempt = 0
+        while True:
+            try:
+                _begin_write()
+                outcomes = [self._apply(pending.unit) for pending in batch]
+                database.session.commit()
+                return outcomes
+            except sqlalchemy.exc.OperationalError as e:
+                database.session.rollback()
+                if not _is_busy(e) or attempt >= self.busy_retries:
+                    raise
+            with self._lock:
+                self._metrics["busy_retries"] += 1
+            time.sleep(self.busy_backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+            attempt += 1
+
+    @staticmethod
+    def _apply(unit: Callable[[], Any]) -> Tuple[Any, Optional[BaseException]]:
+        try:
+            with database.session.begin_nested():
+                return unit(), None
+        except Exception as e:  # pylint: disable=broad-except
+            # A locked database fails the whole batch, which is then retried
+            if _is_busy(e):
+                raise
+            return None, e
+
+
+app.config["WRITE_COORDINATOR"] = os.environ.get("WRITE_COORDINATOR", "0") == "1"
+app.config["WRITE_BATCH_SIZE"] = int(os.environ.get("WRITE_BATCH_SIZE", 64))
+app.config["WRITE_BATCH_DELAY_MS"] = float(os.environ.get("WRITE_BATCH_DELAY_MS", 0))
+app.config["WRITE_BUSY_RETRIES"] = int(os.environ.get("WRITE_BUSY_RETRIES", 5))
+app.config["WRITE_BUSY_BACKOFF_MS"] = float(os.environ.get("WRITE_BUSY_BACKOFF_MS", 10))
+app.config["WRITE_TIMEOUT_S"] = float(os.environ.get("WRITE_TIMEOUT_S", 30))
+
+write_coordinator: Optional[WriteCoordinator] = None
+if app.config["WRITE_COORDINATOR"]:
+    write_coordinator = WriteCoordinator(app,
+                                         app.config["WRITE_BATCH_SIZE"],
+                                         app.config["WRITE_BATCH_DELAY_MS"] / 1000,
+                                         app.config["WRITE_BUSY_RETRIES"],
+                                         app.config["WRITE_BUSY_BACKOFF_MS"] / 1000)
+    atexit.register(write_coordinator.stop)
+
+
+# Applies a unit of work and commits it, in the current session or on the writer thread when the
+# write coordinator is enabled. Units only get plain values from the caller, since they may run
+# on another session, and return what the caller should respond with
+def run_write(unit: Callable[[], _T], conflict_message: str) -> _T:
+    try:
+        # Ends the caller's reads, which run without the write lock
+        database.session.commit()
+        if write_coordinator is None:
+            with writing():
+                _begin_write()
+                result = unit()
+                database.session.commit()
+            return result
+        future = write_coordinator.submit(unit)
+        try:
+            return future.result(timeout=app.config["WRITE_TIMEOUT_S"])
+        except FutureTimeoutError as e:
+            # A unit the writer thread already started may still be committed
+            future.cancel()
+            raise SonataException(503, "Server busy, try again later") from e
+    except sqlalchemy.exc.IntegrityError as e:
+        database.session.rollback()
+        raise SonataAlreadyExistsException(conflict_message) from e
@@ -0,0 +1 @@
+from web.base import app  # pylint: disable=unused-import